@@ -13,15 +13,41 @@ from __future__ import print_function, unicode_literals, division
 
 import argparse
 import codecs
+import collections
+import contextlib
+import errno
+import fnmatch
 import glob
+import heapq
+import importlib
+import io
+import json
+import mmap
 import os
 import os.path
 import re
+import select
 import shutil
+import socket
+import stat
+import struct
 import sys
 import tempfile
 import textwrap
+import time
 import unicodedata
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
 
 __version__ = '0.4.0'
 
@@ -31,6 +57,35 @@ FILESYSTEM_ENCODING = sys.getfilesystemencoding()
 FILE_ENCODING = sys.getdefaultencoding()
 INPUT_ENCODING = sys.getdefaultencoding()
 DEFAULT_BACKUP_EXTENSION = 'bak'
+DEFAULT_MEMOIZE_SIZE = 65536
+FICLONE = 0x40049409
+AUTO_ENCODING = 'auto'
+AUTO_ENCODING_FALLBACK = 'latin-1'
+AUTO_ENCODING_SNIFF_SIZE = 64 * 1024
+BLOCK_SIZE = 1024 * 1024
+GLOBAL_MEMORY_FACTOR = 2
+GLOBAL_STREAM_MIN_SIZE = 8 * 1024 * 1024
+PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+PARALLEL_SEGMENT_SIZE = 32 * 1024 * 1024
+RE_OTHER_LINEBREAKS = re.compile('\r(?!\n)|[\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32-le'),
+    (codecs.BOM_UTF32_BE, 'utf-32-be'),
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be'),
+)
+SERVER_ENV_VARIABLE = 'SUBST_SERVER'
+SERVER_REQUEST_TIMEOUT = 1.0
+INDEX_MAX_FILE_SIZE = 16 * 1024 * 1024
+INDEX_MAX_QUERY_TRIGRAMS = 64
+INDEX_SKIP_DIRECTORIES = ('.git', '.hg', '.svn')
+TEMP_FILE_PREFIX = '.subst-'
+WATCH_DEBOUNCE = 0.05
+WATCH_IGNORED_NAMES = re.compile(r'(?:^%s|~$|\.(?:tmp|swp)$)' % re.escape(TEMP_FILE_PREFIX))
+BUDGET_MAX_CHUNK = 1024
+CHECKPOINT_BATCH_SIZE = 1000
+CHECKPOINT_INTERVAL = 5.0
 
 
 if not IS_PY2:
@@ -66,6 +121,22 @@ def u(string, encoding='utf-8'):
     return string
 
 
+def _is_ascii_compatible(encoding):
+    """ Check if `encoding` encodes ASCII characters as single, identical bytes, and never uses
+        bytes from ASCII range inside of multibyte sequences.
+    """
+    name = codecs.lookup(encoding).name
+    return name in ('utf-8', 'ascii') or name.startswith(('iso8859-', 'cp125', 'koi8-', 'mac-'))
+
+
+def _encoded_len(text, encoding, ascii_compatible=True):
+    """ Return length in bytes of `text` encoded with `encoding`.
+    """
+    if ascii_compatible and not IS_PY2 and text.isascii():
+        return len(text)
+    return len(text.encode(encoding))
+
+
 def err(*args, **kwargs):
     """
     Display error message.
@@ -151,6 +222,53 @@ def _plural_s(cnt, word):
     return '%ss' % word
 
 
+try:
+    unichr
+except NameError:
+    # pylint: disable=invalid-name
+    unichr = chr
+
+
+def _parse_args__size(value):
+    """ Parse size given as number of bytes, optionally with suffix K, M, G or T.
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$', value, re.IGNORECASE)
+    if not match:
+        raise argparse.ArgumentTypeError('invalid size: %s' % value)
+
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' kmgt'.index(unit.lower() or ' '))
+
+
+def _parse_args__line_range(value):
+    """ Parse range of lines given as "A-B" (numbered from 1; any of them can be omitted) or
+        single number.
+
+        Returns tuple: (first line, last line or None).
+    """
+    match = re.match(r'^\s*(\d*)\s*(?:(-)\s*(\d*))?\s*$', value)
+    if not match or not any(match.group(1, 3)):
+        raise argparse.ArgumentTypeError('invalid range of lines: %s' % value)
+
+    first, dash, last = match.groups()
+    first = int(first) if first else 1
+    last = int(last) if last else (None if dash else first)
+    if first < 1 or (last is not None and last < first):
+        raise argparse.ArgumentTypeError('invalid range of lines: %s' % value)
+    return first, last
+
+
+def _parse_args__shard(value):
+    """ Parse shard given as "I/N": shard I (numbered from 0) of N.
+
+        Returns tuple: (I, N).
+    """
+    match = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', value)
+    if not match or not int(match.group(1)) < int(match.group(2)):
+        raise argparse.ArgumentTypeError('invalid shard (expected I/N, where 0 <= I < N): %s' % value)
+    return int(match.group(1)), int(match.group(2))
+
+
 def _parse_args__get_backup_file_ext(args):
     """ Find extension for backup files.
 
@@ -177,6 +295,169 @@ def _parse_args__eval_replacement(repl):
     return _
 
 
+def _parse_args__replace_func(spec):
+    """ Import replacement function given as "package.module:function".
+
+        If name of function ends with "()", it's a factory: it's called once, without
+        arguments, and returned value is used as replacement function.
+    """
+    try:
+        module_name, func_name = spec.split(':', 1)
+    except ValueError:
+        raise ParserException('Bad replacement function specified (expected MODULE:FUNCTION): %s' % spec)
+
+    is_factory = func_name.endswith('()')
+    if is_factory:
+        func_name = func_name[:-2]
+
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+
+    try:
+        func = importlib.import_module(module_name)
+    except ImportError as exc:
+        raise ParserException('Cannot import module "%s": %s' % (module_name, exc))
+
+    try:
+        for attr in func_name.split('.'):
+            func = getattr(func, attr)
+    except AttributeError:
+        raise ParserException('Module "%s" has no attribute "%s"' % (module_name, func_name))
+
+    if is_factory:
+        func = func()
+
+    if not callable(func):
+        raise ParserException('Replacement function "%s" is not callable' % spec)
+
+    return func
+
+
+class _MemoizedReplacement(object):
+    """ Wrapper for replacement function, which caches its results by matched text and groups.
+
+        At most `size` results are kept, least recently used are dropped first.
+    """
+
+    def __init__(self, func, size):
+        self._func = func
+        self._size = size
+        self._cache = collections.OrderedDict()
+        self.hits = self.misses = 0
+
+    def __call__(self, match):
+        key = (match.group(0), ) + match.groups()
+        try:
+            result = self._cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            result = self._func(match)
+            self.misses += 1
+            if len(self._cache) >= self._size:
+                self._cache.popitem(last=False)
+        self._cache[key] = result
+        return result
+
+
+CASE_SEPARATORS = '_-'
+
+
+def _case_words(text):
+    """ Split `text` into words, at separators (see: CASE_SEPARATORS) and changes of case
+        ("fooBar", "HTTPServer"). Returns tuple: (words, separators between them).
+    """
+    words, separators = [], []
+    start = 0
+    for i, char in enumerate(text):
+        if char in CASE_SEPARATORS:
+            words.append(text[start:i])
+            separators.append(char)
+            start = i + 1
+        elif i > start and char.isupper() and (
+                not text[i - 1].isupper() or i + 1 < len(text) and text[i + 1].islower()):
+            words.append(text[start:i])
+            separators.append('')
+            start = i
+    words.append(text[start:])
+    return words, separators
+
+
+def _case_shape(word):
+    """ Return case of `word`: "lower", "upper", "title", or None (mixed or without letters).
+    """
+    if word.islower():
+        return 'lower'
+    elif word.isupper():
+        return 'upper'
+    elif word.istitle():
+        return 'title'
+    return None
+
+
+def _case_apply(word, shape):
+    """ Change case of `word` to `shape` (see: `_case_shape`).
+    """
+    if shape == 'lower':
+        return word.lower()
+    elif shape == 'upper':
+        return word.upper()
+    elif shape == 'title':
+        return word[:1].upper() + word[1:].lower()
+    return word
+
+
+class _PreserveCase(object):
+    """ Replacement function giving replacement (`replace` template or function) the same case
+        shape, as matched text has.
+
+        Matched text, which is single word, changes case of whole replacement: "foo" to lower, "FOO"
+        to upper and "Foo" to first letter upper. Matched text made of many words ("fooBar", "FooBar",
+        "foo_bar", "FOO-BAR") changes case of every word of replacement, and joins them with the same
+        separator. Words are split at changes of case too, so "fOO" is made of words "f" and "OO", like
+        "fooBAR". Other texts (like "foo_Bar-baz", "foo_BAR_Baz") get replacement unchanged.
+    """
+
+    def __init__(self, pattern, replace):
+        if callable(replace):
+            self._expand = replace
+        elif '\\' in replace:
+            self._expand = _replace_global__template(pattern, replace)
+        else:
+            self._expand = lambda match: replace
+        self._words = {}
+
+    def _split(self, replacement):
+        """ Return words of `replacement`, cached (replacement is usually constant).
+        """
+        try:
+            return self._words[replacement]
+        except KeyError:
+            if len(self._words) >= DEFAULT_MEMOIZE_SIZE:
+                self._words.clear()
+            words = self._words[replacement] = _case_words(replacement)[0]
+            return words
+
+    def __call__(self, match):
+        replacement = self._expand(match)
+        text = match.group(0)
+        words, separators = _case_words(text)
+
+        if len(words) == 1:
+            shape = _case_shape(text)
+            if shape == 'title':
+                return replacement[:1].upper() + replacement[1:]
+            return _case_apply(replacement, shape)
+
+        shapes = [_case_shape(word) for word in words]
+        if None in shapes or len(set(separators)) != 1 or len(set(shapes[1:])) != 1:
+            return replacement
+
+        replacement_words = self._split(replacement)
+        return separators[0].join(
+            [_case_apply(replacement_words[0], shapes[0])] +
+            [_case_apply(word, shapes[1]) for word in replacement_words[1:]])
+
+
 def _parse_args__parse_pattern(pat):
     """
     Split pattern into search, replacement and flags.
@@ -235,7 +516,7 @@ def _parse_args__pattern(args):
     """
 
     re_flags = re.UNICODE
-    if args.ignore_case:
+    if args.ignore_case or getattr(args, 'preserve_case', False):
         re_flags |= re.IGNORECASE
 
     if args.pattern_dot_all:
@@ -299,6 +580,154 @@ def _parse_args__pattern(args):
         raise ParserException('Bad pattern specified: %s' % args.pattern_and_replace)
 
 
+class _Rules(object):
+    """ Rules read from file given with --rules: groups of path globs, with list of
+        (compiled pattern, replacement, count) applied to files matching any of them.
+
+        Globs containing "/" are matched against path relative to current directory, other ones
+        against name of file.
+    """
+
+    def __init__(self, groups):
+        self._cwd = os.getcwdu() if IS_PY2 else os.getcwd()
+        self._groups = []
+        for globs, rules in groups:
+            self._groups.append((
+                self._compile([glob_ for glob_ in globs if '/' not in glob_]),
+                self._compile([glob_ for glob_ in globs if '/' in glob_]),
+                rules,
+            ))
+
+    @staticmethod
+    def _compile(globs):
+        """ Compile `globs` into single regular expression.
+        """
+        if not globs:
+            return None
+        return re.compile('|'.join('(?:%s)' % fnmatch.translate(glob_) for glob_ in globs))
+
+    def for_path(self, path):
+        """ Return list of rules for file at `path`.
+        """
+        name = os.path.basename(path)
+        relative = None
+        result = []
+        for name_re, path_re, rules in self._groups:
+            if name_re and name_re.match(name):
+                result.extend(rules)
+            elif path_re:
+                if relative is None:
+                    relative = os.path.relpath(path, self._cwd).replace(os.sep, '/')
+                if path_re.match(relative):
+                    result.extend(rules)
+        return result
+
+
+def _parse_args__rules(path, args):
+    """ Read rules file at `path`: lines "[GLOB ...]" start group of rules for files matching
+        any of globs, and every other line is expression like in --pattern-and-replace, applied
+        to these files (in order). Empty lines and lines starting with "#" are ignored.
+
+        Flags from other arguments (like --ignore-case) apply to all expressions.
+    """
+    try:
+        with io.open(path, 'r', encoding='utf-8') as fh:
+            lines = fh.read().splitlines()
+    except (IOError, OSError, UnicodeDecodeError) as ex:
+        raise ParserException('Cannot read rules file "%s": %s' % (path, ex))
+
+    groups = []
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        if line.startswith('[') and line.endswith(']'):
+            groups.append((line[1:-1].split(), []))
+            continue
+
+        if not groups:
+            raise ParserException('Rules file "%s", line %d: expression before first [GLOB ...] line' % (path, lineno))
+
+        rule_args = argparse.Namespace(**vars(args))
+        rule_args.pattern = rule_args.replace = None
+        rule_args.pattern_and_replace = line
+        try:
+            pattern, replace, count = _parse_args__pattern(rule_args)
+            if getattr(args, 'preserve_case', False):
+                replace = _PreserveCase(pattern, replace)
+            groups[-1][1].append((pattern, replace, count))
+        except (ParserException, re.error) as ex:
+            raise ParserException('Rules file "%s", line %d: %s' % (path, lineno, ex))
+
+    return _Rules(groups)
+
+
+class _Shard(object):
+    """ Deterministic assignment of paths to one of `count` shards, selecting these assigned to
+        shard `index`.
+
+        Paths from `sizes` (dict: path -> size, see: `_parse_args__shard_listing`) are assigned so
+        that every shard gets similar total size (biggest files first, every one to shard with the
+        smallest total). Other paths are assigned by CRC-32 of normalized path, so relative paths
+        are assigned the same way on every node started in the same directory.
+    """
+
+    def __init__(self, index, count, sizes=None):
+        self.index = index
+        self.count = count
+        self._assigned = {}
+        if sizes:
+            loads = [(0, shard) for shard in range(count)]
+            for path, size in sorted(sizes.items(), key=lambda item: (-item[1], item[0])):
+                load, shard = heapq.heappop(loads)
+                self._assigned[path] = shard
+                heapq.heappush(loads, (load + size, shard))
+
+    @staticmethod
+    def key(path):
+        """ Return normalized `path`, used to assign it to shard.
+        """
+        return os.path.normcase(os.path.normpath(path))
+
+    def listed(self):
+        """ Return paths from listing assigned to this shard.
+        """
+        return sorted(path for path, shard in self._assigned.items() if shard == self.index)
+
+    def selects(self, path):
+        """ Check if `path` is assigned to this shard.
+        """
+        key = self.key(path)
+        shard = self._assigned.get(key)
+        if shard is None:
+            shard = (zlib.crc32(key.encode('utf-8', 'replace')) & 0xffffffff) % self.count
+        return shard == self.index
+
+
+def _parse_args__shard_listing(path):
+    """ Read listing of files for --shard-listing: lines "SIZE PATH" (like output of
+        `find -type f -printf '%s %p\\n'`).
+
+        Returns dict: normalized path -> size.
+    """
+    sizes = {}
+    try:
+        with io.open(path, 'r', encoding='utf-8') as fh:
+            for lineno, line in enumerate(fh, 1):
+                line = line.rstrip('\r\n')
+                if not line.strip():
+                    continue
+                try:
+                    size, file_path = line.lstrip().split(None, 1)
+                    sizes[_Shard.key(file_path)] = int(size)
+                except ValueError:
+                    raise ParserException('Listing "%s", line %d: expected "SIZE PATH"' % (path, lineno))
+    except (IOError, OSError, UnicodeDecodeError) as ex:
+        raise ParserException('Cannot read listing "%s": %s' % (path, ex))
+    return sizes
+
+
 def _parse_args__expand_wildcards(paths):
     """
     Expand wildcards in given paths
@@ -322,9 +751,11 @@ def _parse_args__expand_wildcards(paths):
     return _paths
 
 
-def _parse_args__prepare_paths(files, expand_wildcards):
+def _parse_args__prepare_paths(files, expand_wildcards, shard=None, links=None):
     """
-    Prepare paths for processing
+    Prepare paths for processing (only these assigned to `shard`, if given - other
+    paths aren't even stat'ed). Hard links are removed, if `links` is given (see:
+    `_parse_args__dedupe`)
     """
     if not IS_WIN:
         files = [u(path, INPUT_ENCODING) for path in files]
@@ -332,18 +763,75 @@ def _parse_args__prepare_paths(files, expand_wildcards):
     if expand_wildcards:
         files = _parse_args__expand_wildcards(files)
 
-    files = (os.path.abspath(path) for path in files)
-    files = (os.path.normcase(path) for path in files)
+    if shard:
+        files = [path for path in files if shard.selects(path)]
+
+    cwd = os.getcwdu() if IS_PY2 else os.getcwd()
+    files = (os.path.normcase(os.path.normpath(os.path.join(cwd, path))) for path in files)
+    return _parse_args__dedupe((FileEntry(path) for path in files), links)
+
+
+def _parse_args__git(*git_args):
+    """ Run git command with `git_args`, returning NUL separated paths from its output.
+    """
+    import subprocess
+
+    try:
+        proc = subprocess.Popen(('git', ) + git_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as ex:
+        raise SubstException('Cannot run git: %s' % ex)
+
+    out, errors = proc.communicate()
+    if proc.returncode:
+        raise SubstException('git %s failed: %s' % (git_args[0], u(errors, FILESYSTEM_ENCODING).strip()))
+
+    return [u(path, FILESYSTEM_ENCODING) for path in out.split(b'\0') if path]
+
+
+def _parse_args__git_files(args, pathspecs):
+    """ List files selected with --git, --git-changed and --git-untracked, limited to `pathspecs`
+        (if any), relative to current directory.
+    """
+    pathspecs = ['--'] + [u(path, INPUT_ENCODING) for path in pathspecs]
+
+    files = collections.OrderedDict()
+    if args.git:
+        files.update((path, None) for path in _parse_args__git('ls-files', '-z', *pathspecs))
+    if args.git_changed:
+        files.update((path, None) for path in _parse_args__git(
+            'diff', '--name-only', '-z', '--relative', '--diff-filter=d', args.git_changed, *pathspecs))
+    if args.git_untracked:
+        files.update((path, None) for path in _parse_args__git(
+            'ls-files', '-z', '--others', '--exclude-standard', *pathspecs))
     return list(files)
 
 
-# pylint: disable=too-many-branches,too-many-statements
-def parse_args(args):
-    """ Parse arguments passed to script, validate it, compile if needed and return.
+def _parse_args__dedupe(entries, links=None):
+    """ Remove repeated files (the same path) from `entries`, keeping order.
+
+        If `links` (dict) is given, hard links to the same inode are removed too: entries of removed
+        links are stored in `links` by path of kept entry, so result of processing it can be copied
+        to them (every file is replaced by new one, so links don't share content any more).
     """
+    seen = {}
+    result = []
+    for entry in entries:
+        key = (entry.dev, entry.ino) if links is not None and entry.exists() else entry.path
+        if key not in seen:
+            seen[key] = entry
+            result.append(entry)
+        elif entry.path != seen[key].path:
+            links.setdefault(seen[key].path, []).append(entry)
+    return result
 
-    # pylint: disable=global-statement
-    global INPUT_ENCODING, FILE_ENCODING, FILESYSTEM_ENCODING
+
+# parser created once by server (see: `_serve__warm`), inherited by processes handling requests
+_PARSER = None
+
+
+def _parse_args__parser():
+    """ Create parser of arguments passed to script.
+    """
 
     args_description = 'Replace PATTERN with REPLACE in many files.'
     # pylint: disable=invalid-name
@@ -362,9 +850,11 @@ def parse_args(args):
             * regular expressions with non linear search read whole file to yours computer memory - if file size is bigger then you have memory in your computer, it fails
             * parsing expression passed to --pattern-and-replace argument is very simple - if you use / as delimiter, then in your expression can't be used this character anymore. If you need to use same character as delimiter and in expression, then better use --pattern and --replace arguments
             * you can test exit code to verify there was made any changes (exit code = 0) or not (exit code = 1)
+            * subst --serve SOCKET starts a server which keeps subst warm. When environment variable SUBST_SERVER points to this socket, every subst call forwards its arguments, working directory and standard streams to the server instead of doing the work itself (if server is unavailable, work is done locally). Requires Python 3.9+
 
             Security notes:
             * be careful with --eval-replace argument. When it's given, value passed to --replace is eval-ed, so any unsafe code will be executed!
+            * be careful with --replace-func argument. Given module is imported (also from current directory), so any code in it will be executed!
 
             Author:
             Marcin Sztolcman <marcin@urzenia.net> // http://urzenia.net
@@ -381,16 +871,56 @@ def parse_args(args):
     p.add_argument('--eval-replace', dest='eval', action='store_true',
                    help='if specified, make eval data from --replace(should be valid Python code). Ignored with '
                    '--pattern-and-replace argument.')
+    p.add_argument('--replace-func', metavar='MODULE:FUNCTION', type=str,
+                   help='import FUNCTION from MODULE (once) and use it to make replacement: it gets MatchObject and must '
+                   'return string. If FUNCTION ends with "()", it\'s called once and returned function is used (for '
+                   'example to build lookup tables). Supersede --replace and replacement from --pattern-and-replace.')
+    p.add_argument('--memoize', metavar='SIZE', type=int, nargs='?', const=DEFAULT_MEMOIZE_SIZE,
+                   help='cache results of --eval-replace code or --replace-func function by matched text and groups, so '
+                   'it\'s executed once for every distinct match (it must not depend on anything else). Keeps at most '
+                   'SIZE results (default: %d).' % DEFAULT_MEMOIZE_SIZE)
     p.add_argument('-t', '--string', action='store_true',
                    help='if specified, treats --pattern as string, not as regular expression. Ignored with '
                    '--pattern-and-replace argument.')
     p.add_argument('-s', '--pattern-and-replace', '--pattern-and-replace', metavar='"s/PAT/REP/gixsm"', type=str,
                    help='pattern and replacement in one: s/pattern/replace/g(pattern is always regular expression, /g '
                    'is optional and stands for --count=0, /i == --ignore-case, /s == --pattern-dot-all, /m == --pattern-multiline).')
+    p.add_argument('--rules', metavar='FILE', type=str,
+                   help='apply to every file expressions (like in --pattern-and-replace) from groups in FILE matching '
+                   'its path. FILE contains lines "[GLOB ...]" starting groups, followed by expressions, one per line.')
+    p.add_argument('--preserve-case', action='store_true',
+                   help='match pattern ignoring case, and give replacement the same case shape as matched text: '
+                   'lower, UPPER, Title, camelCase, PascalCase, snake_case or kebab-case (for example with "s/foo[_-]?bar/new_name/g" '
+                   '"fooBar" is replaced with "newName", and "FOO-BAR" with "NEW-NAME"). '
+                   'Replacement should be written in lower case.')
     p.add_argument('-c', '--count', type=int,
                    help='make COUNT replacements for every file (0 makes unlimited changes, default).')
+    p.add_argument('--max-total-replacements', metavar='COUNT', type=int,
+                   help='make at most COUNT replacements in all files together, and stop processing files when limit '
+                   'is reached.')
+    p.add_argument('--exit-on-first-match', action='store_true',
+                   help='don\'t replace anything, only check if pattern matches in any file: stop on first match, and '
+                   'exit with code 0 if pattern was found, 1 otherwise.')
+    p.add_argument('-j', '--jobs', type=int, default=1,
+                   help='use up to JOBS processes: files are processed in parallel (biggest first), and big files are '
+                   'split into segments processed in parallel, if pattern can\'t match across lines.')
+    p.add_argument('--memory-limit', metavar='SIZE', type=_parse_args__size,
+                   help='with --jobs, process files in parallel only as long as their estimated memory usage fits '
+                   'in SIZE (like: 512M, 4G). Defaults to available memory.')
+    p.add_argument('--between', nargs=2, metavar=('START', 'END'),
+                   help='replace only in lines between lines matching regular expressions START and END (lines with '
+                   'markers aren\'t changed; region without END lasts to the end of file). File is read as a stream.')
+    p.add_argument('--lines', metavar='A-B', type=_parse_args__line_range,
+                   help='replace only in lines from A to B (numbered from 1, like: 10-20, 10-, -20, 15). File is read '
+                   'as a stream.')
     p.add_argument('-l', '--linear', action='store_true',
                    help='apply pattern for every line separately. Without this flag whole file is read into memory.')
+    p.add_argument('--engine', choices=list(ENGINES), default='auto',
+                   help='how files are processed: global (whole file in memory), linear (line by line, like --linear), '
+                   'windowed (blocks of lines; pattern can\'t match across lines), mmap (memory mapped file; pattern '
+                   'must use only ASCII characters, without classes like \\w or dot), literal (pattern must be '
+                   'constant text, without backreferences in replacement). Default: auto - choose the fastest engine '
+                   'giving the same result for every file (see --debug).')
     p.add_argument('-i', '--ignore-case', dest='ignore_case', action='store_true',
                    help='ignore case of characters when matching')
     p.add_argument('--pattern-dot-all', dest='pattern_dot_all', action='store_true',
@@ -405,28 +935,102 @@ def parse_args(args):
     p.add_argument('--encoding-input', type=str, default=INPUT_ENCODING,
                    help='set encoding for parameters like --pattern etc (default for your system: %s)' % INPUT_ENCODING)
     p.add_argument('--encoding-file', type=str, default=FILE_ENCODING,
-                   help='set encoding for content of processed files (default for your system: %s)' % FILE_ENCODING)
+                   help='set encoding for content of processed files (default for your system: %s). With "auto", '
+                   'encoding is detected for every file separately: from BOM, or UTF-8 if beginning of file is valid '
+                   'UTF-8, or %s otherwise. Files are saved in detected encoding and with the same BOM.' % (
+                       FILE_ENCODING, AUTO_ENCODING_FALLBACK))
+    p.add_argument('--encoding-cache', metavar='FILE', type=str,
+                   help='cache encodings detected with --encoding-file=auto in FILE, to not detect them again in next '
+                   'runs.')
     p.add_argument('--encoding-filesystem', type=str, default=FILESYSTEM_ENCODING,
                    help='set encoding for paths and filenames (default for your system: %s)' % FILESYSTEM_ENCODING)
     p.add_argument('-b', '--no-backup', dest='no_backup', action='store_true',
                    help='don\'t create backup of modified files.')
     p.add_argument('-e', '--backup-extension', dest='ext', default=DEFAULT_BACKUP_EXTENSION, type=str,
                    help='extension for backup files(ignore if no backup is created), without leading dot. Defaults to: "bak".')
+    p.add_argument('--in-place-patch', action='store_true',
+                   help='if all replacements in file have the same length (in bytes) as replaced text, write only '
+                   'changed bytes directly into the file instead of rewriting it (faster for big files with few '
+                   'changes; note that hard links to file are changed too). In other case, file is processed normally.')
+    p.add_argument('--dedupe-content', action='store_true',
+                   help='process only one of files with identical content, and copy result to the others (replacement '
+                   'is assumed to be deterministic).')
     p.add_argument('-W', '--expand-wildcards', action='store_true',
                    help='expand wildcards (see: https://docs.python.org/3/library/glob.html) in paths')
+    p.add_argument('--git', action='store_true',
+                   help='process files tracked by git in current directory (given files are used as git pathspecs '
+                   'limiting selection).')
+    p.add_argument('--git-changed', metavar='REV',
+                   help='process files changed (in index or working tree) since git revision REV.')
+    p.add_argument('--git-untracked', action='store_true',
+                   help='process files not tracked by git, and not ignored.')
+    p.add_argument('--index', metavar='FILE', type=str,
+                   help='use trigram index stored in FILE (see: --build-index) to skip files which can\'t contain '
+                   'matches. Without given files, all indexed files are checked (run --build-index again to find '
+                   'new files).')
+    p.add_argument('--build-index', metavar='DIR', type=str,
+                   help='build trigram index of files in DIR (updating only new and changed files, if it exists), '
+                   'store it in file given with --index and exit.')
     p.add_argument('--stdin', action='store_true',
                    help='read data from STDIN(implies --stdout)')
     p.add_argument('--stdout', action='store_true',
                    help='output data to STDOUT instead of change files in-place(implies --no-backup)')
+    p.add_argument('--report', metavar='FILE', type=str,
+                   help='write to FILE position of every replacement, as JSON Lines: path, byte offset, line, column, '
+                   'length of matched text and of replacement (in bytes).')
+    p.add_argument('--manifest', metavar='FILE', type=str,
+                   help='write to FILE record for every changed file, as JSON Lines: path, SHA-256 hashes and sizes of '
+                   'old and new content, and quantity of replacements. Hashes are computed while data is processed '
+                   '(kernel copies, --in-place-patch and splitting files into segments are not used).')
+    p.add_argument('--shard', metavar='I/N', type=_parse_args__shard,
+                   help='process only files assigned to shard I (numbered from 0) of N: by CRC-32 of path (relative '
+                   'paths are assigned the same way, when run from the same directory), or by --shard-listing. Files '
+                   'of other shards aren\'t even stat\'ed.')
+    p.add_argument('--shard-listing', metavar='FILE', type=str,
+                   help='assign files listed in FILE (lines "SIZE PATH") to shards so that every shard has similar '
+                   'total size. Without given files, files from FILE assigned to this shard are processed.')
+    p.add_argument('--summary', metavar='FILE', type=str,
+                   help='write to FILE summary of run as JSON: shard, quantities of files, changed files and '
+                   'replacements, and time (see: --merge-summaries).')
+    p.add_argument('--merge-summaries', action='store_true',
+                   help='merge summaries (see: --summary) given as files, print it as JSON and exit. Exit code is 1, '
+                   'if summaries of some shards are missing.')
+    p.add_argument('--checkpoint', metavar='FILE', type=str,
+                   help='append to FILE paths of finished files (in batches, synced to disk) and of backup files (before '
+                   'writing files), so interrupted run can be continued with --resume.')
+    p.add_argument('--resume', action='store_true',
+                   help='skip files stored in --checkpoint file by previous run, and restore other files from backup '
+                   'files made by interrupted run (stored in --checkpoint file) before processing them. Files given '
+                   'with --report and --manifest are appended to. Can\'t be used with --no-backup.')
     p.add_argument('-V', '--verbose', action='store_true',
                    help='show files and how many replacements was done and short summary')
     p.add_argument('--debug', action='store_true',
                    help='show more informations')
+    p.add_argument('--watch', action='store_true',
+                   help='watch given files and directories (recursively) with inotify, and process files every time '
+                   'they are written (closed after writing, or moved in), until interrupted. Backup file is '
+                   'refreshed every time file is processed again. Linux only.')
+    p.add_argument('--serve', metavar='SOCKET', type=str,
+                   help='start server listening on UNIX socket SOCKET, and process requests forwarded by clients (see: '
+                   'SUBST_SERVER environment variable).')
     p.add_argument('-v', '--version', action='version',
         version="%s %s\n%s" % (os.path.basename(sys.argv[0]), __version__, args_description))
     p.add_argument('files', nargs='*', type=str,
                    help='files to parse')
 
+    return p
+
+
+# pylint: disable=too-many-branches,too-many-statements
+def parse_args(args):
+    """ Parse arguments passed to script, validate it, compile if needed and return.
+    """
+
+    # pylint: disable=global-statement
+    global INPUT_ENCODING, FILE_ENCODING, FILESYSTEM_ENCODING
+
+    # pylint: disable=invalid-name
+    p = _PARSER or _parse_args__parser()
     args = p.parse_args(args)
 
     if args.utf8:
@@ -439,24 +1043,167 @@ def parse_args(args):
 
     try:
         codecs.lookup(INPUT_ENCODING)
-        codecs.lookup(FILE_ENCODING)
+        if FILE_ENCODING != AUTO_ENCODING:
+            codecs.lookup(FILE_ENCODING)
         codecs.lookup(FILESYSTEM_ENCODING)
     except LookupError as exc:
         p.error(exc)
 
-    if not args.files or args.files[0] == str('-'):
+    if FILE_ENCODING == AUTO_ENCODING and IS_PY2:
+        p.error('--encoding-file=auto requires Python 3.')
+
+    if args.encoding_cache and FILE_ENCODING != AUTO_ENCODING:
+        p.error('--encoding-cache can be used only with --encoding-file=auto.')
+
+    if args.serve:
+        if not hasattr(socket, 'send_fds') or not hasattr(socket, 'AF_UNIX'):
+            p.error('--serve requires Python 3.9+ and UNIX sockets support.')
+        return args
+
+    if args.build_index:
+        if not args.index:
+            p.error('--build-index requires --index.')
+        if not os.path.isdir(args.build_index):
+            p.error('--build-index: "%s" is not a directory.' % args.build_index)
+        return args
+
+    if args.merge_summaries:
+        if not args.files:
+            p.error('--merge-summaries requires summary files.')
+        return args
+
+    if args.shard_listing and not args.shard:
+        p.error('--shard-listing requires --shard.')
+
+    if args.shard:
+        # pylint: disable=too-many-boolean-expressions
+        if args.stdin or args.watch or (args.files and args.files[0] == str('-')) or not (
+                args.files or args.shard_listing or args.index or args.git or args.git_changed or args.git_untracked):
+            p.error('--shard requires files, and can\'t be used with --stdin or --watch.')
+        try:
+            sizes = _parse_args__shard_listing(args.shard_listing) if args.shard_listing else None
+        except ParserException as ex:
+            p.error(ex)
+        args.shard = _Shard(args.shard[0], args.shard[1], sizes)
+
+    if args.index and not os.path.isfile(args.index):
+        p.error('--index: "%s" doesn\'t exist, build it with --build-index.' % args.index)
+
+    # results are copied to hard links of processed files, like with --dedupe-content
+    args.hard_links = None
+    if not (args.stdout or args.report or args.manifest or args.watch or args.max_total_replacements is not None):
+        args.hard_links = {}
+
+    if args.git or args.git_changed or args.git_untracked:
+        if args.stdin:
+            p.error('--git, --git-changed and --git-untracked can\'t be used with --stdin.')
+        try:
+            files = _parse_args__git_files(args, args.files)
+        except SubstException as exc:
+            p.error(exc)
+        # git lists symbolic links, submodules and deleted files too
+        args.files = [entry for entry in _parse_args__prepare_paths(files, False, args.shard, args.hard_links)
+                      if entry.is_regular()]
+    elif args.shard and args.shard_listing and not args.files:
+        args.files = _parse_args__prepare_paths(args.shard.listed(), False, links=args.hard_links)
+    elif args.index and not args.files:
+        # all indexed files (see: `_main__index_candidates`)
+        args.files = None
+    elif not args.files or args.files[0] == str('-'):
         args.stdin = True
         args.files = None
     else:
-        args.files = _parse_args__prepare_paths(args.files, args.expand_wildcards)
+        args.files = _parse_args__prepare_paths(args.files, args.expand_wildcards, args.shard, args.hard_links)
 
 
     if args.stdin:
         args.stdout = True
 
-    if args.stdout:
+    if args.stdout or args.exit_on_first_match:
         args.no_backup = True
 
+    if args.jobs < 1:
+        p.error('--jobs must be greater than 0.')
+
+    if args.memoize is not None:
+        if not args.eval and not args.replace_func:
+            p.error('--memoize can be used only with --eval-replace or --replace-func.')
+        if args.memoize < 1:
+            p.error('--memoize size must be greater than 0.')
+
+    if args.max_total_replacements is not None and args.max_total_replacements < 1:
+        p.error('--max-total-replacements must be greater than 0.')
+
+    if args.watch:
+        if not sys.platform.startswith('linux'):
+            p.error('--watch is available only on Linux.')
+        # pylint: disable=too-many-boolean-expressions
+        if args.stdin or args.exit_on_first_match or args.dedupe_content or args.index or \
+                args.max_total_replacements is not None:
+            p.error('--watch requires files or directories, and can\'t be used with --exit-on-first-match, '
+                    '--dedupe-content, --index or --max-total-replacements.')
+
+    if args.resume and not args.checkpoint:
+        p.error('--resume requires --checkpoint.')
+
+    if args.checkpoint and (args.stdin or args.stdout or args.watch or args.exit_on_first_match):
+        p.error('--checkpoint can\'t be used with --stdin, --stdout, --watch or --exit-on-first-match.')
+
+    # without backups, files finished but not yet stored in checkpoint file can't be restored
+    if args.resume and args.no_backup:
+        p.error('--resume can\'t be used with --no-backup.')
+
+    if args.manifest and (args.stdout or args.dedupe_content):
+        p.error('--manifest can\'t be used with --stdout or --dedupe-content.')
+
+    if args.dedupe_content and (args.stdout or args.report or args.max_total_replacements is not None):
+        p.error('--dedupe-content can\'t be used with --stdout, --report or --max-total-replacements.')
+
+    if args.replace_func and args.eval:
+        p.error('--replace-func and --eval-replace can\'t be used together.')
+
+    if args.replace_func and args.replace is None and args.pattern is not None:
+        args.replace = ''
+
+    args.regions = None
+    if args.between or args.lines:
+        if IS_PY2:
+            p.error('--between and --lines require Python 3.')
+        if args.between and args.lines:
+            p.error('--between and --lines can\'t be used together.')
+        if args.engine not in ('auto', 'linear'):
+            p.error('--between and --lines can be used only with engines: auto, linear.')
+        try:
+            if args.between:
+                start, end = (re.compile(u(marker, INPUT_ENCODING), re.UNICODE) for marker in args.between)
+                args.regions = _LineRegions(start=start, end=end)
+            else:
+                args.regions = _LineRegions(first=args.lines[0], last=args.lines[1])
+        except re.error as ex:
+            p.error('--between: %s' % ex)
+
+    if args.rules:
+        if args.pattern is not None or args.replace is not None or args.pattern_and_replace is not None:
+            p.error('--rules can\'t be used with --pattern, --replace or --pattern-and-replace.')
+        # pylint: disable=too-many-boolean-expressions
+        if args.stdin or args.eval or args.replace_func or args.report or args.in_place_patch or \
+                args.exit_on_first_match or args.max_total_replacements is not None:
+            p.error('--rules requires files, and can\'t be used with --eval-replace, --replace-func, --report, '
+                    '--in-place-patch, --exit-on-first-match or --max-total-replacements.')
+        if args.engine not in ('auto', 'global', 'linear'):
+            p.error('--rules can be used only with engines: auto, global, linear.')
+
+        try:
+            args.ext = _parse_args__get_backup_file_ext(args)
+            args.rules = _parse_args__rules(args.rules, args)
+        except ParserException as ex:
+            p.error(ex)
+
+        args.pattern = args.replace = None
+        args.count = 0
+        args.linear = args.linear or args.engine == 'linear'
+        return args
+
     # pylint: disable=too-many-boolean-expressions
     if \
             (args.pattern is None and args.replace is None and args.pattern_and_replace is None) or \
@@ -476,177 +1223,3115 @@ def parse_args(args):
         args.pattern, args.replace, args.count = _parse_args__pattern(args)
         if args.eval:
             args.replace = _parse_args__eval_replacement(args.replace)
+        elif args.replace_func:
+            args.replace = _parse_args__replace_func(args.replace_func)
+        if args.preserve_case:
+            args.replace = _PreserveCase(args.pattern, args.replace)
+        if args.memoize:
+            args.replace = _MemoizedReplacement(args.replace, args.memoize)
     except ParserException as ex:
         p.error(ex)
 
+    if args.engine == 'linear':
+        args.linear = True
+    elif args.linear and args.engine not in ('auto', 'literal'):
+        p.error('--engine %s can\'t be used with --linear.' % args.engine)
+
+    if args.engine == 'windowed' and not _pattern_is_line_local(args.pattern):
+        p.error('--engine windowed requires pattern which can\'t match across lines.')
+    elif args.engine == 'literal' and not _replace_literal__applicable(args.pattern, args.replace, args.linear):
+        p.error('--engine literal requires constant pattern and replacement.')
+    elif args.engine == 'mmap' and (callable(args.replace) or _pattern_bytes(args.pattern) is None):
+        p.error('--engine mmap requires pattern using only ASCII characters without classes, and constant '
+                'replacement.')
+
     return args
 
 
-def replace_linear(src, dst, pattern, replace, count):
-    """ Read data from 'src' line by line, replace some data from
-        regular expression in 'pattern' with data in 'replace',
-        write it to 'dst', and return quantity of replaces.
+_NEWLINE = ord('\n')
+_CATEGORIES_WITHOUT_NEWLINE = (
+    sre_constants.CATEGORY_DIGIT, sre_constants.CATEGORY_NOT_SPACE,
+    sre_constants.CATEGORY_WORD, sre_constants.CATEGORY_NOT_LINEBREAK,
+)
+_LINE_LOCAL_PATTERNS = {}
+
+
+def _pattern_is_line_local__set(items):
+    """ Check if set of characters (argument of IN opcode) can match new line character.
     """
-    ret = 0
-    for line in src:
-        if count == 0 or ret < count:
-            if IS_PY2 and not isinstance(line, unicode):
-                line = u(line, FILE_ENCODING)
-            line, rest_count = pattern.subn(replace, line, max(0, count - ret))
-            ret += rest_count
+    negate = found = False
+    for opcode, arg in items:
+        if opcode == sre_constants.NEGATE:
+            negate = True
+        elif opcode == sre_constants.LITERAL:
+            found = found or arg == _NEWLINE
+        elif opcode == sre_constants.RANGE:
+            found = found or arg[0] <= _NEWLINE <= arg[1]
+        elif opcode == sre_constants.CATEGORY:
+            found = found or arg not in _CATEGORIES_WITHOUT_NEWLINE
+        else:
+            return True
+    return found != negate
 
-        if IS_PY2 and isinstance(line, unicode):
-            line = line.encode(FILE_ENCODING)
-        dst.write(line)
-    return ret
 
+# pylint: disable=too-many-return-statements,too-many-branches
+def _pattern_is_line_local__items(items, dot_all):
+    """ Check if parsed regular expression can't match new line character, and doesn't use
+        anchors or lookarounds, which would behave differently when lines are processed together.
+    """
+    for opcode, arg in items:
+        if opcode == sre_constants.LITERAL:
+            if arg == _NEWLINE:
+                return False
+        elif opcode == sre_constants.NOT_LITERAL:
+            if arg != _NEWLINE:
+                return False
+        elif opcode == sre_constants.ANY:
+            if dot_all:
+                return False
+        elif opcode == sre_constants.IN:
+            if _pattern_is_line_local__set(arg):
+                return False
+        elif opcode == sre_constants.AT:
+            if arg not in (sre_constants.AT_BOUNDARY, sre_constants.AT_NON_BOUNDARY):
+                return False
+        elif opcode in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) or \
+                opcode == getattr(sre_constants, 'POSSESSIVE_REPEAT', None):
+            if not _pattern_is_line_local__items(arg[2], dot_all):
+                return False
+        elif opcode == sre_constants.SUBPATTERN:
+            sub_dot_all = dot_all
+            if len(arg) == 4:
+                sub_dot_all = (dot_all or arg[1] & re.DOTALL) and not arg[2] & re.DOTALL
+            if not _pattern_is_line_local__items(arg[-1], sub_dot_all):
+                return False
+        elif opcode == sre_constants.BRANCH:
+            if not all(_pattern_is_line_local__items(branch, dot_all) for branch in arg[1]):
+                return False
+        elif opcode == getattr(sre_constants, 'ATOMIC_GROUP', None):
+            if not _pattern_is_line_local__items(arg, dot_all):
+                return False
+        elif opcode == sre_constants.GROUPREF_EXISTS:
+            if not all(_pattern_is_line_local__items(branch, dot_all) for branch in arg[1:] if branch):
+                return False
+        elif opcode != sre_constants.GROUPREF:
+            return False
+    return True
+
+
+def _pattern_is_line_local(pattern):
+    """ Check if every match of compiled `pattern` is contained in single line, and matches are
+        exactly the same, no matter if pattern is applied to every line separately or to many
+        lines at once: pattern can't match new line character or empty string, and doesn't
+        use anchors (except of word boundaries) nor lookarounds.
+    """
+    key = (pattern.pattern, pattern.flags)
+    if key not in _LINE_LOCAL_PATTERNS:
+        try:
+            parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+            _LINE_LOCAL_PATTERNS[key] = parsed.getwidth()[0] > 0 and \
+                _pattern_is_line_local__items(parsed, bool(pattern.flags & re.DOTALL))
+        # pylint: disable=broad-except
+        except Exception:
+            _LINE_LOCAL_PATTERNS[key] = False
+    return _LINE_LOCAL_PATTERNS[key]
 
-def replace_global(src, dst, pattern, replace, count):
-    """ Read whole file from 'src', replace some data from
-        regular expression in 'pattern' with data in 'replace',
-        write it to 'dst', and return quantity of replaces.
+
+_LITERAL_PATTERNS = {}
+
+
+def _pattern_literal(pattern):
+    """ Return text matched by compiled `pattern`, if it matches only single, constant and
+        non empty text. In other case return None.
     """
-    data = src.read()
-    if IS_PY2 and not isinstance(data, unicode):
-        data = u(data, FILE_ENCODING)
+    key = (pattern.pattern, pattern.flags)
+    if key not in _LITERAL_PATTERNS:
+        literal = None
+        try:
+            parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+            if not pattern.flags & re.IGNORECASE and len(parsed) and \
+                    all(opcode == sre_constants.LITERAL for opcode, _ in parsed):
+                literal = ''.join(unichr(arg) for _, arg in parsed)
+        # pylint: disable=broad-except
+        except Exception:
+            pass
+        _LITERAL_PATTERNS[key] = literal
+    return _LITERAL_PATTERNS[key]
+
+
+_BYTES_PATTERNS = {}
+_BYTES_SAFE_ANCHORS = (
+    sre_constants.AT_BEGINNING, sre_constants.AT_BEGINNING_STRING,
+    sre_constants.AT_END, sre_constants.AT_END_STRING,
+)
+
+
+# pylint: disable=too-many-return-statements
+def _pattern_bytes__items(items):
+    """ Check if parsed regular expression matches the same, when applied to encoded text
+        (in ASCII compatible encoding): it can use only ASCII characters, without character
+        classes, negations, dot and word boundaries.
+    """
+    for opcode, arg in items:
+        if opcode == sre_constants.LITERAL:
+            if arg > 127:
+                return False
+        elif opcode == sre_constants.IN:
+            for set_opcode, set_arg in arg:
+                if set_opcode == sre_constants.LITERAL and set_arg <= 127:
+                    continue
+                if set_opcode == sre_constants.RANGE and set_arg[1] <= 127:
+                    continue
+                return False
+        elif opcode == sre_constants.AT:
+            if arg not in _BYTES_SAFE_ANCHORS:
+                return False
+        elif opcode in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) or \
+                opcode == getattr(sre_constants, 'POSSESSIVE_REPEAT', None):
+            if not _pattern_bytes__items(arg[2]):
+                return False
+        elif opcode == sre_constants.SUBPATTERN:
+            if len(arg) == 4 and arg[1] & re.IGNORECASE or not _pattern_bytes__items(arg[-1]):
+                return False
+        elif opcode == sre_constants.BRANCH:
+            if not all(_pattern_bytes__items(branch) for branch in arg[1]):
+                return False
+        elif opcode == getattr(sre_constants, 'ATOMIC_GROUP', None):
+            if not _pattern_bytes__items(arg):
+                return False
+        elif opcode == sre_constants.GROUPREF_EXISTS:
+            if not all(_pattern_bytes__items(branch) for branch in arg[1:] if branch):
+                return False
+        elif opcode != sre_constants.GROUPREF:
+            return False
+    return True
+
+
+def _pattern_bytes(pattern):
+    """ Return version of compiled `pattern` working on bytes, if it finds exactly the same
+        matches in text encoded with ASCII compatible encoding. In other case return None.
+    """
+    key = (pattern.pattern, pattern.flags)
+    if key not in _BYTES_PATTERNS:
+        bytes_pattern = None
+        try:
+            if not pattern.flags & re.IGNORECASE and \
+                    _pattern_bytes__items(sre_parse.parse(pattern.pattern, pattern.flags)):
+                bytes_pattern = re.compile(pattern.pattern.encode('ascii'), pattern.flags & ~re.UNICODE)
+        # pylint: disable=broad-except
+        except Exception:
+            pass
+        _BYTES_PATTERNS[key] = bytes_pattern
+    return _BYTES_PATTERNS[key]
 
-    data, ret = pattern.subn(replace, data, count)
 
-    if IS_PY2 and isinstance(data, unicode):
-        data = data.encode(FILE_ENCODING)
+_TRIGRAM_PATTERNS = {}
+# with IGNORECASE (and not ASCII), these letters match also non ASCII characters (like KELVIN SIGN)
+_TRIGRAM_UNSAFE_IGNORECASE = 'iks'
 
-    dst.write(data)
-    return ret
+
+def _pattern_trigrams__items(items, ignorecase, required):
+    """ Append to `required` texts (made of ASCII characters) which must be found in every text
+        matched by parsed regular expression.
+    """
+    run = []
+    for opcode, arg in items:
+        if opcode == sre_constants.LITERAL and arg <= 127 and \
+                not (ignorecase and unichr(arg).lower() in _TRIGRAM_UNSAFE_IGNORECASE):
+            run.append(unichr(arg))
+            continue
+
+        required.append(''.join(run))
+        run = []
+        if opcode == sre_constants.SUBPATTERN:
+            sub_ignorecase = ignorecase
+            if len(arg) == 4:
+                sub_ignorecase = (ignorecase or bool(arg[1] & re.IGNORECASE)) and not arg[2] & re.IGNORECASE
+            _pattern_trigrams__items(arg[-1], sub_ignorecase, required)
+        elif opcode in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) or \
+                opcode == getattr(sre_constants, 'POSSESSIVE_REPEAT', None):
+            if arg[0] >= 1:
+                _pattern_trigrams__items(arg[2], ignorecase, required)
+        elif opcode == getattr(sre_constants, 'ATOMIC_GROUP', None):
+            _pattern_trigrams__items(arg, ignorecase, required)
+        elif opcode == sre_constants.ASSERT:
+            _pattern_trigrams__items(arg[1], ignorecase, required)
+    required.append(''.join(run))
+
+
+def _pattern_trigrams(pattern):
+    """ Return set of trigrams (lowercase ASCII bytes) which must be found in data encoded with
+        ASCII compatible encoding, if compiled `pattern` matches anything in it.
+    """
+    key = (pattern.pattern, pattern.flags)
+    if key not in _TRIGRAM_PATTERNS:
+        trigrams = set()
+        try:
+            ignorecase = bool(pattern.flags & re.IGNORECASE) and not pattern.flags & getattr(re, 'ASCII', 0)
+            required = []
+            _pattern_trigrams__items(sre_parse.parse(pattern.pattern, pattern.flags), ignorecase, required)
+            for text in required:
+                data = text.lower().encode('ascii')
+                trigrams.update(data[i:i + 3] for i in range(len(data) - 2))
+        # pylint: disable=broad-except
+        except Exception:
+            trigrams = set()
+        _TRIGRAM_PATTERNS[key] = frozenset(trigrams)
+    return _TRIGRAM_PATTERNS[key]
+
+
+def _read_blocks(src):
+    """ Read text from `src` in blocks of about BLOCK_SIZE, every block ending with new line
+        character (or at the end of data).
+    """
+    while True:
+        block = src.read(BLOCK_SIZE)
+        if not block:
+            return
+        while not block.endswith('\n'):
+            line = src.readline()
+            if not line:
+                break
+            block += line
+        yield block
+
+
+def _copy_range(src_fd, dst_fd, offset, size=None):
+    """ Copy `size` bytes (or everything to the end) of data from `src_fd` starting at `offset`,
+        to `dst_fd` at its current position, inside of kernel (with copy_file_range or sendfile).
+
+        Returns False if none of them is available.
+    """
+    start_offset = offset
+    try:
+        start_dst_offset = dst_offset = os.lseek(dst_fd, 0, os.SEEK_CUR)
+    except OSError:
+        # not seekable (like pipe): only sendfile, which can't fail after writing part of data
+        start_dst_offset = dst_offset = None
+
+    for func in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, func) or (start_dst_offset is None and func != 'sendfile'):
+            continue
+        offset, dst_offset = start_offset, start_dst_offset
+        try:
+            while size is None or offset < start_offset + size:
+                chunk = BLOCK_SIZE * 64
+                if size is not None:
+                    chunk = min(chunk, start_offset + size - offset)
+                if func == 'copy_file_range':
+                    copied = os.copy_file_range(src_fd, dst_fd, chunk, offset, dst_offset)
+                else:
+                    if dst_offset is not None:
+                        os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+                    copied = os.sendfile(dst_fd, src_fd, offset, chunk)
+                if not copied:
+                    break
+                offset += copied
+                if dst_offset is not None:
+                    dst_offset += copied
+        except OSError:
+            if start_dst_offset is None and offset != start_offset:
+                raise
+            continue
+        if dst_offset is not None:
+            os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+        return True
+    return False
+
+
+def _copy_file_range(src_path, dst_fh, offset=0, size=None):
+    """ Copy `size` bytes (or everything to the end) of file at `src_path` starting at `offset`
+        to binary file `dst_fh`.
+    """
+    dst_fh.flush()
+    with io.open(src_path, 'rb') as src_fh:
+        if _copy_range(src_fh.fileno(), dst_fh.fileno(), offset, size):
+            return
+        src_fh.seek(offset)
+        while size is None or size > 0:
+            data = src_fh.read(BLOCK_SIZE if size is None else min(BLOCK_SIZE, size))
+            if not data:
+                break
+            dst_fh.write(data)
+            if size is not None:
+                size -= len(data)
+        dst_fh.flush()
+
+
+def _stream_encoding(stream):
+    """ Return normalized name of encoding of codecs `stream`, or None if it's not a codecs stream.
+    """
+    # codecs stream classes are defined in modules named after encoding, like encodings.utf_8
+    module = type(stream).__module__
+    if not module.startswith('encodings.'):
+        return None
+    try:
+        return codecs.lookup(module.rsplit('.', 1)[-1]).name
+    except LookupError:
+        return None
 
 
-def _process_file__make_backup(path, backup_ext):
-    """ Create backup of file: copy it with new extension.
+def _copy_rest(src, dst):
+    """ Copy rest of data from `src` to `dst` without changes.
 
-        Returns path to backup file.
+        If both are codecs streams over regular files in the same encoding, data which wasn't
+        yet read from source file is copied inside of kernel, without decoding and encoding it
+        again.
     """
+    if isinstance(dst, _NullWriter):
+        return
 
-    root = os.path.dirname(path)
-    backup_path = os.path.join(root, path + backup_ext)
+    src_fh, dst_fh = getattr(src, 'stream', None), getattr(dst, 'stream', None)
+    if not IS_PY2 and src_fh is not None and dst_fh is not None and hasattr(src, 'charbuffer') and \
+            _stream_encoding(src) is not None and _stream_encoding(src) == _stream_encoding(dst):
+        try:
+            src_fd, dst_fd = src_fh.fileno(), dst_fh.fileno()
+            src_offset = src_fh.tell()
+        except (AttributeError, IOError, OSError, ValueError):
+            src_fd = None
+
+        if src_fd is not None:
+            # decoded or read, but not yet consumed data
+            if src.linebuffer:
+                dst.write(''.join(src.linebuffer))
+            else:
+                dst.write(src.charbuffer)
+            dst_fh.write(src.bytebuffer)
+            dst_fh.flush()
 
-    if os.path.exists(backup_path):
-        raise SubstException('Backup path: "%s" for file "%s" already exists, file skipped' % (backup_path, path))
+            if _copy_range(src_fd, dst_fd, src_offset):
+                return
 
-    try:
-        shutil.copy2(path, backup_path)
-    except (shutil.Error, IOError) as ex:
-        raise SubstException('Cannot create backup for "%s": %s' % (path, ex))
+            dst_fh.write(src_fh.read())
+            return
 
-    return backup_path
+    while True:
+        data = src.read(BLOCK_SIZE)
+        if not data:
+            return
+        dst.write(data)
 
 
-def _process_file__handle(src_path, dst_fh, cfg, replace_func):
-    """ Read data from `src_path`, replace data with `replace_func` and
-        save it to `dst_fh`.
+class _RecordWriter(object):
+    """ Write records as JSON Lines to file at `path`.
+
+        Records are written in batches, every batch with single write to descriptor opened
+        in append mode, so batches from many processes are never interleaved.
     """
 
-    with codecs.open(src_path, 'r', encoding=FILE_ENCODING) as fh_src:
-        cnt = replace_func(fh_src, dst_fh, cfg.pattern, cfg.replace, cfg.count)
-        if cfg.verbose or cfg.debug:
-            debug('%s %s' % (cnt, _plural_s(cnt, 'replacement')), indent=1)
+    def __init__(self, path, append=False):
+        self.path = path
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | (0 if append else os.O_TRUNC), 0o644)
 
-    return cnt
+    def write(self, records):
+        """ Write list of `records` (dicts).
+        """
+        if records:
+            data = ''.join(json.dumps(record, sort_keys=True) + '\n' for record in records)
+            os.write(self._fd, data.encode('utf-8'))
+
+    def close(self):
+        """ Close underlying file.
+        """
+        os.close(self._fd)
 
 
-def _process_file__regular(src_path, cfg, replace_func):
-    """ Read data from `src_path`, replace data with `replace_func` and
-        save it.
+class _Checkpoint(object):
+    """ Append-only list of finished files, stored in file at `path` as JSON Lines (absolute
+        path in every line), and of backup files made (objects with absolute path in `backup`).
 
-        It's safe operation - first save data to temporary file, and then try to rename
-        new file to old one.
+        Paths are written in batches (after CHECKPOINT_BATCH_SIZE paths or CHECKPOINT_INTERVAL
+        seconds), every batch with single write and fsync. With `resume`, paths already stored
+        are loaded (see: `done` and `backed_up`) and new ones are appended, in other case file
+        is truncated.
     """
 
-    tmp_fh, tmp_path = tempfile.mkstemp()
-    tmp_fh = os.fdopen(tmp_fh, 'w')
+    def __init__(self, path, resume=False):
+        self.path = path
+        self._done = set()
+        self._backups = set()
+        complete = True
+        if resume:
+            complete = self._load()
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | (0 if resume else os.O_TRUNC), 0o644)
+        if not complete:
+            os.write(self._fd, b'\n')
+        self._pending = []
+        self._flushed = time.time()
+
+    def _load(self):
+        """ Read paths stored by previous run (last line can be incomplete, if it was killed).
+
+            Returns False if last line is incomplete.
+        """
+        line = '\n'
+        try:
+            with io.open(self.path, 'r', encoding='utf-8', errors='replace') as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(record, dict):
+                        self._backups.add(record.get('backup'))
+                    else:
+                        self._done.add(record)
+        except (IOError, OSError) as ex:
+            if ex.errno != errno.ENOENT:
+                raise SubstException('Cannot read checkpoint file "%s": %s' % (self.path, ex))
+        return line.endswith('\n')
+
+    def done(self, path):
+        """ Check if file at `path` was finished by previous run.
+        """
+        return os.path.abspath(path) in self._done
 
-    cnt = _process_file__handle(src_path, tmp_fh, cfg, replace_func)
+    def backed_up(self, backup_path):
+        """ Check if backup file at `backup_path` was made by previous run.
+        """
+        return os.path.abspath(backup_path) in self._backups
 
-    try:
-        tmp_fh.close()
-    # pylint: disable=bare-except
-    except:
-        pass
+    def add_backup(self, backup_path):
+        """ Store backup file at `backup_path`, immediately (before file is written): interrupted
+            run can leave file written, but not stored as finished.
+        """
+        data = json.dumps({'backup': os.path.abspath(backup_path)}) + '\n'
+        os.write(self._fd, data.encode('utf-8'))
 
-    try:
-        shutil.move(tmp_path, src_path)
-    except OSError as ex:
-        raise SubstException('Error replacing "%s" with "%s": %s' % (src_path, tmp_path, ex))
-    else:
-        if cfg.debug:
-            debug('moved temporary file to original', indent=1)
+    def add(self, path):
+        """ Mark file at `path` as finished.
+        """
+        self._pending.append(os.path.abspath(path))
+        if len(self._pending) >= CHECKPOINT_BATCH_SIZE or time.time() - self._flushed >= CHECKPOINT_INTERVAL:
+            self.flush()
 
-    return cnt
+    def flush(self):
+        """ Write and fsync pending paths.
+        """
+        if self._pending:
+            data = ''.join(json.dumps(path) + '\n' for path in self._pending)
+            os.write(self._fd, data.encode('utf-8'))
+            os.fsync(self._fd)
+            self._pending = []
+        self._flushed = time.time()
+
+    def close(self):
+        """ Write pending paths and close underlying file.
+        """
+        self.flush()
+        os.close(self._fd)
 
 
-def process_file(path, replace_func, cfg):
-    """ Process single file: open, read, make backup and replace data.
+class _ContentHash(object):
+    """ SHA-256 hash and size of data passing through a stream.
     """
 
-    if cfg.verbose or cfg.debug:
-        debug(path)
+    def __init__(self, data=b''):
+        self.reset(data)
 
-    if not os.path.exists(path):
-        raise SubstException('Path "%s" doesn\'t exists' % path)
-
-    if not os.path.isfile(path) or os.path.islink(path):
-        raise SubstException('Path "%s" is not a regular file' % path)
+    def reset(self, data=b''):
+        """ Start again, with `data` already seen.
+        """
+        import hashlib
 
-    if not cfg.no_backup:
-        backup_path = _process_file__make_backup(path, cfg.ext)
+        self.hash = hashlib.sha256(data)
+        self.size = len(data)
 
-        if cfg.debug:
-            debug('created backup file: "%s"' % backup_path, indent=1)
+    def update(self, data):
+        """ Add `data` to hash.
+        """
+        self.hash.update(data)
+        self.size += len(data)
 
-    cnt = 0
-    try:
-        if cfg.stdout:
-            cnt = _process_file__handle(path, sys.stdout, cfg, replace_func)
-        else:
-            cnt = _process_file__regular(path, cfg, replace_func)
-    except SubstException as ex:
-        err(u(ex))
+    def hexdigest(self):
+        """ Return hash as hexadecimal string.
+        """
+        return self.hash.hexdigest()
 
-    return cnt
 
+class _HashingStream(object):
+    """ Wrapper for binary file `fh`, which adds data read or written to `content_hash`.
 
-def main(args):
-    """ Run tool: parse input arguments, read data, replace and save or display.
+        It doesn't provide `fileno`, so data is never copied inside of kernel, around the hash.
     """
 
-    try:
-        args = parse_args(args)
-    except (UnicodeDecodeError, UnicodeEncodeError):
-        err("Cannot determine encoding of input arguments, please use --encoding-input option", exit_code=1)
+    def __init__(self, fh, content_hash):
+        self._fh = fh
+        self._hash = content_hash
 
-    if args.linear:
-        replace_func = replace_linear
-    else:
-        replace_func = replace_global
+    def read(self, size=-1):
+        """ Read and hash data.
+        """
+        data = self._fh.read(size)
+        self._hash.update(data)
+        return data
 
-    if args.stdin:
-        cnt_changes = replace_func(sys.stdin, sys.stdout, args.pattern, args.replace, args.count)
-        cnt_changed_files = 0
+    def write(self, data):
+        """ Hash and write data.
+        """
+        self._hash.update(data)
+        return self._fh.write(data)
 
-    else:
-        cnt_changes = cnt_changed_files = 0
-        for path in args.files:
+    def seek(self, *args):
+        """ Change stream position (hash has to be reset by caller).
+        """
+        return self._fh.seek(*args)
+
+    def tell(self):
+        """ Return stream position.
+        """
+        return self._fh.tell()
+
+    def truncate(self, *args):
+        """ Truncate file.
+        """
+        return self._fh.truncate(*args)
+
+    def flush(self):
+        """ Flush file.
+        """
+        self._fh.flush()
+
+    def close(self):
+        """ Close file.
+        """
+        self._fh.close()
+
+
+class FileEntry(object):
+    """ Metadata of file to process, taken from single `lstat` call and carried through
+        filtering, scheduling and processing, so every file is stat'ed at most once.
+
+        If file doesn't exist, `mode` is None.
+    """
+
+    __slots__ = ('path', 'size', 'mode', 'mtime', 'ino', 'dev')
+
+    def __init__(self, path, stat_result=None):
+        self.path = path
+        if stat_result is None:
+            try:
+                stat_result = os.lstat(path)
+            except OSError:
+                stat_result = None
+
+        if stat_result is None:
+            self.size = self.mode = self.mtime = self.ino = self.dev = None
+        else:
+            self.size = stat_result.st_size
+            self.mode = stat_result.st_mode
+            self.mtime = getattr(stat_result, 'st_mtime_ns', stat_result.st_mtime)
+            self.ino = stat_result.st_ino
+            self.dev = stat_result.st_dev
+
+    def exists(self):
+        """ Check if file existed when entry was created.
+        """
+        return self.mode is not None
+
+    def is_regular(self):
+        """ Check if entry is regular file (not symbolic link).
+        """
+        return self.mode is not None and stat.S_ISREG(self.mode)
+
+    def __repr__(self):
+        return 'FileEntry(%r, size=%r)' % (self.path, self.size)
+
+
+class _TrigramIndex(object):
+    """ Index of trigrams (lowercase bytes) found in files, stored in SQLite database at `path`.
+
+        Files are indexed only if they aren't too big and don't start with BOM of encoding, which
+        isn't ASCII compatible - other files are always candidates for processing.
+    """
+
+    def __init__(self, path):
+        import sqlite3
+
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime INTEGER, indexed INTEGER);
+            CREATE TABLE IF NOT EXISTS postings (
+                trigram BLOB, file_id INTEGER, PRIMARY KEY (trigram, file_id)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_file_id ON postings (file_id);
+        """)
+
+    @staticmethod
+    def _trigrams(entry):
+        """ Return set of trigrams in file described by `entry`, or None if it can't be indexed.
+        """
+        if entry.size > INDEX_MAX_FILE_SIZE:
+            return None
+        with io.open(entry.path, 'rb') as fh:
+            data = fh.read()
+        for bom, encoding in BOMS:
+            if data.startswith(bom) and not _is_ascii_compatible(encoding):
+                return None
+        data = data.lower()
+        return set(data[i:i + 3] for i in range(len(data) - 2))
+
+    def update(self, root):
+        """ Index files in directory `root` (skipping directories of version control systems):
+            only new files and files with changed size or modification time are read. Files which
+            don't exist any more are removed from index.
+
+            Returns tuple: (quantity of indexed files, quantity of removed files).
+        """
+        import sqlite3
+
+        prefix = root.rstrip(os.sep) + os.sep
+        known = {}
+        for file_id, path, size, mtime in self._db.execute('SELECT id, path, size, mtime FROM files'):
+            if path.startswith(prefix):
+                known[path] = (file_id, size, mtime)
+
+        cnt_indexed = 0
+        seen = set()
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [name for name in dirnames if name not in INDEX_SKIP_DIRECTORIES]
+            for name in filenames:
+                entry = FileEntry(os.path.normcase(os.path.join(dirpath, name)))
+                if not entry.is_regular() or entry.path == self.path:
+                    continue
+                seen.add(entry.path)
+                row = known.get(entry.path)
+                if row and row[1:] == (entry.size, entry.mtime):
+                    continue
+
+                try:
+                    trigrams = self._trigrams(entry)
+                except (IOError, OSError):
+                    continue
+
+                if row:
+                    file_id = row[0]
+                    self._db.execute('DELETE FROM postings WHERE file_id = ?', (file_id, ))
+                    self._db.execute('UPDATE files SET size = ?, mtime = ?, indexed = ? WHERE id = ?',
+                                     (entry.size, entry.mtime, trigrams is not None, file_id))
+                else:
+                    file_id = self._db.execute('INSERT INTO files (path, size, mtime, indexed) VALUES (?, ?, ?, ?)',
+                                               (entry.path, entry.size, entry.mtime, trigrams is not None)).lastrowid
+                if trigrams:
+                    self._db.executemany('INSERT INTO postings (trigram, file_id) VALUES (?, ?)',
+                                         ((sqlite3.Binary(trigram), file_id) for trigram in trigrams))
+                cnt_indexed += 1
+
+        removed = [row[0] for path, row in known.items() if path not in seen]
+        for file_id in removed:
+            self._db.execute('DELETE FROM postings WHERE file_id = ?', (file_id, ))
+            self._db.execute('DELETE FROM files WHERE id = ?', (file_id, ))
+
+        self._db.commit()
+        return cnt_indexed, len(removed)
+
+    def candidates(self, entries, trigrams):
+        """ Return entries of files which can contain all `trigrams`: indexed files containing them,
+            files which couldn't be indexed, and files not in index or changed since indexing.
+            If `entries` is None, candidates are chosen from all indexed files.
+        """
+        import sqlite3
+
+        trigrams = sorted(trigrams)[:INDEX_MAX_QUERY_TRIGRAMS]
+        matching = None
+        if trigrams:
+            matching = set(file_id for file_id, in self._db.execute(
+                'SELECT file_id FROM postings WHERE trigram IN (%s) GROUP BY file_id HAVING COUNT(*) = ?' % (
+                    ', '.join('?' * len(trigrams))),
+                [sqlite3.Binary(trigram) for trigram in trigrams] + [len(trigrams)]))
+
+        rows = self._db.execute('SELECT path, id, size, mtime, indexed FROM files')
+        if entries is None:
+            result = []
+            for path, file_id, size, mtime, indexed in rows:
+                entry = FileEntry(path)
+                if entry.exists() and (matching is None or (size, mtime) != (entry.size, entry.mtime) or
+                                       not indexed or file_id in matching):
+                    result.append(entry)
+            return result
+
+        known = dict((row[0], row[1:]) for row in rows)
+        result = []
+        for entry in entries:
+            row = known.get(entry.path)
+            if matching is None or row is None or row[1:3] != (entry.size, entry.mtime) or \
+                    not row[3] or row[0] in matching:
+                result.append(entry)
+        return result
+
+    def close(self):
+        """ Close database.
+        """
+        self._db.close()
+
+
+class _EncodingCache(object):
+    """ Cache of detected encodings of files, stored as JSON in file at `path`.
+
+        Entry is valid as long as size and modification time of file are unchanged.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._modified = False
+        try:
+            with io.open(path, 'r', encoding='utf-8') as fh:
+                self._data = json.load(fh)
+        except (IOError, OSError, ValueError):
+            self._data = {}
+
+    @staticmethod
+    def _stamp(file_entry):
+        """ Values identifying version of file.
+        """
+        return [file_entry.size, file_entry.mtime]
+
+    def get(self, file_entry):
+        """ Return cached (encoding, bom) for file described by `file_entry` or None.
+        """
+        entry = self._data.get(file_entry.path)
+        if entry and entry[:2] == self._stamp(file_entry):
+            return entry[2], codecs.decode(entry[3], 'hex')
+        return None
+
+    def set(self, file_entry, encoding, bom):
+        """ Store (encoding, bom) for file described by `file_entry`.
+        """
+        self._data[file_entry.path] = self._stamp(file_entry) + [encoding, u(codecs.encode(bom, 'hex'))]
+        self._modified = True
+
+    def entry(self, path):
+        """ Return raw entry for file at `path` (or None), to move it between processes.
+        """
+        return self._data.get(path)
+
+    def update(self, path, entry):
+        """ Store raw `entry` for file at `path`.
+        """
+        self._data[path] = entry
+        self._modified = True
+
+    def save(self):
+        """ Write cache to disk, if changed.
+        """
+        if self._modified:
+            with io.open(self.path, 'w', encoding='utf-8') as fh:
+                fh.write(u(json.dumps(self._data)))
+
+
+class _MatchReport(object):
+    """ Proxy for compiled pattern, which records position of every replacement made by
+        `subn` in single file.
+
+        Engines passes file content to `subn` in order, so positions are computed incrementally
+        from already seen text, without another scan of file. Text consumed without calling `subn`
+        must be announced with `skip`.
+    """
+
+    def __init__(self, pattern, path, encoding, writer, offset=0):
+        self._pattern = pattern
+        self._path = path
+        self._encoding = encoding
+        self._ascii_compatible = _is_ascii_compatible(encoding)
+        self._writer = writer
+        self._records = []
+
+        self._offset = offset
+        self._line = 1
+        self._column = 0
+        self._string = None
+        self._cursor = 0
+
+    def __getattr__(self, name):
+        return getattr(self._pattern, name)
+
+    def _advance(self, position):
+        """ Move cursor in current string to `position`, updating offset, line and column.
+        """
+        text = self._string[self._cursor:position]
+        self._offset += _encoded_len(text, self._encoding, self._ascii_compatible)
+        newlines = text.count('\n')
+        if newlines:
+            self._line += newlines
+            self._column = len(text) - text.rfind('\n') - 1
+        else:
+            self._column += len(text)
+        self._cursor = position
+
+    def _wrap_replace(self, replace):
+        """ Wrap `replace` with function which records every replacement.
+        """
+        if callable(replace):
+            func = replace
+        else:
+            func = lambda match: match.expand(replace)
+
+        def _(match):
+            result = func(match)
+            self._advance(match.start())
+            self._record(match, result)
+            return result
+
+        return _
+
+    def _record(self, match, result):
+        """ Record replacement of `match` with `result`. Cursor is at the beginning of match.
+        """
+        self._records.append({
+            'path': self._path,
+            'offset': self._offset,
+            'line': self._line,
+            'column': self._column + 1,
+            'length': _encoded_len(match.group(0), self._encoding, self._ascii_compatible),
+            'replacement_length': _encoded_len(result, self._encoding, self._ascii_compatible),
+        })
+
+    def subn(self, replace, string, count=0):
+        """ Same as `subn` method of compiled pattern, but records replacements.
+        """
+        self._string, self._cursor = string, 0
+        result = self._pattern.subn(self._wrap_replace(replace), string, count)
+        self.skip()
+        return result
+
+    def skip(self, string=None):
+        """ Announce that `string` was consumed without replacements (or rest of current string
+            if `string` is None).
+        """
+        if string is not None:
+            self._string, self._cursor = string, 0
+        if self._string is not None:
+            self._advance(len(self._string))
+        self._string = None
+
+    def flush(self):
+        """ Write collected records.
+        """
+        self._writer.write(self._records)
+        self._records = []
+
+
+class _ReplacementBudget(object):
+    """ Limit of replacements shared by all processed files (and processes working on them).
+
+        Before processing a file, worker takes part of the budget it can use (`take`), and then
+        returns unused part (`settle`). Workers processing files in parallel take it in small parts
+        while they work instead (`take_chunk`, see: `_BudgetedReplacement`).
+    """
+
+    def __init__(self, limit):
+        import multiprocessing
+
+        self._lock = multiprocessing.Lock()
+        self._remaining = multiprocessing.RawValue('q', limit)
+        self._reserved = multiprocessing.RawValue('q', 0)
+
+    def take(self, count):
+        """ Reserve up to `count` replacements (0 means as much as possible) and return reserved
+            quantity. Returns 0 only if budget is exhausted. If whole budget is reserved by other
+            workers, waits until they settle.
+        """
+        while True:
+            with self._lock:
+                remaining = self._remaining.value
+                if remaining > 0:
+                    granted = remaining if count == 0 else min(count, remaining)
+                    self._remaining.value -= granted
+                    self._reserved.value += granted
+                    return granted
+                if self._reserved.value == 0:
+                    return 0
+            time.sleep(0.001)
+
+    def take_chunk(self, workers):
+        """ Reserve part of remaining replacements for one of `workers` sharing budget: the smaller
+            the rest of budget, the smaller the part (at most BUDGET_MAX_CHUNK). Returns 0 if nothing
+            remains, without waiting for other workers to settle.
+        """
+        with self._lock:
+            remaining = self._remaining.value
+            granted = max(0, min(remaining, BUDGET_MAX_CHUNK, max(1, remaining // (4 * workers))))
+            self._remaining.value -= granted
+            self._reserved.value += granted
+            return granted
+
+    def settle(self, granted, used):
+        """ Return to budget unused part of `granted` replacements.
+        """
+        with self._lock:
+            self._remaining.value += granted - used
+            self._reserved.value -= granted
+
+    def exhausted(self):
+        """ Check if there is no more replacements to make.
+        """
+        with self._lock:
+            return self._remaining.value <= 0 and self._reserved.value == 0
+
+
+class _BudgetedReplacement(object):
+    """ Replacement function (for `replace` template or function) taking every replacement from
+        shared `budget`, in chunks, so workers processing files in parallel share it while they
+        work. When nothing remains in budget, matched text is left unchanged.
+
+        `used` is quantity of replacements really made; `settle` must be called at the end.
+    """
+
+    def __init__(self, pattern, replace, budget, workers):
+        if callable(replace):
+            self._expand = replace
+        elif '\\' in replace:
+            self._expand = _replace_global__template(pattern, replace)
+        else:
+            self._expand = lambda match: replace
+        self._budget = budget
+        self._workers = workers
+        self._granted = self._available = self.used = 0
+
+    def __call__(self, match):
+        if not self._available:
+            self._available = self._budget.take_chunk(self._workers)
+            self._granted += self._available
+            if not self._available:
+                return match.group(0)
+        self._available -= 1
+        self.used += 1
+        return self._expand(match)
+
+    def settle(self):
+        """ Return unused replacements to budget.
+        """
+        self._budget.settle(self._granted, self.used)
+        self._granted = self._available = 0
+
+
+def _replace_linear__block(block, pattern, replace, count):
+    """ Replace data in `block` of lines, as if every line was processed separately.
+
+        Returns tuple: (new block, quantity of replaces).
+    """
+    if not RE_OTHER_LINEBREAKS.search(block):
+        return pattern.subn(replace, block, count)
+
+    ret = 0
+    lines = block.splitlines(True)
+    for idx, line in enumerate(lines):
+        if count and ret >= count:
+            break
+        lines[idx], cnt = pattern.subn(replace, line, max(0, count - ret))
+        ret += cnt
+    return ''.join(lines), ret
+
+
+class _LengthChanged(Exception):
+    """ Raised by _PatchCollector when replacement changes length of replaced data.
+    """
+
+
+class _PatchCollector(_MatchReport):
+    """ Proxy for compiled pattern, which collects replacements as (byte offset, encoded
+        replacement) pairs. Raises _LengthChanged as soon as replacement and replaced data
+        differ in length.
+    """
+
+    def __init__(self, pattern, encoding, offset=0):
+        super(_PatchCollector, self).__init__(pattern, None, encoding, None, offset)
+
+    def _record(self, match, result):
+        data = result.encode(self._encoding)
+        if len(data) != _encoded_len(match.group(0), self._encoding, self._ascii_compatible):
+            raise _LengthChanged()
+        if result != match.group(0):
+            self._records.append((self._offset, data))
+
+    def patches(self):
+        """ Return collected (offset, data) pairs.
+        """
+        return self._records
+
+
+class _NullWriter(object):
+    """ Writer which discards all data.
+    """
+
+    def write(self, data):
+        """ Discard `data`.
+        """
+
+
+class _LineRegions(object):
+    """ Chooses lines of file, where replacements are done: lines between lines matching
+        `start` and `end` (lines with markers are excluded, and region without end lasts to the
+        end of file), or lines with numbers from `first` to `last` (numbered from 1; None means
+        to the end of file).
+    """
+
+    def __init__(self, start=None, end=None, first=1, last=None):
+        self.start = start
+        self.end = end
+        self.first = first
+        self.last = last
+
+    def lines(self, src):
+        """ Read lines from `src`, yielding tuples: (is line in region, line). After the last
+            line in range (with `first` and `last`), rest of current block is yielded at once
+            and iteration stops - rest of `src` is not read.
+        """
+        active = False
+        lineno = 0
+        for block in _read_blocks(src):
+            lines = block.split('\n')
+            if lines[-1]:
+                lines[:-1] = [line + '\n' for line in lines[:-1]]
+            else:
+                lines = [line + '\n' for line in lines[:-1]]
+
+            for idx, line in enumerate(lines):
+                lineno += 1
+                if self.start is None:
+                    if self.last is not None and lineno > self.last:
+                        yield False, ''.join(lines[idx:])
+                        return
+                    yield lineno >= self.first, line
+                elif active:
+                    active = not self.end.search(line)
+                    yield active, line
+                else:
+                    active = bool(self.start.search(line))
+                    yield False, line
+
+
+def _replace_regions__replace(dst, pattern, replace, text, count, linear):
+    """ Replace data in `text` from region, and write it to `dst`.
+
+        Returns quantity of replaces.
+    """
+    if linear:
+        text, cnt = _replace_linear__block(text, pattern, replace, count)
+    else:
+        text, cnt = pattern.subn(replace, text, count)
+    dst.write(text)
+    return cnt
+
+
+def _replace_regions__copy(dst, pattern, text):
+    """ Write `text` from outside of regions to `dst` without changes.
+    """
+    dst.write(text)
+    if hasattr(pattern, 'skip'):
+        pattern.skip(text)
+
+
+# pylint: disable=too-many-arguments
+def replace_regions(src, dst, pattern, replace, count, regions, linear):
+    """ Read data from 'src' as a stream of lines, replace data from regular expression in
+        'pattern' with data in 'replace' only in lines chosen by 'regions' (see: _LineRegions),
+        write it to 'dst', and return quantity of replaces.
+
+        Lines in region are collected and processed together at the end of region (or in blocks
+        of about BLOCK_SIZE, if pattern can't cross lines). Other lines are copied in blocks.
+    """
+    if isinstance(pattern, _RuleChain):
+        line_local = linear or pattern.line_local
+    else:
+        line_local = linear or _pattern_is_line_local(pattern)
+
+    ret = 0
+    region, passive = [], []
+    region_size = passive_size = 0
+    for active, line in regions.lines(src):
+        if active and (not count or ret < count):
+            if passive:
+                _replace_regions__copy(dst, pattern, ''.join(passive))
+                passive, passive_size = [], 0
+            region.append(line)
+            region_size += len(line)
+            if line_local and region_size >= BLOCK_SIZE:
+                ret += _replace_regions__replace(dst, pattern, replace, ''.join(region), max(0, count - ret), linear)
+                region, region_size = [], 0
+            continue
+
+        if region:
+            ret += _replace_regions__replace(dst, pattern, replace, ''.join(region), max(0, count - ret), linear)
+            region, region_size = [], 0
+        passive.append(line)
+        passive_size += len(line)
+        if passive_size >= BLOCK_SIZE:
+            _replace_regions__copy(dst, pattern, ''.join(passive))
+            passive, passive_size = [], 0
+
+    if region:
+        ret += _replace_regions__replace(dst, pattern, replace, ''.join(region), max(0, count - ret), linear)
+    if passive:
+        _replace_regions__copy(dst, pattern, ''.join(passive))
+
+    _copy_rest(src, dst)
+    return ret
+
+
+def _replace_blocks(src, dst, pattern, replace, count, linear):
+    """ Process data from `src` in blocks of lines, when pattern can't cross lines. After `count`
+        replacements rest of data is copied without changes.
+    """
+    ret = 0
+    for block in _read_blocks(src):
+        if linear:
+            block, rest_count = _replace_linear__block(block, pattern, replace, max(0, count - ret))
+        else:
+            block, rest_count = pattern.subn(replace, block, max(0, count - ret))
+        ret += rest_count
+        dst.write(block)
+
+        if count and ret >= count:
+            _copy_rest(src, dst)
+            break
+    return ret
+
+
+def replace_linear(src, dst, pattern, replace, count):
+    """ Read data from 'src' line by line, replace some data from
+        regular expression in 'pattern' with data in 'replace',
+        write it to 'dst', and return quantity of replaces.
+
+        If pattern can't match across lines (see: `_pattern_is_line_local`), many lines are
+        processed at once, with the same result.
+    """
+    if isinstance(pattern, _RuleChain):
+        line_local = pattern.line_local
+    else:
+        line_local = _pattern_is_line_local(pattern)
+
+    if IS_PY2 or not line_local:
+        return _replace_linear__lines(src, dst, pattern, replace, count)
+
+    return _replace_blocks(src, dst, pattern, replace, count, True)
+
+
+def _replace_linear__lines(src, dst, pattern, replace, count):
+    """ Apply pattern for every line from `src` separately.
+    """
+    ret = 0
+    for line in src:
+        if count == 0 or ret < count:
+            if IS_PY2 and not isinstance(line, unicode):
+                line = u(line, FILE_ENCODING)
+            line, rest_count = pattern.subn(replace, line, max(0, count - ret))
+            ret += rest_count
+
+        if IS_PY2 and isinstance(line, unicode):
+            line = line.encode(FILE_ENCODING)
+        dst.write(line)
+
+        if not IS_PY2 and count and ret >= count:
+            _copy_rest(src, dst)
+            break
+    return ret
+
+
+_RE_PATTERN_TYPE = type(re.compile(''))
+
+
+def _replace_global__template(pattern, template):
+    """ Return function expanding replacement `template` for match of `pattern` (like
+        `match.expand`, but with template parsed only once).
+    """
+    try:
+        parsed = sre_parse.parse_template(template, pattern)
+    # pylint: disable=broad-except
+    except Exception:
+        return lambda match: match.expand(template)
+
+    if hasattr(sre_parse, 'expand_template'):
+        return lambda match: sre_parse.expand_template(parsed, match)
+
+    # since Python 3.12: list of literals, separated by numbers of groups
+    literals, groups = parsed[::2], parsed[1::2]
+    if not groups:
+        return lambda match: literals[0]
+
+    def _(match):
+        pieces = [literals[0]]
+        for group, literal in zip(groups, literals[1:]):
+            pieces.append(match.group(group) or '')
+            pieces.append(literal)
+        return ''.join(pieces)
+    return _
+
+
+def _replace_global__stream(data, dst, pattern, replace, count):
+    """ Replace matches of `pattern` in `data` with `replace`, writing result to `dst` in pieces
+        of about BLOCK_SIZE, instead of building whole new text (like `pattern.subn`).
+
+        Returns quantity of replaces.
+    """
+    if callable(replace):
+        expand = replace
+    elif '\\' in replace:
+        expand = _replace_global__template(pattern, replace)
+    else:
+        expand = lambda match: replace
+
+    pieces = []
+    pieces_size = position = cnt = 0
+    for match in pattern.finditer(data):
+        start, end = match.span()
+        if start - position >= BLOCK_SIZE:
+            dst.write(''.join(pieces))
+            pieces, pieces_size = [], 0
+            for offset in range(position, start, BLOCK_SIZE):
+                dst.write(data[offset:min(offset + BLOCK_SIZE, start)])
+        else:
+            pieces.append(data[position:start])
+        piece = expand(match)
+        pieces.append(piece)
+        pieces_size += start - position + len(piece)
+        position = end
+        cnt += 1
+
+        if pieces_size >= BLOCK_SIZE:
+            dst.write(''.join(pieces))
+            pieces, pieces_size = [], 0
+        if cnt == count:
+            break
+
+    dst.write(''.join(pieces))
+    for offset in range(position, len(data), BLOCK_SIZE):
+        dst.write(data[offset:offset + BLOCK_SIZE])
+    return cnt
+
+
+def replace_global(src, dst, pattern, replace, count):
+    """ Read whole file from 'src', replace some data from
+        regular expression in 'pattern' with data in 'replace',
+        write it to 'dst', and return quantity of replaces.
+
+        Big files are written in pieces, so only single copy of data is held in memory.
+    """
+    data = src.read()
+    if IS_PY2 and not isinstance(data, unicode):
+        data = u(data, FILE_ENCODING)
+
+    if not IS_PY2 and len(data) >= GLOBAL_STREAM_MIN_SIZE and isinstance(pattern, _RE_PATTERN_TYPE):
+        return _replace_global__stream(data, dst, pattern, replace, count)
+
+    data, ret = pattern.subn(replace, data, count)
+
+    if IS_PY2 and isinstance(data, unicode):
+        data = data.encode(FILE_ENCODING)
+
+    dst.write(data)
+    return ret
+
+
+def replace_windowed(src, dst, pattern, replace, count):
+    """ Read data from 'src' in blocks of lines, replace some data from
+        regular expression in 'pattern' with data in 'replace',
+        write it to 'dst', and return quantity of replaces.
+
+        Result is the same as from replace_global, if pattern can't cross lines
+        (see: `_pattern_is_line_local`).
+    """
+    return _replace_blocks(src, dst, pattern, replace, count, False)
+
+
+def _replace_literal__applicable(pattern, replace, linear):
+    """ Check if replace_literal can be used for `pattern` and `replace`.
+    """
+    literal = _pattern_literal(pattern)
+    return literal is not None and not isinstance(pattern, _MatchReport) and \
+        not callable(replace) and '\\' not in replace and \
+        not (linear and ('\n' in literal or RE_OTHER_LINEBREAKS.search(literal)))
+
+
+def replace_literal(src, dst, pattern, replace, count):
+    """ Read data from 'src', replace constant text matched by 'pattern'
+        with 'replace' (without regular expressions engine),
+        write it to 'dst', and return quantity of replaces.
+
+        Data is processed in blocks, if text doesn't contain new line character.
+    """
+    if not _replace_literal__applicable(pattern, replace, False):
+        return replace_global(src, dst, pattern, replace, count)
+
+    literal = _pattern_literal(pattern)
+    blocks = _read_blocks(src) if '\n' not in literal else [src.read()]
+
+    ret = 0
+    for block in blocks:
+        found = block.count(literal)
+        if count:
+            found = min(found, count - ret)
+        if found:
+            block = block.replace(literal, replace, found)
+            ret += found
+        dst.write(block)
+
+        if count and ret >= count:
+            _copy_rest(src, dst)
+            break
+    return ret
+
+
+def _replace_mmap__applicable(src, dst, pattern, replace):
+    """ Check if replace_mmap can be used: `pattern` has version working on bytes, `replace` is
+        a string, and both `src` and `dst` are codecs streams over files in the same ASCII
+        compatible encoding, and source file is read from the beginning (without BOM).
+    """
+    if isinstance(pattern, _MatchReport) or callable(replace) or _pattern_bytes(pattern) is None:
+        return False
+
+    src_fh, dst_fh = getattr(src, 'stream', None), getattr(dst, 'stream', None)
+    encoding = _stream_encoding(dst)
+    if encoding is None or encoding != _stream_encoding(src):
+        return False
+    try:
+        return _is_ascii_compatible(encoding) and src_fh.tell() == 0 and \
+            src_fh.fileno() >= 0 and dst_fh.fileno() >= 0
+    except (AttributeError, IOError, LookupError, OSError, ValueError):
+        return False
+
+
+def replace_mmap(src, dst, pattern, replace, count):
+    """ Memory map file from 'src', replace some data from
+        regular expression in 'pattern' with data in 'replace' (working on
+        encoded data), write it to 'dst', and return quantity of replaces.
+
+        File is never read into memory; unchanged data is copied inside of kernel
+        where possible.
+    """
+    if not _replace_mmap__applicable(src, dst, pattern, replace):
+        return replace_global(src, dst, pattern, replace, count)
+
+    bytes_pattern = _pattern_bytes(pattern)
+    bytes_replace = dst.encode(replace)[0]
+    is_template = b'\\' in bytes_replace
+    src_fd, dst_fh = src.stream.fileno(), dst.stream
+
+    size = os.fstat(src_fd).st_size
+    if not size:
+        return 0
+
+    def _copy(start, end):
+        """ Copy unchanged data between `start` and `end`.
+        """
+        if end - start >= BLOCK_SIZE:
+            dst_fh.flush()
+            if _copy_range(src_fd, dst_fh.fileno(), start, end - start):
+                return
+        dst_fh.write(data[start:end])
+
+    data = mmap.mmap(src_fd, 0, access=mmap.ACCESS_READ)
+    try:
+        ret = position = 0
+        matches = bytes_pattern.finditer(data)
+        for match in matches:
+            _copy(position, match.start())
+            dst_fh.write(match.expand(bytes_replace) if is_template else bytes_replace)
+            position = match.end()
+            ret += 1
+            if count and ret >= count:
+                break
+        matches = match = None
+        _copy(position, size)
+    finally:
+        data.close()
+
+    return ret
+
+
+ENGINES = collections.OrderedDict((
+    ('auto', None),
+    ('global', replace_global),
+    ('linear', replace_linear),
+    ('windowed', replace_windowed),
+    ('mmap', replace_mmap),
+    ('literal', replace_literal),
+))
+
+
+def _available_memory():
+    """ Return size of free memory, or None if it's unknown.
+    """
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _stream_size(src):
+    """ Return size of file behind stream `src`, or None if it's unknown.
+    """
+    try:
+        return os.fstat(getattr(src, 'stream', src).fileno()).st_size
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
+# pylint: disable=too-many-return-statements
+class _RuleChain(object):
+    """ Proxy for compiled pattern, which applies in order all `rules` (tuples: compiled pattern,
+        replacement, count) chosen for file. Replacement and count given to `subn` are ignored:
+        every rule has its own, with count of replacements kept for whole file.
+    """
+
+    def __init__(self, rules):
+        self._rules = rules
+        self._remaining = [count for _, _, count in rules]
+        self.line_local = all(_pattern_is_line_local(pattern) for pattern, _, _ in rules)
+
+    def subn(self, replace, string, count=0):
+        """ Apply rules to `string`.
+
+            Returns tuple: (new string, quantity of replaces).
+        """
+        ret = 0
+        for idx, (pattern, rule_replace, rule_count) in enumerate(self._rules):
+            if rule_count and not self._remaining[idx]:
+                continue
+            string, cnt = pattern.subn(rule_replace, string, self._remaining[idx])
+            if rule_count:
+                self._remaining[idx] -= cnt
+            ret += cnt
+        return string, ret
+
+
+def select_engine(src, dst, pattern, replace, linear):
+    """ Choose the fastest engine giving the same result as replace_linear (if `linear` is
+        True) or replace_global, for given streams, pattern and replacement:
+            * literal - if pattern matches only constant text
+            * windowed (or linear) - if pattern can't cross lines
+            * global - if file is small, or fits in available memory
+            * mmap - for big files, if pattern can be applied to encoded data
+    """
+    if IS_PY2:
+        return replace_linear if linear else replace_global
+
+    if isinstance(pattern, _RuleChain):
+        if linear:
+            return replace_linear
+        return replace_windowed if pattern.line_local else replace_global
+
+    if _replace_literal__applicable(pattern, replace, linear):
+        return replace_literal
+
+    if _pattern_is_line_local(pattern):
+        return replace_linear if linear else replace_windowed
+
+    if linear:
+        return replace_linear
+
+    size = _stream_size(src)
+    if size is None or size < BLOCK_SIZE:
+        return replace_global
+
+    available = _available_memory()
+    if available is not None and size * GLOBAL_MEMORY_FACTOR > available and \
+            _replace_mmap__applicable(src, dst, pattern, replace):
+        return replace_mmap
+
+    return replace_global
+
+
+def _engine_name(replace_func):
+    """ Return name of engine.
+    """
+    for name, func in ENGINES.items():
+        if func is replace_func:
+            return name
+    return getattr(replace_func, '__name__', repr(replace_func))
+
+
+def _process_file__engine(src, dst, pattern, cfg, replace_func):
+    """ Return engine to use for given streams: `replace_func` chosen by user, or selected
+        automatically.
+    """
+    if cfg.regions:
+        regions, linear = cfg.regions, cfg.linear
+
+        def _replace_regions(src, dst, pattern, replace, count):
+            return replace_regions(src, dst, pattern, replace, count, regions, linear)
+        _replace_regions.__name__ = 'regions'
+        replace_func = _replace_regions
+
+    elif replace_func is None:
+        replace_func = select_engine(src, dst, pattern, cfg.replace, cfg.linear)
+
+    if cfg.debug:
+        debug('engine: %s' % _engine_name(replace_func), indent=1)
+
+    return replace_func
+
+
+# job for processes created by _process_file__parallel: (path, pattern, replace, encoding, linear, count)
+_PARALLEL_JOB = None
+
+
+def _parallel__segments(path, start, end, parts):
+    """ Split data in file at `path` between `start` and `end` into about `parts` byte ranges,
+        every one of them ending with new line character (or at `end`).
+    """
+    bounds = [start]
+    with io.open(path, 'rb') as fh:
+        for part in range(1, parts):
+            fh.seek(start + (end - start) * part // parts)
+            fh.readline()
+            position = fh.tell()
+            if position >= end:
+                break
+            if position > bounds[-1]:
+                bounds.append(position)
+    bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _parallel__read(segment):
+    """ Read and decode segment of file processed in _PARALLEL_JOB.
+    """
+    path, _, _, encoding, _, _ = _PARALLEL_JOB
+    start, end = segment
+    with io.open(path, 'rb') as fh:
+        fh.seek(start)
+        return fh.read(end - start).decode(encoding)
+
+
+def _parallel__count(segment):
+    """ Count matches in segment of file (but no more than count of replacements).
+    """
+    _, pattern, _, _, linear, count = _PARALLEL_JOB
+    text = _parallel__read(segment)
+
+    parts = [text]
+    if linear and RE_OTHER_LINEBREAKS.search(text):
+        parts = text.splitlines(True)
+
+    found = 0
+    for part in parts:
+        for _ in pattern.finditer(part):
+            found += 1
+            if found >= count:
+                return found
+    return found
+
+
+def _parallel__replace(job):
+    """ Replace data in segment of file, with given limit of replacements (0 - unlimited). Result
+        is saved in temporary file.
+
+        Returns tuple: (path to temporary file, quantity of replaces).
+    """
+    segment, limit = job
+    _, pattern, replace, encoding, linear, _ = _PARALLEL_JOB
+    text = _parallel__read(segment)
+
+    if linear:
+        text, cnt = _replace_linear__block(text, pattern, replace, limit)
+    else:
+        text, cnt = pattern.subn(replace, text, limit)
+
+    tmp_fd, tmp_path = tempfile.mkstemp(prefix=TEMP_FILE_PREFIX)
+    with io.open(tmp_fd, 'wb') as tmp_fh:
+        tmp_fh.write(text.encode(encoding))
+    return tmp_path, cnt
+
+
+def _can_fork():
+    """ Check if work can be given to processes forked from current one (which isn't worker
+        process itself).
+    """
+    if IS_PY2:
+        return False
+
+    import multiprocessing
+
+    return not multiprocessing.current_process().daemon and 'fork' in multiprocessing.get_all_start_methods()
+
+
+def _process_file__can_parallel(src_entry, cfg, encoding):
+    """ Check if file described by `src_entry` should be split into segments processed in parallel: it's
+        big enough, pattern can't cross lines and new line characters can be found in encoded data.
+        Not possible when file is already processed in worker process.
+    """
+    return not IS_PY2 and cfg.jobs > 1 and not cfg.report and not cfg.rules and not cfg.regions and \
+        not cfg.manifest and _can_fork() and \
+        _is_ascii_compatible(encoding) and _pattern_is_line_local(cfg.pattern) and \
+        src_entry.size >= PARALLEL_MIN_SIZE
+
+
+def _process_file__parallel(src_entry, dst_fh, cfg, count, encoding, bom):
+    """ Split file described by `src_entry` into line aligned segments, process them in `cfg.jobs`
+        processes and write results in order to binary file `dst_fh`.
+
+        If `count` is given, first matches in segments are counted (stopping when `count`
+        is reached), to find how many replacements can be done in every segment.
+    """
+    # pylint: disable=global-statement
+    global _PARALLEL_JOB
+
+    src_path, size = src_entry.path, src_entry.size
+    segments = _parallel__segments(src_path, len(bom), size, max(cfg.jobs, size // PARALLEL_SEGMENT_SIZE))
+    _PARALLEL_JOB = (src_path, cfg.pattern, cfg.replace, encoding, cfg.linear, count)
+
+    import multiprocessing
+
+    pool = multiprocessing.get_context('fork').Pool(cfg.jobs)
+    try:
+        # limit of replacements for every segment: 0 means unlimited, None - copy without changes
+        limits = [0] * len(segments)
+        if count:
+            limits = [None] * len(segments)
+            remaining = count
+            for idx, found in enumerate(pool.imap(_parallel__count, segments)):
+                limits[idx] = min(found, remaining) or None
+                remaining -= found
+                if remaining <= 0:
+                    break
+
+        jobs = [(segment, limit) for segment, limit in zip(segments, limits) if limit is not None]
+        results = pool.imap(_parallel__replace, jobs)
+
+        cnt = 0
+        for (start, end), limit in zip(segments, limits):
+            if limit is None:
+                _copy_file_range(src_path, dst_fh, start, end - start)
+                continue
+
+            tmp_path, segment_cnt = next(results)
+            cnt += segment_cnt
+            try:
+                _copy_file_range(tmp_path, dst_fh)
+            finally:
+                os.unlink(tmp_path)
+    finally:
+        pool.terminate()
+        _PARALLEL_JOB = None
+
+    if cfg.verbose or cfg.debug:
+        debug('%s %s (in %d segments)' % (cnt, _plural_s(cnt, 'replacement'), len(segments)), indent=1)
+
+    return cnt
+
+
+def _process_file__clone(fh_src, fh_dst):
+    """ Try to make copy-on-write clone of `fh_src` in empty `fh_dst` (supported on Linux by
+        btrfs, XFS and others), which is cheap even for huge files.
+
+        Returns True if clone was created.
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+
+    try:
+        fcntl.ioctl(fh_dst.fileno(), FICLONE, fh_src.fileno())
+    except (IOError, OSError):
+        return False
+
+    return True
+
+
+def _process_file__make_backup(path, backup_ext, keep_existing=False):
+    """ Create backup of file: copy (or clone, if possible) it with new extension. With `keep_existing`,
+        existing backup file is used (it's left by interrupted run, see: --resume).
+
+        Returns path to backup file.
+    """
+
+    root = os.path.dirname(path)
+    backup_path = os.path.join(root, path + backup_ext)
+
+    # created exclusively: checking for existence of backup would cost additional stat
+    try:
+        fd = os.open(backup_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o600)
+    except OSError as ex:
+        if ex.errno == errno.EEXIST and keep_existing:
+            return backup_path
+        if ex.errno == errno.EEXIST:
+            raise SubstException('Backup path: "%s" for file "%s" already exists, file skipped' % (backup_path, path))
+        raise SubstException('Cannot create backup for "%s": %s' % (path, ex))
+
+    try:
+        with io.open(path, 'rb') as fh_src, io.open(fd, 'wb') as fh_dst:
+            if not _process_file__clone(fh_src, fh_dst):
+                _copy_file_range(path, fh_dst)
+        shutil.copystat(path, backup_path)
+    except (shutil.Error, IOError, OSError) as ex:
+        raise SubstException('Cannot create backup for "%s": %s' % (path, ex))
+
+    return backup_path
+
+
+def _process_file__backup(path, cfg):
+    """ Create backup of file at `path`, if requested.
+    """
+    if not cfg.no_backup:
+        checkpoint = cfg.checkpoint if isinstance(cfg.checkpoint, _Checkpoint) else None
+        keep_existing = cfg.resume and checkpoint is not None and checkpoint.backed_up(path + cfg.ext)
+        backup_path = _process_file__make_backup(path, cfg.ext, keep_existing)
+        if checkpoint is not None and not keep_existing:
+            checkpoint.add_backup(backup_path)
+
+        if cfg.debug:
+            debug('created backup file: "%s"' % backup_path, indent=1)
+
+
+def _detect_encoding(path):
+    """ Detect encoding of file at `path`: if it starts with BOM, return encoding for it. In other
+        case, return 'utf-8' if beginning of file is valid UTF-8, or AUTO_ENCODING_FALLBACK.
+
+        Returns tuple: (encoding, bom).
+    """
+    with io.open(path, 'rb') as fh:
+        data = fh.read(AUTO_ENCODING_SNIFF_SIZE)
+
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return encoding, bom
+
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(data, len(data) < AUTO_ENCODING_SNIFF_SIZE)
+    except UnicodeDecodeError:
+        return AUTO_ENCODING_FALLBACK, b''
+
+    return 'utf-8', b''
+
+
+def _process_file__encoding(entry, cfg):
+    """ Find encoding of file described by `entry`: detected (with --encoding-file=auto) or given
+        by user.
+
+        Returns tuple: (encoding, bom).
+    """
+    if FILE_ENCODING != AUTO_ENCODING:
+        return FILE_ENCODING, b''
+
+    if cfg.encoding_cache:
+        cached = cfg.encoding_cache.get(entry)
+        if cached:
+            return cached
+
+    encoding, bom = _detect_encoding(entry.path)
+
+    if cfg.encoding_cache:
+        cfg.encoding_cache.set(entry, encoding, bom)
+
+    if cfg.debug:
+        debug('detected encoding: %s%s' % (encoding, ' with BOM' if bom else ''), indent=1)
+
+    return encoding, bom
+
+
+def _process_file__can_fall_back(encoding, bom):
+    """ Check if file with detected `encoding` can turn out not to be valid in it, and be processed
+        with AUTO_ENCODING_FALLBACK encoding.
+    """
+    return FILE_ENCODING == AUTO_ENCODING and encoding != AUTO_ENCODING_FALLBACK and not bom
+
+
+def _process_file__decoded(entry, cfg, process):
+    """ Find encoding of file described by `entry` (see: `_process_file__encoding`) and call
+        `process(encoding, bom)`. If encoding was detected as UTF-8, but file turns out not to be
+        valid UTF-8 (`process` raises UnicodeDecodeError), `process` is called again with
+        AUTO_ENCODING_FALLBACK encoding - it must discard results of previous call.
+
+        Returns tuple: (result of `process`, encoding, bom).
+    """
+    encoding, bom = _process_file__encoding(entry, cfg)
+    while True:
+        try:
+            return process(encoding, bom), encoding, bom
+        except UnicodeDecodeError:
+            if not _process_file__can_fall_back(encoding, bom):
+                raise
+
+            if cfg.debug:
+                debug('file is not valid UTF-8, using encoding: %s' % AUTO_ENCODING_FALLBACK, indent=1)
+
+            encoding = AUTO_ENCODING_FALLBACK
+            if cfg.encoding_cache:
+                cfg.encoding_cache.set(entry, encoding, bom)
+
+
+def _process_file__validate(path, encoding):
+    """ Decode whole file at `path` with `encoding`, raising UnicodeDecodeError if it's not valid.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    with io.open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(BLOCK_SIZE), b''):
+            decoder.decode(block)
+    decoder.decode(b'', True)
+
+
+def _process_file__open(path, encoding, bom, src_hash=None):
+    """ Open file at `path` for reading text in `encoding`, skipping `bom`. If `src_hash` is
+        given (_ContentHash), read data is added to it.
+    """
+    fh_src = io.open(path, 'rb')
+    fh_src.seek(len(bom))
+    if src_hash is not None:
+        fh_src = _HashingStream(fh_src, src_hash)
+    return codecs.getreader(encoding)(fh_src)
+
+
+def _process_file__pattern(src_path, cfg, encoding, bom):
+    """ Return pattern to use for file at `src_path`: compiled pattern, or proxy for it, if
+        replacements have to be reported (or rules from --rules have to be applied).
+    """
+    if cfg.rules:
+        return _RuleChain(cfg.rules.for_path(src_path))
+    if cfg.report:
+        return _MatchReport(cfg.pattern, src_path, encoding, cfg.report, len(bom))
+    return cfg.pattern
+
+
+# pylint: disable=too-many-arguments
+def _process_file__handle(src_path, dst_fh, cfg, replace_func, count, encoding, bom, src_hash=None):
+    """ Read data from `src_path` (in given `encoding`, starting with `bom`), replace data with
+        `replace_func` (at most `count` replacements) and save it to `dst_fh`. If `src_hash` is
+        given, data read from file is added to it, as it streams through.
+    """
+
+    pattern = _process_file__pattern(src_path, cfg, encoding, bom)
+
+    with _process_file__open(src_path, encoding, bom, src_hash) as fh_src:
+        replace_func = _process_file__engine(fh_src, dst_fh, pattern, cfg, replace_func)
+        cnt = replace_func(fh_src, dst_fh, pattern, cfg.replace, count)
+        if cfg.report:
+            pattern.flush()
+        if cfg.verbose or cfg.debug:
+            debug('%s %s' % (cnt, _plural_s(cnt, 'replacement')), indent=1)
+
+    return cnt
+
+
+def _process_file__match_free(entry, cfg, encoding):
+    """ Check, without decoding, if pattern certainly doesn't match anything in file described
+        by `entry`: version of pattern working on bytes (see: `_pattern_bytes`) doesn't find
+        anything in memory mapped file.
+    """
+    # with --linear and --between/--lines pattern is applied to parts of file, where anchors
+    # can match in other places
+    if cfg.linear or cfg.regions or cfg.rules or not _is_ascii_compatible(encoding):
+        return False
+
+    bytes_pattern = _pattern_bytes(cfg.pattern)
+    if bytes_pattern is None:
+        return False
+
+    with io.open(entry.path, 'rb') as fh:
+        if not entry.size:
+            return bytes_pattern.search(b'') is None
+        data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return bytes_pattern.search(data) is None
+        finally:
+            data.close()
+
+
+def _process_file__stdout(entry, cfg, replace_func, count):
+    """ Process file described by `entry`, writing result to STDOUT.
+
+        File in which pattern certainly doesn't match (see: `_process_file__match_free`), in the
+        same encoding as STDOUT, is copied inside of kernel. Other files are written to STDOUT
+        by big binary writes, instead of writes of text to sys.stdout.
+
+        Data written to STDOUT can't be discarded, so file which can turn out not to be valid in
+        detected encoding is validated first.
+    """
+    return _process_file__decoded(entry, cfg, lambda encoding, bom: _process_file__stdout_decoded(
+        entry, cfg, replace_func, count, encoding, bom))[0]
+
+
+def _process_file__stdout_decoded(entry, cfg, replace_func, count, encoding, bom):
+    """ Process file described by `entry`, in `encoding`, writing result to STDOUT (see:
+        `_process_file__stdout`).
+    """
+    if _process_file__can_fall_back(encoding, bom) and entry.size > AUTO_ENCODING_SNIFF_SIZE:
+        _process_file__validate(entry.path, encoding)
+
+    stdout_fd = None
+    stdout_encoding = getattr(sys.stdout, 'encoding', None)
+    if not IS_PY2 and not IS_WIN and stdout_encoding:
+        try:
+            stdout_fd = sys.stdout.fileno()
+        except (AttributeError, IOError, OSError, ValueError):
+            stdout_fd = None
+
+    if stdout_fd is None:
+        return _process_file__handle(entry.path, sys.stdout, cfg, replace_func, count, encoding, bom)
+
+    sys.stdout.flush()
+    if not bom and codecs.lookup(encoding).name == codecs.lookup(stdout_encoding).name and \
+            _process_file__match_free(entry, cfg, encoding):
+        with io.open(entry.path, 'rb') as fh_src:
+            if not _copy_range(fh_src.fileno(), stdout_fd, 0):
+                with io.open(stdout_fd, 'wb', buffering=BLOCK_SIZE, closefd=False) as fh_dst:
+                    shutil.copyfileobj(fh_src, fh_dst, BLOCK_SIZE)
+        if cfg.verbose or cfg.debug:
+            debug('0 replacements (copied without changes)', indent=1)
+        return 0
+
+    with io.open(stdout_fd, 'wb', buffering=BLOCK_SIZE, closefd=False) as fh_dst:
+        dst_fh = codecs.getwriter(stdout_encoding)(fh_dst, getattr(sys.stdout, 'errors', None) or 'strict')
+        return _process_file__handle(entry.path, dst_fh, cfg, replace_func, count, encoding, bom)
+
+
+def _process_file__regular(src_entry, cfg, replace_func, count):
+    """ Read data from file described by `src_entry`, replace data with `replace_func` (at most `count`
+        replacements) and save it.
+
+        It's safe operation - first save data to temporary file, and then try to rename
+        new file to old one.
+
+        Output is written in the same encoding as input (including BOM). If encoding was
+        detected as UTF-8, but file turns out not to be valid UTF-8, it's processed again with
+        AUTO_ENCODING_FALLBACK encoding.
+    """
+
+    src_path = src_entry.path
+
+    tmp_fh, tmp_path = tempfile.mkstemp(prefix=TEMP_FILE_PREFIX)
+    if IS_PY2:
+        tmp_fh = os.fdopen(tmp_fh, 'w')
+    else:
+        tmp_fh = io.open(tmp_fh, 'wb')
+
+    src_hash = dst_hash = None
+    if cfg.manifest:
+        src_hash, dst_hash = _ContentHash(), _ContentHash()
+        tmp_fh = _HashingStream(tmp_fh, dst_hash)
+
+    def _process(encoding, bom):
+        tmp_fh.seek(0)
+        tmp_fh.truncate()
+        if cfg.manifest:
+            src_hash.reset(bom)
+            dst_hash.reset()
+        tmp_fh.write(bom)
+        if _process_file__can_parallel(src_entry, cfg, encoding):
+            return _process_file__parallel(src_entry, tmp_fh, cfg, count, encoding, bom)
+        dst_fh = tmp_fh if IS_PY2 else codecs.getwriter(encoding)(tmp_fh)
+        return _process_file__handle(src_path, dst_fh, cfg, replace_func, count, encoding, bom, src_hash)
+
+    cnt, encoding, bom = _process_file__decoded(src_entry, cfg, _process)
+
+    try:
+        tmp_fh.close()
+    # pylint: disable=bare-except
+    except:
+        pass
+
+    try:
+        shutil.move(tmp_path, src_path)
+    except OSError as ex:
+        raise SubstException('Error replacing "%s" with "%s": %s' % (src_path, tmp_path, ex))
+    else:
+        if cfg.debug:
+            debug('moved temporary file to original', indent=1)
+
+    if cfg.encoding_cache and FILE_ENCODING == AUTO_ENCODING:
+        cfg.encoding_cache.set(FileEntry(src_path), encoding, bom)
+
+    if cfg.manifest and src_hash.hexdigest() != dst_hash.hexdigest():
+        cfg.manifest.write([{
+            'path': src_path,
+            'old_sha256': src_hash.hexdigest(),
+            'new_sha256': dst_hash.hexdigest(),
+            'old_size': src_hash.size,
+            'new_size': dst_hash.size,
+            'replacements': cnt,
+        }])
+
+    return cnt
+
+
+def _process_file__patch(entry, cfg, replace_func, count):
+    """ Find replacements in file described by `entry`, and if none of them changes length of replaced data,
+        write only replaced bytes directly into file.
+
+        Returns quantity of replacements, or None if file must be processed in regular way.
+    """
+
+    path = entry.path
+
+    def _collect(encoding, bom):
+        if '\n\n'.encode(encoding) != '\n'.encode(encoding) * 2:
+            return None
+
+        pattern = _process_file__pattern(path, cfg, encoding, bom)
+        collector = _PatchCollector(pattern, encoding, len(bom))
+        try:
+            with _process_file__open(path, encoding, bom) as fh_src:
+                null_writer = _NullWriter()
+                engine = _process_file__engine(fh_src, null_writer, collector, cfg, replace_func)
+                cnt = engine(fh_src, null_writer, collector, cfg.replace, count)
+        except _LengthChanged:
+            if cfg.debug:
+                debug('replacements change length of data, can\'t patch file in place', indent=1)
+            return None
+        return pattern, collector, cnt
+
+    collected = _process_file__decoded(entry, cfg, _collect)[0]
+    if collected is None:
+        return None
+
+    pattern, collector, cnt = collected
+    patches = collector.patches()
+    if patches:
+        _process_file__backup(path, cfg)
+
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            for offset, data in patches:
+                if hasattr(os, 'pwrite'):
+                    os.pwrite(fd, data, offset)
+                else:
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    if cfg.report:
+        pattern.flush()
+    if cfg.verbose or cfg.debug:
+        debug('%s %s (patched in place)' % (cnt, _plural_s(cnt, 'replacement')), indent=1)
+
+    return cnt
+
+
+def _process_file__entry(entry):
+    """ Return FileEntry for `entry` (FileEntry or path), checking if it's regular file.
+    """
+    if not isinstance(entry, FileEntry):
+        entry = FileEntry(entry)
+
+    if not entry.exists():
+        raise SubstException('Path "%s" doesn\'t exists' % entry.path)
+
+    if not entry.is_regular():
+        raise SubstException('Path "%s" is not a regular file' % entry.path)
+
+    return entry
+
+
+def process_file(entry, replace_func, cfg):
+    """ Process single file (FileEntry or path): open, read, make backup and replace data.
+    """
+
+    path = entry.path if isinstance(entry, FileEntry) else entry
+    if cfg.verbose or cfg.debug:
+        debug(path)
+
+    entry = _process_file__entry(entry)
+
+    if cfg.rules and not cfg.rules.for_path(path):
+        if cfg.debug:
+            debug('no rules for file, file skipped', indent=1)
+        return 0
+
+    count = cfg.count
+    if cfg.replacement_budget:
+        count = cfg.replacement_budget.take(count)
+        if not count:
+            if cfg.debug:
+                debug('limit of replacements exhausted, file skipped', indent=1)
+            return 0
+
+    cnt = 0
+    try:
+        if cfg.in_place_patch and not cfg.stdout and not cfg.manifest:
+            patched_cnt = _process_file__patch(entry, cfg, replace_func, count)
+            if patched_cnt is not None:
+                cnt = patched_cnt
+                return cnt
+
+        _process_file__backup(path, cfg)
+
+        try:
+            if cfg.stdout:
+                cnt = _process_file__stdout(entry, cfg, replace_func, count)
+            else:
+                cnt = _process_file__regular(entry, cfg, replace_func, count)
+        except SubstException as ex:
+            err(u(ex))
+    finally:
+        if cfg.replacement_budget:
+            cfg.replacement_budget.settle(count, cnt)
+
+    return cnt
+
+
+def check_file(entry, cfg):
+    """ Check if pattern matches anything in file (FileEntry or path; STDIN if `entry` is None).
+        File is not modified.
+    """
+
+    if entry is None:
+        return _check_file__stream(sys.stdin, cfg)
+
+    entry = _process_file__entry(entry)
+
+    def _check(encoding, bom):
+        with _process_file__open(entry.path, encoding, bom) as fh_src:
+            return _check_file__stream(fh_src, cfg)
+
+    return _process_file__decoded(entry, cfg, _check)[0]
+
+
+def _check_file__stream(src, cfg):
+    """ Check if pattern matches anything in `src` (only in lines chosen by --between or --lines),
+        reading line by line in linear mode.
+    """
+    if cfg.regions:
+        return _check_file__regions(src, cfg)
+
+    if cfg.linear:
+        for line in src:
+            if cfg.pattern.search(line):
+                return True
+        return False
+
+    return cfg.pattern.search(src.read()) is not None
+
+
+def _check_file__regions(src, cfg):
+    """ Check if pattern matches anything in lines of `src` chosen by `cfg.regions` (see:
+        replace_regions: every region is searched separately).
+    """
+    region = []
+    for active, line in cfg.regions.lines(src):
+        if active:
+            if cfg.linear:
+                if cfg.pattern.search(line):
+                    return True
+            else:
+                region.append(line)
+            continue
+
+        if region and cfg.pattern.search(''.join(region)):
+            return True
+        region = []
+    return bool(region) and cfg.pattern.search(''.join(region)) is not None
+
+
+class _Watcher(object):
+    """ Watch for files written in directories (recursively) and files from `paths` with inotify
+        (Linux only, through ctypes).
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, paths, debounce=WATCH_DEBOUNCE):
+        import ctypes.util
+
+        self._debounce = debounce
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            raise SubstException('Cannot initialize inotify: %s' % os.strerror(ctypes.get_errno()))
+
+        self._dirs = {}
+        self._files = set()
+        for path in paths:
+            if os.path.isdir(path):
+                self._add_tree(path)
+            else:
+                self._files.add(path)
+                self._add(os.path.dirname(path), recursive=False)
+
+    def _add(self, path, recursive=True):
+        """ Start watching directory at `path`.
+        """
+        import ctypes
+
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | (self.IN_CREATE if recursive else 0)
+        wd = self._libc.inotify_add_watch(self._fd, path.encode(FILESYSTEM_ENCODING), mask)
+        if wd < 0:
+            raise SubstException('Cannot watch "%s": %s' % (path, os.strerror(ctypes.get_errno())))
+        if recursive or wd not in self._dirs:
+            self._dirs[wd] = (path, recursive)
+
+    def _add_tree(self, root):
+        """ Start watching directory `root` with all subdirectories.
+
+            Returns paths of files already present in new subdirectories.
+        """
+        found = []
+        for dirpath, _, filenames in os.walk(root):
+            self._add(dirpath)
+            found.extend(os.path.join(dirpath, name) for name in filenames)
+        return found
+
+    def _read(self):
+        """ Read available events.
+
+            Returns list of paths of written files.
+        """
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError as ex:
+            if ex.errno == errno.EAGAIN:
+                return []
+            raise
+
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                err('inotify queue overflow, some events were lost')
+                continue
+            if mask & self.IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            if wd not in self._dirs or not name:
+                continue
+
+            directory, recursive = self._dirs[wd]
+            path = os.path.join(directory, u(name, FILESYSTEM_ENCODING))
+            if mask & self.IN_ISDIR:
+                if recursive:
+                    paths.extend(self._add_tree(path))
+            elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                if recursive or path in self._files:
+                    paths.append(path)
+        return paths
+
+    def batches(self):
+        """ Yield lists of paths of files written since previous batch. Batch is yielded when
+            no new events arrived for `debounce` seconds.
+        """
+        while True:
+            select.select([self._fd], [], [])
+            batch = collections.OrderedDict()
+            while True:
+                batch.update((path, None) for path in self._read())
+                if not select.select([self._fd], [], [], self._debounce)[0]:
+                    break
+            if batch:
+                yield list(batch)
+
+    def close(self):
+        """ Stop watching.
+        """
+        os.close(self._fd)
+
+
+def _serve__recv_exactly(sock, size):
+    """ Read exactly `size` bytes from `sock`. Returns less data only if connection was closed.
+    """
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _serve__recv_request(sock):
+    """ Read request forwarded by client: message length (4 bytes, network order), with client's stdin,
+        stdout and stderr descriptors passed as ancillary data, followed by JSON message with `argv`
+        and `cwd`.
+
+        Returns tuple: (descriptors, request).
+    """
+    header, fds, _, _ = socket.recv_fds(sock, 4, 3)
+    try:
+        if len(header) < 4:
+            header += _serve__recv_exactly(sock, 4 - len(header))
+        request = json.loads(_serve__recv_exactly(sock, struct.unpack('!I', header)[0]).decode('utf-8'))
+    except (struct.error, ValueError):
+        for fd in fds:
+            os.close(fd)
+        raise
+    return fds, request
+
+
+def _serve__warm(argv):
+    """ Create parser of arguments, and compile pattern given in `argv` (filling caches of its analysis)
+        in server process, so processes handling requests inherit them. Errors are ignored: arguments
+        are validated by handler.
+    """
+    # pylint: disable=global-statement
+    global _PARSER
+
+    if _PARSER is None:
+        _PARSER = _parse_args__parser()
+
+    try:
+        with contextlib.redirect_stderr(io.StringIO()):
+            args, _ = _PARSER.parse_known_args(argv)
+        if args.rules or (args.pattern is None and args.pattern_and_replace is None):
+            return
+        pattern = _parse_args__pattern(args)[0]
+        _pattern_literal(pattern)
+        _pattern_bytes(pattern)
+        _pattern_is_line_local(pattern)
+    # pylint: disable=broad-except
+    except (Exception, SystemExit):
+        pass
+
+
+class _ServeRequestHandler(object):
+    """ Handle single request forwarded by client (see: `_serve__recv_request`), already read by server.
+
+        Response is exit code (4 bytes, network order). Every request is handled in forked process,
+        so changes of working directory, standard streams or global state don't leak between requests.
+    """
+
+    def __init__(self, sock, _, server):
+        self.request = sock
+        self.server = server
+        self.handle()
+
+    def handle(self):
+        """ Run forwarded call, with client's working directory and standard streams.
+        """
+        fds, request = self.server.forwarded
+
+        for target_fd, fd in enumerate(fds):
+            os.dup2(fd, target_fd)
+            os.close(fd)
+
+        try:
+            os.chdir(request['cwd'])
+            exit_code = main(request['argv'])
+        except SystemExit as exc:
+            exit_code = exc.code
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+        if exit_code is None:
+            exit_code = 0
+        elif not isinstance(exit_code, int):
+            exit_code = 1
+        self.request.sendall(struct.pack('!i', exit_code))
+
+
+def _serve__server(socket_path):
+    """ Create forking server listening on UNIX socket `socket_path`: request is read, and its pattern
+        compiled, by server, and handled by its child.
+
+        socketserver is imported only here, so it doesn't slow down clients forwarding requests.
+    """
+    import socketserver
+
+    class _ServeServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+        """ Forking server: every request is handled by child of warm server process.
+        """
+
+        forwarded = None
+
+        def process_request(self, request, client_address):
+            # request is sent by client right after connecting: client sending nothing can't block others
+            request.settimeout(SERVER_REQUEST_TIMEOUT)
             try:
-                cnt_changes_single = process_file(path, replace_func, args)
-                if cnt_changes_single > 0:
-                    cnt_changes += cnt_changes_single
-                    cnt_changed_files += 1
+                self.forwarded = _serve__recv_request(request)
+            except (IOError, OSError, struct.error, ValueError):
+                self.shutdown_request(request)
+                return
+            request.settimeout(None)
+
+            _serve__warm(self.forwarded[1]['argv'])
+            try:
+                socketserver.ForkingMixIn.process_request(self, request, client_address)
+            finally:
+                for fd in self.forwarded[0]:
+                    os.close(fd)
+                self.forwarded = None
+
+    return _ServeServer(socket_path, _ServeRequestHandler)
+
+
+def serve(socket_path):
+    """ Listen on UNIX socket `socket_path` and handle requests forwarded by clients, until interrupted.
+    """
+
+    # server must not forward requests to itself
+    os.environ.pop(SERVER_ENV_VARIABLE, None)
+
+    # socket left by server, which wasn't stopped cleanly, is replaced
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except OSError:
+        mode = None
+    if mode is not None:
+        if not stat.S_ISSOCK(mode):
+            err('Path "%s" already exists and isn\'t a socket, server not started' % socket_path, exit_code=1)
+        os.unlink(socket_path)
+
+    server = _serve__server(socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+    return 0
+
+
+def _main__forward(socket_path, args):
+    """ Forward arguments, working directory and standard streams to server listening on
+        `socket_path`.
+
+        Returns exit code of forwarded call, or None if server is not available.
+    """
+    if not hasattr(socket, 'send_fds'):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except (IOError, OSError):
+        sock.close()
+        return None
+
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        payload = json.dumps({'argv': list(args), 'cwd': os.getcwd()}).encode('utf-8')
+        socket.send_fds(sock, [struct.pack('!I', len(payload))], [0, 1, 2])
+        sock.sendall(payload)
+        response = _serve__recv_exactly(sock, 4)
+    finally:
+        sock.close()
+
+    if len(response) < 4:
+        err('connection to server "%s" lost' % socket_path)
+        return 1
+
+    return struct.unpack('!i', response)[0]
+
+
+def _main__build_index(args):
+    """ Build (or update) trigram index of directory given with --build-index.
+    """
+    import sqlite3
+
+    cwd = os.getcwdu() if IS_PY2 else os.getcwd()
+    root = os.path.normcase(os.path.normpath(os.path.join(cwd, u(args.build_index, INPUT_ENCODING))))
+
+    index = _TrigramIndex(os.path.normcase(os.path.abspath(args.index)))
+    try:
+        cnt_indexed, cnt_removed = index.update(root)
+    except sqlite3.Error as ex:
+        err('Cannot build index "%s": %s' % (args.index, ex), exit_code=1)
+    finally:
+        index.close()
+
+    if args.verbose or args.debug:
+        debug('Indexed %d %s, removed %d %s.' % (
+            cnt_indexed, _plural_s(cnt_indexed, 'file'), cnt_removed, _plural_s(cnt_removed, 'file')))
+    return 0
+
+
+def _main__index_candidates(entries, args):
+    """ Return entries of files (or of all indexed files, if `entries` is None), which can contain
+        matches according to index given with --index.
+    """
+    import sqlite3
+
+    trigrams = frozenset()
+    if not args.rules and (FILE_ENCODING == AUTO_ENCODING or _is_ascii_compatible(FILE_ENCODING)):
+        trigrams = _pattern_trigrams(args.pattern)
+
+    index = _TrigramIndex(args.index)
+    try:
+        candidates = index.candidates(entries, trigrams)
+    except sqlite3.Error as ex:
+        err('Cannot read index "%s": %s' % (args.index, ex), exit_code=1)
+    finally:
+        index.close()
+
+    if args.debug:
+        debug('candidates found in index: %d' % len(candidates))
+    return candidates
+
+
+def _main__watch(replace_func, args):
+    """ Process files from `args.files` (and files in given directories) every time they are
+        written, until interrupted. Files written by this process, temporary and backup files
+        are ignored. Backup made when file was processed before by this function is replaced with
+        new one.
+
+        Returns tuple: (quantity of replaces, quantity of changes of files).
+    """
+    try:
+        watcher = _Watcher([entry.path for entry in args.files])
+    except SubstException as exc:
+        err(u(exc), exit_code=1)
+
+    if args.verbose or args.debug:
+        debug('Watching for changes, press Ctrl+C to stop.')
+
+    # (size, mtime, inode) of files after they were processed
+    written = {}
+    # files with backups made by this process
+    backups = set()
+    cnt_changes = cnt_changed_files = 0
+    try:
+        for batch in watcher.batches():
+            for path in batch:
+                name = os.path.basename(path)
+                if WATCH_IGNORED_NAMES.search(name) or (args.ext and name.endswith(args.ext)):
+                    continue
+
+                entry = FileEntry(path)
+                if not entry.is_regular() or written.get(path) == (entry.size, entry.mtime, entry.ino):
+                    continue
+
+                try:
+                    backup_path = None if args.no_backup else path + args.ext
+                    if path in backups:
+                        _main__watch_remove_backup(path, backup_path)
+                    elif backup_path and os.path.exists(backup_path):
+                        backup_path = None
+                    cnt = process_file(entry, replace_func, args)
+                    if backup_path and os.path.exists(backup_path):
+                        backups.add(path)
+                    if cnt > 0:
+                        cnt_changes += cnt
+                        cnt_changed_files += 1
+                except SubstException as exc:
+                    err(u(exc), indent=int(args.verbose or args.debug))
+
+                entry = FileEntry(path)
+                written[path] = (entry.size, entry.mtime, entry.ino)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+    return cnt_changes, cnt_changed_files
+
+
+def _main__watch_remove_backup(path, backup_path):
+    """ Remove backup of file at `path`, made when it was processed before by `_main__watch`.
+    """
+    try:
+        os.remove(backup_path)
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise SubstException('Cannot remove backup "%s" for file "%s": %s' % (backup_path, path, ex))
+
+
+def _main__content_hash(entry):
+    """ Return hash of content of file described by `entry`.
+    """
+    import hashlib
+
+    digest = hashlib.sha256()
+    with io.open(entry.path, 'rb') as fh:
+        for block in iter(lambda: fh.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.digest()
+
+
+def _main__restore_backups(entries, args):
+    """ Restore files described by `entries` (and their hard links) from backups made by interrupted
+        run (stored in checkpoint file, see: --resume), so replacements already written to some of
+        them aren't applied again. Backups are kept.
+
+        Returns list of entries, describing restored files again.
+    """
+    result = []
+    for entry in entries:
+        for path in [entry.path] + [link.path for link in (args.hard_links or {}).get(entry.path, ())]:
+            backup_path = path + args.ext
+            if not args.checkpoint.backed_up(backup_path) or not os.path.isfile(backup_path):
+                continue
+
+            if args.debug:
+                debug('restoring "%s" from backup' % path)
+
+            tmp_fh, tmp_path = tempfile.mkstemp(prefix=TEMP_FILE_PREFIX)
+            try:
+                with io.open(tmp_fh, 'wb') as tmp_fh:
+                    _copy_file_range(backup_path, tmp_fh)
+                shutil.copystat(backup_path, tmp_path)
+                shutil.move(tmp_path, path)
+            except (shutil.Error, IOError, OSError) as ex:
+                raise SubstException('Cannot restore "%s" from backup "%s": %s' % (path, backup_path, ex))
+
+            if path == entry.path:
+                entry = FileEntry(path)
+        result.append(entry)
+    return result
+
+
+def _main__dedupe_content(entries):
+    """ Group `entries` by content of files: files are hashed only if there are other files of
+        the same size.
+
+        Returns tuple: (entries to process, dict: path of processed file -> list of entries of
+        files with identical content).
+    """
+    by_size = collections.defaultdict(list)
+    for entry in entries:
+        if entry.is_regular():
+            by_size[entry.size].append(entry)
+
+    copies = {}
+    skipped = set()
+    for same_size in by_size.values():
+        if len(same_size) < 2:
+            continue
+
+        by_hash = collections.OrderedDict()
+        for entry in same_size:
+            try:
+                by_hash.setdefault(_main__content_hash(entry), []).append(entry)
+            except (IOError, OSError):
+                pass
+
+        for group in by_hash.values():
+            if len(group) > 1:
+                copies[group[0].path] = group[1:]
+                skipped.update(entry.path for entry in group[1:])
+
+    return [entry for entry in entries if entry.path not in skipped], copies
+
+
+def _main__copy_result(entry, copies, cfg):
+    """ Replace content of files described by `copies` (identical to original content of file
+        described by `entry`) with already processed file.
+    """
+    for copy in copies:
+        if cfg.verbose or cfg.debug:
+            debug(copy.path)
+
+        _process_file__backup(copy.path, cfg)
+
+        tmp_fh, tmp_path = tempfile.mkstemp(prefix=TEMP_FILE_PREFIX)
+        with io.open(tmp_fh, 'wb') as tmp_fh:
+            _copy_file_range(entry.path, tmp_fh)
+
+        try:
+            shutil.move(tmp_path, copy.path)
+        except OSError as ex:
+            raise SubstException('Error replacing "%s" with "%s": %s' % (copy.path, tmp_path, ex))
+
+        if cfg.debug:
+            debug('copied result of: "%s"' % entry.path, indent=1)
+
+
+def _main__copies(path, args, links=True):
+    """ Return entries of files, which get result of processing file at `path`: its hard links
+        (if `links`), and files with identical content (with --dedupe-content) and their hard links.
+    """
+    hard_links = args.hard_links or {}
+    copies = list(hard_links.get(path, ())) if links else []
+    if args.dedupe_content:
+        for copy in args.content_copies.get(path, ()):
+            copies.append(copy)
+            copies.extend(hard_links.get(copy.path, ()))
+    return copies
+
+
+def _main__process_file(entry, replace_func, args):
+    """ Process single file, and copy result to its hard links and files with identical content
+        (with --dedupe-content).
+
+        Returns tuple: (quantity of replaces, quantity of changed files).
+    """
+    cnt = process_file(entry, replace_func, args)
+    if cnt <= 0:
+        return 0, 0
+
+    # file patched in place (see: --in-place-patch) keeps its inode, so hard links already have result
+    patched = args.in_place_patch and (args.hard_links or {}).get(entry.path) and \
+        FileEntry(entry.path).ino == entry.ino
+    copies = _main__copies(entry.path, args, links=not patched)
+    if copies:
+        _main__copy_result(entry, copies, args)
+
+    changed = len(_main__copies(entry.path, args)) + 1
+    return cnt * changed, changed
+
+
+def _main__write_summary(args, cnt_files, cnt_changes, cnt_changed_files, seconds):
+    """ Write summary of run to file given with --summary.
+    """
+    summary = {
+        'shard': [args.shard.index, args.shard.count] if args.shard else None,
+        'files': cnt_files,
+        'changed_files': cnt_changed_files,
+        'replacements': cnt_changes,
+        'seconds': round(seconds, 3),
+    }
+    try:
+        with io.open(args.summary, 'w', encoding='utf-8') as fh:
+            fh.write(u(json.dumps(summary, sort_keys=True)) + '\n')
+    except (IOError, OSError) as ex:
+        err('Cannot write summary "%s": %s' % (args.summary, ex), exit_code=1)
+
+
+def _main__merge_summaries(paths):
+    """ Merge summaries (see: --summary) from files at `paths`, and print result as JSON:
+        sums of quantities, the longest time, found and missing shards.
+
+        Returns exit code: 1 if some shards are missing or repeated, 0 in other case.
+    """
+    merged = {'files': 0, 'changed_files': 0, 'replacements': 0, 'seconds': 0, 'shards': [],
+              'missing_shards': [], 'repeated_shards': []}
+    counts = set()
+    for path in paths:
+        try:
+            with io.open(path, 'r', encoding='utf-8') as fh:
+                summary = json.load(fh)
+            for key in ('files', 'changed_files', 'replacements'):
+                merged[key] += summary[key]
+            merged['seconds'] = max(merged['seconds'], summary['seconds'])
+        except (IOError, OSError, ValueError, KeyError, TypeError) as ex:
+            err('Cannot read summary "%s": %s' % (path, ex), exit_code=1)
+
+        if summary.get('shard'):
+            index, count = summary['shard']
+            counts.add(count)
+            if index in merged['shards']:
+                merged['repeated_shards'].append(index)
+            else:
+                merged['shards'].append(index)
+
+    if len(counts) > 1:
+        err('Summaries of different quantities of shards: %s' % ', '.join(str(count) for count in sorted(counts)),
+            exit_code=1)
+
+    merged['shards'].sort()
+    if counts:
+        merged['missing_shards'] = sorted(set(range(counts.pop())) - set(merged['shards']))
+
+    disp(json.dumps(merged, sort_keys=True))
+    return int(bool(merged['missing_shards'] or merged['repeated_shards']))
+
+
+def _main__checkpoint(path, args):
+    """ Store in checkpoint file, that file at `path` (and files getting result of processing it,
+        see: `_main__copies`) is finished.
+    """
+    args.checkpoint.add(path)
+    for copy in _main__copies(path, args):
+        args.checkpoint.add(copy.path)
+
+
+# run of main, for processes created by _main__parallel: (replace_func, args)
+_PARALLEL_RUN = None
+
+
+def _main__parallel_worker(entry):
+    """ Process file described by `entry` in worker process.
+
+        Returns tuple: (path, quantity of replaces, quantity of changed files, error message,
+        entry for encoding cache, memoize hits and misses).
+    """
+    replace_func, cfg = _PARALLEL_RUN
+
+    memoize_stats = (cfg.replace.hits, cfg.replace.misses) if cfg.memoize else (0, 0)
+    cnt = cnt_files = 0
+    error = None
+    budgeted = None
+    try:
+        if cfg.replacement_budget:
+            # budget is taken while file is processed, instead of reserving it all for this file
+            if cfg.replacement_budget.exhausted():
+                return entry.path, 0, 0, None, None, (0, 0)
+            budgeted = _BudgetedReplacement(cfg.pattern, cfg.replace, cfg.replacement_budget, cfg.jobs)
+            file_cfg = argparse.Namespace(**vars(cfg))
+            file_cfg.replace, file_cfg.replacement_budget = budgeted, None
+            _main__process_file(entry, replace_func, file_cfg)
+            cnt, cnt_files = budgeted.used, int(budgeted.used > 0)
+        else:
+            cnt, cnt_files = _main__process_file(entry, replace_func, cfg)
+    except SubstException as exc:
+        error = u(exc)
+    finally:
+        if budgeted:
+            budgeted.settle()
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    if cfg.memoize:
+        memoize_stats = (cfg.replace.hits - memoize_stats[0], cfg.replace.misses - memoize_stats[1])
+    cache_entry = cfg.encoding_cache.entry(entry.path) if cfg.encoding_cache else None
+
+    return entry.path, cnt, cnt_files, error, cache_entry, memoize_stats
+
+
+def _main__estimate_memory(size, cfg):
+    """ Estimate how much memory is needed to process file of given `size`.
+    """
+    small = 4 * BLOCK_SIZE
+    if cfg.linear or cfg.engine in ('windowed', 'mmap'):
+        return small
+
+    if cfg.rules:
+        return max(small, size * GLOBAL_MEMORY_FACTOR)
+
+    if cfg.engine in ('auto', 'literal'):
+        literal = _pattern_literal(cfg.pattern)
+        if literal is not None and '\n' not in literal:
+            return small
+        if cfg.engine == 'auto' and _pattern_is_line_local(cfg.pattern):
+            return small
+
+    return max(small, size * GLOBAL_MEMORY_FACTOR)
+
+
+# pylint: disable=too-many-locals
+def _main__parallel(files, replace_func, args):
+    """ Process `files` in `args.jobs` worker processes, biggest files first. Files are started
+        only if their estimated memory usage fits in `args.memory_limit` together with files
+        being processed (if the biggest one doesn't fit, the smallest one is tried).
+
+        Returns tuple: (quantity of replaces, quantity of changed files).
+    """
+    import multiprocessing
+    import queue
+
+    # pylint: disable=global-statement
+    global _PARALLEL_RUN
+
+    limit = args.memory_limit or _available_memory()
+
+    pending = [(_main__estimate_memory(entry.size or 0, args), entry.size or 0, entry) for entry in files]
+    pending = collections.deque(sorted(pending, key=lambda item: item[1], reverse=True))
+
+    results = queue.Queue()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    _PARALLEL_RUN = (replace_func, args)
+    pool = multiprocessing.get_context('fork').Pool(args.jobs)
+
+    cnt_changes = cnt_changed_files = running = used = 0
+    error = failure = None
+    try:
+        while True:
+            while pending and running < args.jobs:
+                if args.replacement_budget and args.replacement_budget.exhausted():
+                    if args.debug:
+                        debug('limit of replacements exhausted, remaining files skipped')
+                    pending.clear()
+                    break
+
+                if not running or not limit or used + pending[0][0] <= limit:
+                    estimate, _, entry = pending.popleft()
+                elif used + pending[-1][0] <= limit:
+                    estimate, _, entry = pending.pop()
+                else:
+                    break
+
+                pool.apply_async(_main__parallel_worker, (entry, ),
+                                 callback=lambda result, estimate=estimate: results.put((result, estimate)),
+                                 error_callback=lambda exc, estimate=estimate: results.put((exc, estimate)))
+                running += 1
+                used += estimate
+
+            if not running:
+                break
+
+            result, estimate = results.get()
+            running -= 1
+            used -= estimate
+
+            # after failure no new files are started, but files being processed are finished: killed
+            # worker could leave partially written file (moving temporary file between filesystems)
+            if isinstance(result, BaseException):
+                failure = failure or result
+                pending.clear()
+                continue
+
+            path, cnt, cnt_files, file_error, cache_entry, memoize_stats = result
+            if file_error:
+                error = error or file_error
+                pending.clear()
+                continue
+            if args.checkpoint:
+                _main__checkpoint(path, args)
+            cnt_changes += cnt
+            cnt_changed_files += cnt_files
+            if cache_entry:
+                args.encoding_cache.update(path, cache_entry)
+            if args.memoize:
+                args.replace.hits += memoize_stats[0]
+                args.replace.misses += memoize_stats[1]
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+        _PARALLEL_RUN = None
+
+    if failure:
+        raise failure
+    if error:
+        err(error, indent=int(args.verbose or args.debug), exit_code=1)
+
+    return cnt_changes, cnt_changed_files
+
+
+def main(args):
+    """ Run tool: parse input arguments, read data, replace and save or display.
+    """
+
+    server_path = os.environ.get(SERVER_ENV_VARIABLE)
+    if server_path:
+        exit_code = _main__forward(server_path, args)
+        if exit_code is not None:
+            return exit_code
+
+    try:
+        args = parse_args(args)
+    except (UnicodeDecodeError, UnicodeEncodeError):
+        err("Cannot determine encoding of input arguments, please use --encoding-input option", exit_code=1)
+
+    if args.serve:
+        return serve(args.serve)
+
+    if args.build_index:
+        return _main__build_index(args)
+
+    if args.merge_summaries:
+        return _main__merge_summaries(args.files)
+
+    started = time.time()
+    replace_func = ENGINES[args.engine]
+
+    if args.index and not args.stdin:
+        args.files = _main__index_candidates(args.files, args)
+        if args.shard:
+            args.files = [entry for entry in args.files if args.shard.selects(entry.path)]
+
+    if args.exit_on_first_match:
+        for entry in [None] if args.stdin else args.files:
+            try:
+                if check_file(entry, args):
+                    if args.verbose:
+                        debug('Pattern found in: %s' % (entry.path if entry else '<stdin>'))
+                    return 0
+            except SubstException as exc:
+                err(u(exc), exit_code=1)
+        return 1
+
+    if args.report:
+        args.report = _RecordWriter(args.report, args.resume)
+
+    if args.manifest:
+        args.manifest = _RecordWriter(args.manifest, args.resume)
+
+    if args.checkpoint:
+        try:
+            args.checkpoint = _Checkpoint(args.checkpoint, args.resume)
+        except (SubstException, OSError) as exc:
+            err(u(exc), exit_code=1)
+
+    if args.encoding_cache:
+        args.encoding_cache = _EncodingCache(args.encoding_cache)
+
+    if args.max_total_replacements is not None:
+        args.replacement_budget = _ReplacementBudget(args.max_total_replacements)
+    else:
+        args.replacement_budget = None
+
+    files = args.files
+    if args.resume and files:
+        files = [entry for entry in files if not args.checkpoint.done(entry.path)]
+        if args.debug:
+            debug('files finished by previous run: %d' % (len(args.files) - len(files)))
+        if not args.no_backup:
+            try:
+                files = _main__restore_backups(files, args)
             except SubstException as exc:
-                err(u(exc), indent=int(args.verbose or args.debug), exit_code=1)
+                err(u(exc), exit_code=1)
+
+    if args.dedupe_content and files:
+        files, args.content_copies = _main__dedupe_content(files)
+        if args.debug:
+            debug('files with identical content: %d' % sum(len(copies) for copies in args.content_copies.values()))
+
+    try:
+        if args.stdin:
+            pattern = args.pattern
+            if args.report:
+                pattern = _MatchReport(pattern, '-', sys.stdin.encoding or 'utf-8', args.report)
+            count = args.count
+            if args.replacement_budget:
+                count = args.replacement_budget.take(count)
+            if args.replacement_budget and not count:
+                shutil.copyfileobj(sys.stdin, sys.stdout)
+                cnt_changes = 0
+            else:
+                replace_func = _process_file__engine(sys.stdin, sys.stdout, pattern, args, replace_func)
+                cnt_changes = replace_func(sys.stdin, sys.stdout, pattern, args.replace, count)
+            cnt_changed_files = 0
+            if args.report:
+                pattern.flush()
+
+        elif args.watch:
+            cnt_changes, cnt_changed_files = _main__watch(replace_func, args)
+
+        elif args.jobs > 1 and not args.stdout and len(files) > 1 and _can_fork():
+            cnt_changes, cnt_changed_files = _main__parallel(files, replace_func, args)
+
+        else:
+            cnt_changes = cnt_changed_files = 0
+            for entry in files:
+                if args.replacement_budget and args.replacement_budget.exhausted():
+                    if args.debug:
+                        debug('limit of replacements exhausted, remaining files skipped')
+                    break
+
+                try:
+                    cnt_changes_single, cnt_changed_files_single = _main__process_file(entry, replace_func, args)
+                    cnt_changes += cnt_changes_single
+                    cnt_changed_files += cnt_changed_files_single
+                except SubstException as exc:
+                    err(u(exc), indent=int(args.verbose or args.debug), exit_code=1)
+                if args.checkpoint:
+                    _main__checkpoint(entry.path, args)
+    finally:
+        if args.checkpoint:
+            args.checkpoint.close()
+
+    if args.report:
+        args.report.close()
+
+    if args.manifest:
+        args.manifest.close()
+
+    if args.encoding_cache:
+        args.encoding_cache.save()
+
+    if args.summary:
+        _main__write_summary(args, len(files or ()), cnt_changes, cnt_changed_files, time.time() - started)
 
     if args.verbose:
         debug('There was %d %s in %d %s.' % (
             cnt_changes, _plural_s(cnt_changes, 'replacement'),
             cnt_changed_files, _plural_s(cnt_changed_files, 'file'),
         ))
+        if args.memoize:
+            lookups = args.replace.hits + args.replace.misses
+            debug('Memoized replacements: hits: %d, misses: %d (hit rate: %.1f%%).' % (
+                args.replace.hits, args.replace.misses, 100.0 * args.replace.hits / lookups if lookups else 0,
+            ))
 
     if cnt_changes > 0:
         return 0
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import io
+import json
+import os
+
+import pytest
+from .test_manager import *
+import subst
+
+
+def test_checkpoint_resume(tmpdir):
+    path = str(tmpdir.join('checkpoint.jsonl'))
+
+    checkpoint = subst._Checkpoint(path)
+    checkpoint.add('a.txt')
+    checkpoint.close()
+    with io.open(path, 'ab') as fh:
+        fh.write(b'"/incomplete')
+
+    checkpoint = subst._Checkpoint(path, resume=True)
+    assert checkpoint.done('a.txt')
+    assert not checkpoint.done('b.txt')
+    checkpoint.add_backup('b.txt.bak')
+    checkpoint.add('b.txt')
+    checkpoint.close()
+
+    checkpoint = subst._Checkpoint(path, resume=True)
+    assert checkpoint.done('b.txt')
+    assert checkpoint.backed_up('b.txt.bak')
+    assert not checkpoint.done('b.txt.bak')
+    assert not checkpoint.backed_up('a.txt.bak')
+    assert not subst._Checkpoint(path).done('a.txt')
+
+
+def test_main_resume(tmpdir):
+    checkpoint = str(tmpdir.join('checkpoint.jsonl'))
+    paths = [str(tmpdir.join('%d.txt' % i)) for i in range(3)]
+    for path in paths:
+        with open(path, 'wb') as fh:
+            fh.write(b'a\n')
+
+    # interrupted run: first file finished, second one already rewritten, but not yet stored
+    with io.open(checkpoint, 'w', encoding='utf-8') as fh:
+        fh.write('%s\n' % json.dumps(os.path.abspath(paths[0])))
+        fh.write('%s\n' % json.dumps({'backup': os.path.abspath(paths[1] + '.bak')}))
+    with open(paths[1] + '.bak', 'wb') as fh:
+        fh.write(b'a\n')
+    with open(paths[1], 'wb') as fh:
+        fh.write(b'aa\n')
+
+    assert subst.main(['--checkpoint', checkpoint, '--resume', '-s', 's/a/aa/'] + paths) == 0
+
+    with open(paths[0], 'rb') as fh:
+        assert fh.read() == b'a\n'
+    for path in paths[1:]:
+        with open(path, 'rb') as fh:
+            assert fh.read() == b'aa\n'
+        with open(path + '.bak', 'rb') as fh:
+            assert fh.read() == b'a\n'
+
+    with io.open(checkpoint, encoding='utf-8') as fh:
+        records = [json.loads(line) for line in fh]
+    assert [record for record in records if not isinstance(record, dict)] == [os.path.abspath(path) for path in paths]
+    assert {'backup': os.path.abspath(paths[2] + '.bak')} in records
+
+
+def test_main_resume_keeps_other_backups(tmpdir):
+    checkpoint = str(tmpdir.join('checkpoint.jsonl'))
+    path = str(tmpdir.join('a.txt'))
+    with open(path, 'wb') as fh:
+        fh.write(b'edited\n')
+    # left by older run, not by interrupted one
+    with open(path + '.bak', 'wb') as fh:
+        fh.write(b'old\n')
+    with io.open(checkpoint, 'w', encoding='utf-8') as fh:
+        fh.write('%s\n' % json.dumps({'backup': str(tmpdir.join('other.txt.bak'))}))
+
+    with pytest.raises(SystemExit):
+        subst.main(['--checkpoint', checkpoint, '--resume', '-s', 's/e/x/', path])
+
+    with open(path, 'rb') as fh:
+        assert fh.read() == b'edited\n'
+    with open(path + '.bak', 'rb') as fh:
+        assert fh.read() == b'old\n'
+
+
+def test_main_checkpoint_stores_backups(tmpdir):
+    checkpoint = str(tmpdir.join('checkpoint.jsonl'))
+    path = str(tmpdir.join('a.txt'))
+    with open(path, 'wb') as fh:
+        fh.write(b'a\n')
+
+    assert subst.main(['--checkpoint', checkpoint, '-s', 's/a/b/', path]) == 0
+
+    with io.open(checkpoint, encoding='utf-8') as fh:
+        records = [json.loads(line) for line in fh]
+    assert records == [{'backup': os.path.abspath(path + '.bak')}, os.path.abspath(path)]
+
+
+@pytest.mark.parametrize('args', [
+    ['--resume'],
+    ['--checkpoint', 'checkpoint.jsonl', '--resume', '--no-backup'],
+])
+def test_resume_invalid(args):
+    with pytest.raises(SystemExit):
+        subst.parse_args(args + ['-s', 's/a/b/', 'file.txt'])
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import codecs
+import io
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import pytest
+from .test_manager import *
+import subst
+
+
+DATA = 'zażółć gęślą jaźń\n' * 1000
+
+
+@pytest.fixture(params=['utf-8', 'utf-16-le'])
+def files(request, tmpdir):
+    encoding = request.param
+    src_path = tmpdir.join('src')
+    src_path.write_binary(DATA.encode(encoding))
+    dst_path = tmpdir.join('dst')
+
+    src = codecs.getreader(encoding)(io.open(str(src_path), 'rb'))
+    dst_fh = io.open(str(dst_path), 'wb')
+    dst = codecs.getwriter(encoding)(dst_fh)
+
+    def result():
+        src.close()
+        dst_fh.close()
+        return dst_path.read_binary().decode(encoding)
+
+    return src, dst, result
+
+
+def test_after_readline(files):
+    src, dst, result = files
+
+    dst.write(src.readline())
+    subst._copy_rest(src, dst)
+
+    assert result() == DATA
+
+
+def test_after_partial_read(files):
+    src, dst, result = files
+
+    dst.write(src.read(7))
+    subst._copy_rest(src, dst)
+
+    assert result() == DATA
+
+
+def test_after_iteration(files):
+    src, dst, result = files
+
+    for line in src:
+        dst.write(line.upper())
+        break
+    subst._copy_rest(src, dst)
+
+    assert result() == DATA.split('\n', 1)[0].upper() + '\n' + DATA.split('\n', 1)[1]
+
+
+def test_different_encodings(tmpdir):
+    src_path = tmpdir.join('src')
+    src_path.write_binary(DATA.encode('utf-8'))
+    dst_path = tmpdir.join('dst')
+
+    with io.open(str(src_path), 'rb') as src_fh, io.open(str(dst_path), 'wb') as dst_fh:
+        src = codecs.getreader('latin-1')(src_fh)
+        dst = codecs.getwriter('utf-8')(dst_fh)
+        dst.write(src.readline())
+        subst._copy_rest(src, dst)
+
+    assert dst_path.read_binary().decode('utf-8') == DATA.encode('utf-8').decode('latin-1')
+
+
+def test_streams():
+    src = StringIO(DATA)
+    dst = StringIO()
+
+    dst.write(src.read(7))
+    subst._copy_rest(src, dst)
+
+    assert dst.getvalue() == DATA
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import os
+
+import pytest
+from .test_manager import *
+import subst
+
+
+def _write(tmpdir, name, data):
+    path = str(tmpdir.join(name))
+    with open(path, 'wb') as fh:
+        fh.write(data)
+    return path
+
+
+def test_dedupe_paths_and_hard_links(tmpdir):
+    path = _write(tmpdir, 'a.txt', b'foo\n')
+    other = _write(tmpdir, 'b.txt', b'foo\n')
+    link = str(tmpdir.join('link.txt'))
+    os.link(path, link)
+    missing = str(tmpdir.join('missing.txt'))
+
+    entries = [subst.FileEntry(p) for p in (path, other, link, path, missing, missing)]
+    assert [entry.path for entry in subst._parse_args__dedupe(entries)] == [path, other, link, missing]
+
+    links = {}
+    entries = [subst.FileEntry(p) for p in (path, other, link, path, missing, missing)]
+    assert [entry.path for entry in subst._parse_args__dedupe(entries, links)] == [path, other, missing]
+    assert {key: [entry.path for entry in group] for key, group in links.items()} == {path: [link]}
+
+
+def test_main_hard_links(tmpdir):
+    path = _write(tmpdir, 'a.txt', b'foo\n')
+    link = str(tmpdir.join('link.txt'))
+    os.link(path, link)
+
+    assert subst.main(['-s', 's/foo/bar/', path, link]) == 0
+    for p in (path, link):
+        with open(p, 'rb') as fh:
+            assert fh.read() == b'bar\n'
+        with open(p + '.bak', 'rb') as fh:
+            assert fh.read() == b'foo\n'
+
+
+def test_main_hard_links_in_place_patch(tmpdir):
+    path = _write(tmpdir, 'a.txt', b'foo\n')
+    link = str(tmpdir.join('link.txt'))
+    os.link(path, link)
+
+    assert subst.main(['--in-place-patch', '-s', 's/foo/bar/', path, link]) == 0
+    assert os.path.samefile(path, link)
+    with open(link, 'rb') as fh:
+        assert fh.read() == b'bar\n'
+    with open(path + '.bak', 'rb') as fh:
+        assert fh.read() == b'foo\n'
+    assert not os.path.exists(link + '.bak')
+
+
+def test_dedupe_content(tmpdir):
+    first = _write(tmpdir, 'a.txt', b'foo\nbar\n')
+    different = _write(tmpdir, 'b.txt', b'foo\nbaz\n')
+    copy = _write(tmpdir, 'c.txt', b'foo\nbar\n')
+    shorter = _write(tmpdir, 'd.txt', b'foo\n')
+
+    entries = [subst.FileEntry(p) for p in (first, different, copy, shorter)]
+    files, copies = subst._main__dedupe_content(entries)
+    assert [entry.path for entry in files] == [first, different, shorter]
+    assert {path: [entry.path for entry in group] for path, group in copies.items()} == {first: [copy]}
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import codecs
+
+import pytest
+from .test_manager import *
+import subst
+
+
+@pytest.fixture()
+def write_file(tmpdir):
+    def _(data):
+        path = tmpdir.join('file.txt')
+        path.write_binary(data)
+        return str(path)
+
+    return _
+
+
+@pytest.mark.parametrize('bom, encoding', [
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be'),
+    (codecs.BOM_UTF32_LE, 'utf-32-le'),
+    (codecs.BOM_UTF32_BE, 'utf-32-be'),
+])
+def test_bom(write_file, bom, encoding):
+    path = write_file(bom + 'zażółć'.encode(encoding))
+
+    assert subst._detect_encoding(path) == (encoding, bom)
+
+
+def test_utf8(write_file):
+    path = write_file('zażółć'.encode('utf-8'))
+
+    assert subst._detect_encoding(path) == ('utf-8', b'')
+
+
+def test_utf8_truncated_at_sniff_size(write_file):
+    data = b'x' * (subst.AUTO_ENCODING_SNIFF_SIZE - 1) + 'ż'.encode('utf-8')
+    path = write_file(data)
+
+    assert subst._detect_encoding(path) == ('utf-8', b'')
+
+
+def test_fallback(write_file):
+    path = write_file('café'.encode('latin-1'))
+
+    assert subst._detect_encoding(path) == (subst.AUTO_ENCODING_FALLBACK, b'')
+
+
+def test_empty(write_file):
+    path = write_file(b'')
+
+    assert subst._detect_encoding(path) == ('utf-8', b'')
+
+
+LATE_INVALID_UTF8 = b'x' * (subst.AUTO_ENCODING_SNIFF_SIZE + 100) + b'\nfoo caf\xe9\n'
+
+
+def test_fallback_after_sniff_size_exit_on_first_match(write_file):
+    path = write_file(LATE_INVALID_UTF8)
+
+    assert subst.main(['--encoding-file', 'auto', '--exit-on-first-match', '-s', 's/caf./x/', path]) == 0
+
+
+def test_fallback_after_sniff_size_stdout(write_file, capfd):
+    path = write_file(LATE_INVALID_UTF8)
+
+    assert subst.main(['--encoding-file', 'auto', '--stdout', '-s', 's/foo/bar/', path]) == 0
+
+    out = capfd.readouterr().out
+    assert out.endswith('\nbar café\n')
+    assert out.count('x') == subst.AUTO_ENCODING_SNIFF_SIZE + 100
+
+
+@pytest.mark.parametrize('args, replaced', [
+    (['-s', 's/foo/bar/'], 1),
+    (['--engine', 'mmap', '-s', 's/foo/bar/g'], 2),
+])
+def test_stdout_in_other_encoding(write_file, capfd, args, replaced):
+    path = write_file(LATE_INVALID_UTF8 * 2)
+
+    assert subst.main(['--encoding-file', 'latin-1', '--stdout'] + args + [path]) == 0
+
+    expected = (LATE_INVALID_UTF8 * 2).decode('latin-1').replace('foo', 'bar', replaced)
+    assert capfd.readouterr().out == expected
+
+
+if __name__ == '__main__':
+    pytest.main()
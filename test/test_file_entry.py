@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import os
+
+import pytest
+from .test_manager import *
+import subst
+
+
+def test_file_entry_regular(tmpdir):
+    path = str(tmpdir.join('file.txt'))
+    with open(path, 'wb') as fh:
+        fh.write(b'foo bar\n')
+
+    entry = subst.FileEntry(path)
+    assert entry.path == path
+    assert entry.size == 8
+    assert entry.exists()
+    assert entry.is_regular()
+    assert entry.ino == os.stat(path).st_ino
+
+
+def test_file_entry_missing(tmpdir):
+    entry = subst.FileEntry(str(tmpdir.join('missing.txt')))
+    assert not entry.exists()
+    assert not entry.is_regular()
+    assert entry.size is None
+
+
+def test_file_entry_symlink(tmpdir):
+    path = str(tmpdir.join('file.txt'))
+    with open(path, 'wb') as fh:
+        fh.write(b'foo\n')
+    link = str(tmpdir.join('link.txt'))
+    os.symlink(path, link)
+
+    entry = subst.FileEntry(link)
+    assert entry.exists()
+    assert not entry.is_regular()
+
+
+def test_make_backup_exclusive(tmpdir):
+    path = str(tmpdir.join('file.txt'))
+    with open(path, 'wb') as fh:
+        fh.write(b'foo\n')
+
+    backup_path = subst._process_file__make_backup(path, '.bak')
+    with open(backup_path, 'rb') as fh:
+        assert fh.read() == b'foo\n'
+
+    with pytest.raises(subst.SubstException):
+        subst._process_file__make_backup(path, '.bak')
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import os
+import subprocess
+
+import pytest
+from .test_manager import *
+import subst
+
+
+def _git(*args):
+    subprocess.check_call(('git', ) + args, stdout=subprocess.PIPE)
+
+
+@pytest.fixture
+def repo(tmpdir, monkeypatch):
+    try:
+        _git('--version')
+    except OSError:
+        pytest.skip('git is not available')
+
+    monkeypatch.chdir(str(tmpdir))
+    _git('init', '-q')
+    for name in ('tracked.txt', 'changed.py', 'untracked.txt', 'ignored.txt'):
+        with open(name, 'w') as fh:
+            fh.write('foo\n')
+    with open('.gitignore', 'w') as fh:
+        fh.write('ignored.txt\n')
+    os.symlink('tracked.txt', 'link.txt')
+    _git('add', 'tracked.txt', 'changed.py', 'link.txt', '.gitignore')
+    _git('-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-q', '-m', 'init')
+    with open('changed.py', 'a') as fh:
+        fh.write('bar\n')
+    return str(tmpdir)
+
+
+def _names(argv):
+    args = subst.parse_args(['-s', 's/foo/bar/'] + argv)
+    return sorted(os.path.basename(entry.path) for entry in args.files)
+
+
+def test_git_tracked(repo):
+    assert _names(['--git']) == ['.gitignore', 'changed.py', 'tracked.txt']
+
+
+def test_git_tracked_pathspec(repo):
+    assert _names(['--git', '*.py']) == ['changed.py']
+
+
+def test_git_changed(repo):
+    assert _names(['--git-changed', 'HEAD']) == ['changed.py']
+
+
+def test_git_untracked(repo):
+    assert _names(['--git-untracked']) == ['untracked.txt']
+
+
+def test_git_combined(repo):
+    assert _names(['--git-changed', 'HEAD', '--git-untracked']) == ['changed.py', 'untracked.txt']
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import hashlib
+import io
+import json
+
+import pytest
+from .test_manager import *
+import subst
+
+
+def test_hashing_stream():
+    content_hash = subst._ContentHash(b'ab')
+    stream = subst._HashingStream(io.BytesIO(b'cdef'), content_hash)
+    assert stream.read(2) == b'cd'
+    assert stream.read() == b'ef'
+    assert content_hash.size == 6
+    assert content_hash.hexdigest() == hashlib.sha256(b'abcdef').hexdigest()
+    assert not hasattr(stream, 'fileno')
+
+
+@pytest.mark.parametrize('data, changed', [
+    (b'foo bar\n' * 1000, True),
+    (b'\xef\xbb\xbffoo bar\n', True),
+    (b'foo \xff\n', True),
+    (b'bar\n', False),
+])
+def test_manifest(tmpdir, data, changed):
+    path = str(tmpdir.join('file.txt'))
+    manifest = str(tmpdir.join('manifest.jsonl'))
+    with open(path, 'wb') as fh:
+        fh.write(data)
+
+    subst.main(['--no-backup', '--encoding-file', 'auto', '--manifest', manifest, '-s', 's/foo/XY/g', path])
+
+    with open(path, 'rb') as fh:
+        new_data = fh.read()
+    with io.open(manifest, encoding='utf-8') as fh:
+        records = [json.loads(line) for line in fh]
+
+    if not changed:
+        assert records == []
+        return
+
+    assert records == [{
+        'path': path,
+        'old_sha256': hashlib.sha256(data).hexdigest(),
+        'new_sha256': hashlib.sha256(new_data).hexdigest(),
+        'old_size': len(data),
+        'new_size': len(new_data),
+        'replacements': data.count(b'foo'),
+    }]
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import re
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import pytest
+from .test_manager import *
+import subst
+
+
+class MockRecordWriter(object):
+    def __init__(self):
+        self.records = []
+
+    def write(self, records):
+        self.records.extend(records)
+
+
+def _report(pattern, data, replace, count=0, linear=False, encoding='utf-8'):
+    writer = MockRecordWriter()
+    report = subst._MatchReport(re.compile(pattern), 'path', encoding, writer)
+    dst = StringIO()
+    if linear:
+        cnt = subst.replace_linear(StringIO(data), dst, report, replace, count)
+    else:
+        cnt = subst.replace_global(StringIO(data), dst, report, replace, count)
+    report.flush()
+
+    return cnt, dst.getvalue(), [(r['offset'], r['line'], r['column'], r['length'], r['replacement_length'])
+                                 for r in writer.records]
+
+
+def test_global():
+    cnt, data, records = _report(r'ab', 'ab ab\nxx ab\n', 'XYZ')
+
+    assert cnt == 3
+    assert data == 'XYZ XYZ\nxx XYZ\n'
+    assert records == [(0, 1, 1, 2, 3), (3, 1, 4, 2, 3), (9, 2, 4, 2, 3)]
+
+
+def test_linear():
+    cnt, data, records = _report(r'ab', 'ab ab\nxx ab\n', 'XYZ', linear=True)
+
+    assert cnt == 3
+    assert records == [(0, 1, 1, 2, 3), (3, 1, 4, 2, 3), (9, 2, 4, 2, 3)]
+
+
+def test_multibyte_offsets():
+    cnt, data, records = _report(r'ab', 'zażółć ab\nść ab', 'ą', linear=True)
+
+    assert cnt == 2
+    assert records == [(11, 1, 8, 2, 2), (19, 2, 4, 2, 2)]
+
+
+def test_backreferences():
+    cnt, data, records = _report(r'(a)(b)', 'xab', r'\2\1\1')
+
+    assert data == 'xbaa'
+    assert records == [(1, 1, 2, 2, 3)]
+
+
+def test_callable():
+    cnt, data, records = _report(r'b+', 'abbb', lambda m: str(len(m.group(0))))
+
+    assert data == 'a3'
+    assert records == [(1, 1, 2, 3, 1)]
+
+
+def test_count():
+    cnt, data, records = _report(r'a', 'a\na\na\n', 'b', count=2, linear=True)
+
+    assert cnt == 2
+    assert data == 'b\nb\na\n'
+    assert records == [(0, 1, 1, 1, 1), (2, 2, 1, 1, 1)]
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import re
+
+import pytest
+from .test_manager import *
+import subst
+
+
+class CountingReplacement(object):
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, match):
+        self.calls += 1
+        return match.group(0).upper()
+
+
+def test_same_result():
+    func = CountingReplacement()
+    memoized = subst._MemoizedReplacement(func, 10)
+
+    result = re.sub(r'\w+', memoized, 'ala ma kota, ala ma psa')
+
+    assert result == 'ALA MA KOTA, ALA MA PSA'
+    assert func.calls == 4
+    assert memoized.hits == 2
+    assert memoized.misses == 4
+
+
+def test_keyed_by_groups():
+    memoized = subst._MemoizedReplacement(lambda m: m.group(1) or '-', 10)
+
+    result = re.sub(r'a(b)?', memoized, 'a ab a ab')
+
+    assert result == '- b - b'
+    assert memoized.misses == 2
+
+
+def test_size_limit():
+    func = CountingReplacement()
+    memoized = subst._MemoizedReplacement(func, 2)
+
+    re.sub(r'\w', memoized, 'abcabc')
+
+    assert func.calls == 6
+    assert memoized.hits == 0
+
+
+def test_least_recently_used_dropped():
+    func = CountingReplacement()
+    memoized = subst._MemoizedReplacement(func, 2)
+
+    re.sub(r'\w', memoized, 'ababcb')
+
+    assert func.calls == 3
+    assert memoized.hits == 3
+
+
+def test_with_eval_replacement():
+    memoized = subst._MemoizedReplacement(subst._parse_args__eval_replacement('m.group(0) * 2'), 10)
+
+    assert re.sub(r'\d', memoized, '1 2 1') == '11 22 11'
+    assert memoized.hits == 1
+
+
+if __name__ == '__main__':
+    pytest.main()
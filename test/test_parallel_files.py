@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+
+import pytest
+from .test_manager import *
+import subst
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('100', 100),
+    ('4k', 4096),
+    ('512M', 512 * 1024 ** 2),
+    ('1.5G', 3 * 1024 ** 3 // 2),
+    ('2GiB', 2 * 1024 ** 3),
+])
+def test_parse_args_size(value, expected):
+    assert subst._parse_args__size(value) == expected
+
+
+@pytest.mark.parametrize('value', ['', 'M', '12X', '-5'])
+def test_parse_args_size_invalid(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        subst._parse_args__size(value)
+
+
+@pytest.mark.parametrize('argv, small', [
+    (['-s', 's/foo/bar/'], True),
+    (['-s', 's/fo+|ba[rz]/x/'], True),
+    (['-s', 's/foo\\nbar/x/'], False),
+    (['--linear', '-s', 's/foo\\nbar/x/'], True),
+    (['--engine', 'global', '-s', 's/foo/bar/'], False),
+    (['--engine', 'mmap', '-s', 's/foo\\nbar/x/'], True),
+])
+def test_estimate_memory(argv, small):
+    cfg = subst.parse_args(argv + ['file'])
+    size = 1024 ** 3
+    assert (subst._main__estimate_memory(size, cfg) < size) == small
+
+
+def test_stdout_in_order(tmpdir, capfd):
+    paths = []
+    for i in range(4):
+        path = str(tmpdir.join('%d.txt' % i))
+        with open(path, 'wb') as fh:
+            fh.write(('file%d foo\n' % i).encode('ascii') * 20000)
+        paths.append(path)
+
+    assert subst.main(['-j', '3', '--stdout', '-s', 's/foo/bar/g'] + paths) == 0
+
+    out = capfd.readouterr().out
+    assert out == ''.join('file%d bar\n' % i * 20000 for i in range(4))
+
+
+def test_error_waits_for_running_files(tmpdir):
+    paths = [str(tmpdir.join('%d.txt' % i)) for i in range(3)]
+    for path in paths:
+        with open(path, 'wb') as fh:
+            fh.write(b'foo\n')
+    tmpdir.mkdir('dir')
+
+    with pytest.raises(SystemExit) as exc:
+        subst.main(['-b', '-j', '2', '-s', 's/foo/bar/'] + paths + [str(tmpdir.join('dir'))])
+    assert exc.value.code == 1
+
+    for path in paths:
+        with open(path, 'rb') as fh:
+            assert fh.read() in (b'foo\n', b'bar\n')
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import pytest
+from .test_manager import *
+import subst
+
+
+@pytest.fixture()
+def path(tmpdir):
+    path = tmpdir.join('file.txt')
+    path.write_binary(b'aaaa\nbb\ncccccc\nd\neeee')
+    return str(path)
+
+
+def test_line_aligned(path):
+    segments = subst._parallel__segments(path, 0, 21, 3)
+
+    assert segments == [(0, 8), (8, 15), (15, 21)]
+
+
+def test_cover_whole_range(path):
+    for parts in range(1, 30):
+        segments = subst._parallel__segments(path, 0, 21, parts)
+
+        assert segments[0][0] == 0
+        assert segments[-1][1] == 21
+        assert all(prev[1] == nxt[0] for prev, nxt in zip(segments, segments[1:]))
+        assert all(start < end for start, end in segments)
+
+
+def test_start_offset(path):
+    segments = subst._parallel__segments(path, 5, 21, 2)
+
+    assert segments == [(5, 15), (15, 21)]
+
+
+def test_single_part(path):
+    assert subst._parallel__segments(path, 0, 21, 1) == [(0, 21)]
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import re
+
+import pytest
+from .test_manager import *
+import subst
+
+
+MODULE = '''
+def upper(match):
+    return match.group(0).upper()
+
+def factory():
+    table = {'ala': 'ola'}
+    return lambda match: table.get(match.group(0), match.group(0))
+
+class Replacer(object):
+    @staticmethod
+    def reverse(match):
+        return match.group(0)[::-1]
+
+not_callable = 1
+'''
+
+
+@pytest.fixture()
+def module(tmpdir, monkeypatch):
+    tmpdir.join('subst_test_replace_module.py').write(MODULE)
+    monkeypatch.syspath_prepend(str(tmpdir))
+    return 'subst_test_replace_module'
+
+
+def test_function(module):
+    result = subst._parse_args__replace_func(module + ':upper')
+
+    assert re.sub(r'\w+', result, 'ala ma') == 'ALA MA'
+
+
+def test_factory(module):
+    result = subst._parse_args__replace_func(module + ':factory()')
+
+    assert re.sub(r'\w+', result, 'ala ma') == 'ola ma'
+
+
+def test_nested_attribute(module):
+    result = subst._parse_args__replace_func(module + ':Replacer.reverse')
+
+    assert re.sub(r'\w+', result, 'ala ma') == 'ala am'
+
+
+def test_no_function():
+    with pytest.raises(subst.ParserException):
+        subst._parse_args__replace_func('os.path')
+
+
+def test_missing_module():
+    with pytest.raises(subst.ParserException):
+        subst._parse_args__replace_func('subst_test_missing_module:func')
+
+
+def test_missing_function(module):
+    with pytest.raises(subst.ParserException):
+        subst._parse_args__replace_func(module + ':missing')
+
+
+def test_not_callable(module):
+    with pytest.raises(subst.ParserException):
+        subst._parse_args__replace_func(module + ':not_callable')
+
+
+if __name__ == '__main__':
+    pytest.main()
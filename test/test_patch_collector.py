@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import re
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import pytest
+from .test_manager import *
+import subst
+
+
+def _collect(pattern, data, replace, count=0, offset=0):
+    collector = subst._PatchCollector(re.compile(pattern), 'utf-8', offset)
+    cnt = subst.replace_linear(StringIO(data), subst._NullWriter(), collector, replace, count)
+    return cnt, collector.patches()
+
+
+def test_same_length():
+    cnt, patches = _collect(r'v\d', 'ab v1\nżó v2\n', 'v9')
+
+    assert cnt == 2
+    assert patches == [(3, b'v9'), (11, b'v9')]
+
+
+def test_offset():
+    cnt, patches = _collect(r'v\d', 'ab v1\n', 'v9', offset=3)
+
+    assert patches == [(6, b'v9')]
+
+
+def test_identical_replacement_is_skipped():
+    cnt, patches = _collect(r'v\d', 'v1 v2', 'v1')
+
+    assert cnt == 2
+    assert patches == [(3, b'v1')]
+
+
+def test_multibyte_same_length():
+    cnt, patches = _collect(r'ó', 'zażółć', 'Ó')
+
+    assert patches == [(4, 'Ó'.encode('utf-8'))]
+
+
+def test_length_changed():
+    with pytest.raises(subst._LengthChanged):
+        _collect(r'v\d', 'ab v1\nv2\n', 'v10')
+
+
+def test_length_changed_in_bytes():
+    with pytest.raises(subst._LengthChanged):
+        _collect(r'o', 'foo', 'ó')
+
+
+def test_in_place_patch_fallback_encoding(tmpdir):
+    path = str(tmpdir.join('file.txt'))
+    data = b'v1\n' + b'x' * subst.AUTO_ENCODING_SNIFF_SIZE + b'\ncaf\xe9 v2\n'
+    with open(path, 'wb') as fh:
+        fh.write(data)
+
+    assert subst.main(['--no-backup', '--in-place-patch', '--encoding-file', 'auto', '-s', 's/v\\d/v9/g', path]) == 0
+
+    with open(path, 'rb') as fh:
+        assert fh.read() == data.replace(b'v1', b'v9').replace(b'v2', b'v9')
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import re
+
+import pytest
+from .test_manager import *
+import subst
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('foo', (['foo'], [])),
+    ('foo_bar', (['foo', 'bar'], ['_'])),
+    ('FOO-BAR', (['FOO', 'BAR'], ['-'])),
+    ('fooBar', (['foo', 'Bar'], [''])),
+    ('HTTPServer', (['HTTP', 'Server'], [''])),
+    ('getHTTP2', (['get', 'HTTP2'], [''])),
+])
+def test_case_words(text, expected):
+    assert subst._case_words(text) == expected
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('old_name', 'new_name'),
+    ('OLD_NAME', 'NEW_NAME'),
+    ('old-name', 'new-name'),
+    ('Old-Name', 'New-Name'),
+    ('oldName', 'newName'),
+    ('OldName', 'NewName'),
+    ('Oldname', 'New_name'),
+    ('OLDNAME', 'NEW_NAME'),
+    ('oldname', 'new_name'),
+    ('oLDnAME', 'new_name'),
+])
+def test_preserve_case(text, expected):
+    pattern = re.compile('old[_-]?name', re.IGNORECASE | re.UNICODE)
+    replace = subst._PreserveCase(pattern, 'new_name')
+    assert pattern.sub(replace, text) == expected
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('foo', 'barbaz'),
+    ('FOO', 'BARBAZ'),
+    ('fooBAR', 'barBAZ'),
+    ('fOO', 'barBAZ'),
+    ('foo_Bar-baz', 'barBaz'),
+    ('foo_BAR_Baz', 'barBaz'),
+])
+def test_preserve_case_mixed(text, expected):
+    pattern = re.compile('[fo_-]+(?:bar[_-]?baz|bar)?', re.IGNORECASE | re.UNICODE)
+    replace = subst._PreserveCase(pattern, 'barBaz')
+    assert pattern.sub(replace, text) == expected
+
+
+def test_preserve_case_template():
+    pattern = re.compile('get_(\\w+)', re.IGNORECASE | re.UNICODE)
+    replace = subst._PreserveCase(pattern, 'fetch_\\1')
+    assert pattern.sub(replace, 'get_item GET_ITEM Get_Item') == 'fetch_item FETCH_ITEM Fetch_Item'
+
+
+def test_preserve_case_function():
+    pattern = re.compile('ab', re.IGNORECASE | re.UNICODE)
+    replace = subst._PreserveCase(pattern, lambda match: 'xyz')
+    assert pattern.sub(replace, 'ab AB Ab') == 'xyz XYZ Xyz'
+
+
+def test_parse_args():
+    args = subst.parse_args(['--preserve-case', '-s', 's/foo/bar/g', 'file.txt'])
+    assert args.pattern.flags & re.IGNORECASE
+    assert isinstance(args.replace, subst._PreserveCase)
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import re
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import pytest
+from .test_manager import *
+import subst
+
+
+DATA = 'ala ma kota\nkot ma ale\n\nala ma psa i kota\nkoniec ala'
+
+
+@pytest.mark.parametrize('pattern', [r'ala', r'a\nk', r'(k)(o)?t', r'^a', r'(?m)$', r'a*', r''])
+@pytest.mark.parametrize('replace', ['X', '', r'<\g<0>>', r'\1\n', lambda match: match.group(0).upper()])
+@pytest.mark.parametrize('count', [0, 1, 3])
+@pytest.mark.parametrize('block_size', [1, 5, 1024])
+def test_stream_same_as_subn(monkeypatch, pattern, replace, count, block_size):
+    monkeypatch.setattr(subst, 'BLOCK_SIZE', block_size)
+    monkeypatch.setattr(subst, 'GLOBAL_STREAM_MIN_SIZE', 0)
+    pattern = re.compile(pattern)
+    if replace == r'\1\n' and not pattern.groups:
+        replace = r'\\\n'
+
+    result = StringIO()
+    result_cnt = subst.replace_global(StringIO(DATA), result, pattern, replace, count)
+
+    assert (result.getvalue(), result_cnt) == pattern.subn(replace, DATA, count)
+
+
+if __name__ == '__main__':
+    pytest.main()
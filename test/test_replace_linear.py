@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import codecs
+import io
+import re
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import pytest
+from .test_manager import *
+import subst
+
+
+DATA = 'ala ma kota\r\nkot ma ale\n\nala\rma\x0cpsa i kota\u2028kot\nkoniec ala'
+
+
+def _reader():
+    return codecs.getreader('utf-8')(io.BytesIO(DATA.encode('utf-8')))
+
+
+@pytest.mark.parametrize('pattern, expected', [
+    (r'ala', True),
+    (r'a.a', True),
+    (r'[a-z]+', True),
+    (r'\bma\b', True),
+    (r'(?i)KOT(?:a|y)?', True),
+    (r'a\Sa', True),
+    (r'a\na', False),
+    (r'a\sa', False),
+    (r'a[^x]a', False),
+    (r'(?s)a.a', False),
+    (r'^ala', False),
+    (r'ala$', False),
+    (r'(?<=k)ot', False),
+    (r'a*', False),
+])
+def test_pattern_is_line_local(pattern, expected):
+    assert subst._pattern_is_line_local(re.compile(pattern)) is expected
+
+
+@pytest.mark.parametrize('pattern', [r'ala', r'a.a', r'm\w', r'\bk', r'a|\n', r'a.m', r'a\W*k', r'^a', r'a$', r'a*'])
+@pytest.mark.parametrize('count', [0, 1, 2, 3, 5])
+@pytest.mark.parametrize('block_size', [1, 4, 1024])
+def test_same_as_line_by_line(monkeypatch, pattern, count, block_size):
+    monkeypatch.setattr(subst, 'BLOCK_SIZE', block_size)
+    pattern = re.compile(pattern)
+
+    expected = StringIO()
+    expected_cnt = subst._replace_linear__lines(_reader(), expected, pattern, '<\\g<0>>', count)
+    result = StringIO()
+    result_cnt = subst.replace_linear(_reader(), result, pattern, '<\\g<0>>', count)
+
+    assert result_cnt == expected_cnt
+    assert result.getvalue() == expected.getvalue()
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import re
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import pytest
+from .test_manager import *
+import subst
+
+
+DATA = 'foo 1\n# BEGIN\nfoo 2\nfoo\nbar 3\n# END\nfoo 4\n# BEGIN\nfoo 5\nfoo'
+REGIONS = [
+    subst._LineRegions(start=re.compile('BEGIN'), end=re.compile('END')),
+    subst._LineRegions(first=3, last=5),
+    subst._LineRegions(first=7),
+    subst._LineRegions(first=1, last=1),
+]
+
+
+def _expected(regions, pattern, count):
+    """ Replace in lines chosen by `regions` one region after another.
+    """
+    lines = DATA.splitlines(True)
+    chosen = [active for active, _ in regions.lines(StringIO(DATA))]
+    result, ret, idx = [], 0, 0
+    while idx < len(lines):
+        if idx < len(chosen) and chosen[idx]:
+            end = idx
+            while end < len(chosen) and chosen[end]:
+                end += 1
+            text, cnt = pattern.subn('<\\g<0>>', ''.join(lines[idx:end]), max(0, count - ret) if count else 0)
+            if count and ret >= count:
+                text, cnt = ''.join(lines[idx:end]), 0
+            result.append(text)
+            ret += cnt
+            idx = end
+        else:
+            result.append(lines[idx])
+            idx += 1
+    return ''.join(result), ret
+
+
+@pytest.mark.parametrize('regions', REGIONS)
+@pytest.mark.parametrize('pattern', [r'foo', r'o\nb', r'^f'])
+@pytest.mark.parametrize('count', [0, 1, 2])
+def test_same_as_regions_processed_separately(regions, pattern, count):
+    pattern = re.compile(pattern, re.MULTILINE)
+    result = StringIO()
+    cnt = subst.replace_regions(StringIO(DATA), result, pattern, '<\\g<0>>', count, regions, False)
+    assert (result.getvalue(), cnt) == _expected(regions, pattern, count)
+
+
+@pytest.mark.parametrize('block_size', [1, 7, 1024])
+def test_line_local_blocks(monkeypatch, block_size):
+    monkeypatch.setattr(subst, 'BLOCK_SIZE', block_size)
+    pattern = re.compile('foo')
+    result = StringIO()
+    cnt = subst.replace_regions(StringIO(DATA), result, pattern, 'X', 0, REGIONS[0], False)
+    assert cnt == 4
+    assert result.getvalue() == DATA.replace('foo 2\nfoo', 'X 2\nX').replace('foo 5\nfoo', 'X 5\nX')
+
+
+@pytest.mark.parametrize('args, expected', [
+    (['--between', '^# BEGIN', '^# END', '-s', 's/bar/x/'], 0),
+    (['--between', '^# BEGIN', '^# END', '-s', 's/foo 4/x/'], 1),
+    (['--between', '^# BEGIN', '^# END', '-s', 's/foo\\n# END/x/'], 1),
+    (['--between', '^# BEGIN', '^# END', '-l', '-s', 's/foo 5/x/'], 0),
+    (['--lines', '3-5', '-s', 's/foo 1/x/'], 1),
+    (['--lines', '3-5', '-s', 's/foo\\nbar/x/'], 0),
+])
+def test_exit_on_first_match(tmpdir, args, expected):
+    path = tmpdir.join('file.txt')
+    path.write_binary(DATA.encode('utf-8'))
+    assert subst.main(['--exit-on-first-match'] + args + [str(path)]) == expected
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('3-5', (3, 5)),
+    ('3-', (3, None)),
+    ('-5', (1, 5)),
+    ('7', (7, 7)),
+])
+def test_parse_args_line_range(value, expected):
+    assert subst._parse_args__line_range(value) == expected
+
+
+@pytest.mark.parametrize('value', ['', '-', '0-3', '5-3', 'a-b'])
+def test_parse_args_line_range_invalid(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        subst._parse_args__line_range(value)
+
+
+if __name__ == '__main__':
+    pytest.main()
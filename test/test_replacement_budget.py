@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import io
+import re
+
+import pytest
+from .test_manager import *
+import subst
+
+
+def test_take_limited():
+    budget = subst._ReplacementBudget(5)
+
+    assert budget.take(3) == 3
+    assert budget.take(3) == 2
+
+
+def test_take_unlimited():
+    budget = subst._ReplacementBudget(5)
+
+    assert budget.take(0) == 5
+
+
+def test_settle_returns_unused():
+    budget = subst._ReplacementBudget(5)
+
+    granted = budget.take(0)
+    budget.settle(granted, 2)
+
+    assert not budget.exhausted()
+    assert budget.take(0) == 3
+
+
+def test_exhausted():
+    budget = subst._ReplacementBudget(2)
+
+    granted = budget.take(0)
+    assert not budget.exhausted()
+
+    budget.settle(granted, 2)
+    assert budget.exhausted()
+    assert budget.take(1) == 0
+
+
+def test_take_chunk():
+    budget = subst._ReplacementBudget(100)
+
+    assert budget.take_chunk(5) == 5
+    assert budget.take_chunk(5) == 4
+
+    budget = subst._ReplacementBudget(1)
+    assert budget.take_chunk(5) == 1
+    assert budget.take_chunk(5) == 0
+    assert not budget.exhausted()
+
+
+def test_budgeted_replacement():
+    budget = subst._ReplacementBudget(3)
+    replace = subst._BudgetedReplacement(re.compile('a'), 'b', budget, 2)
+
+    assert re.sub('a', replace, 'aaaaa') == 'bbbaa'
+    assert replace.used == 3
+    replace.settle()
+    assert budget.exhausted()
+
+
+def test_parallel_files(tmpdir):
+    paths = [str(tmpdir.join('%d.txt' % i)) for i in range(4)]
+    for path in paths:
+        with open(path, 'wb') as fh:
+            fh.write(b'a\n' * 100)
+
+    assert subst.main(['-b', '-j', '2', '--max-total-replacements', '150', '-s', 's/a/b/g'] + paths) == 0
+
+    replaced = 0
+    for path in paths:
+        with open(path, 'rb') as fh:
+            replaced += fh.read().count(b'b')
+    assert replaced == 150
+
+
+def test_exit_on_first_match_without_files(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    monkeypatch.setattr('sys.stdin', io.StringIO('foo\n'))
+
+    assert subst.main(['-W', '--exit-on-first-match', '-s', 's/foo/bar/', 'nomatch*']) == 1
+    assert subst.main(['--exit-on-first-match', '-s', 's/foo/bar/', '-']) == 0
+
+
+if __name__ == '__main__':
+    pytest.main()
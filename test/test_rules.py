@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import io
+import os
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import pytest
+from .test_manager import *
+import subst
+
+
+RULES = '''\
+# comment
+[*.py]
+s/^import foo$/import bar/m
+s/foo/baz/
+
+[*.yaml *.yml]
+s/foo/FOO/g
+[src/*.sql]
+s/a/b/gi
+'''
+
+
+@pytest.fixture
+def rules(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    with io.open('rules.txt', 'w', encoding='utf-8') as fh:
+        fh.write(RULES)
+    return subst.parse_args(['--rules', 'rules.txt', 'file.py']).rules
+
+
+def test_for_path(rules, tmpdir):
+    assert [replace for _, replace, _ in rules.for_path(str(tmpdir.join('x', 'a.py')))] == ['import bar', 'baz']
+    assert [count for _, _, count in rules.for_path(str(tmpdir.join('a.yml')))] == [0]
+    assert len(rules.for_path(str(tmpdir.join('src', 'a.sql')))) == 1
+    assert rules.for_path(str(tmpdir.join('a.sql'))) == []
+    assert rules.for_path(str(tmpdir.join('a.txt'))) == []
+
+
+def test_rule_chain_counts_for_whole_file(rules, tmpdir):
+    chain = subst._RuleChain(rules.for_path(str(tmpdir.join('a.py'))))
+    assert chain.subn(None, 'import foo\nfoo foo\n') == ('import bar\nbaz foo\n', 2)
+    assert chain.subn(None, 'import foo\nfoo\n') == ('import foo\nfoo\n', 0)
+
+
+def test_rule_chain_engine(rules, tmpdir):
+    chain = subst._RuleChain(rules.for_path(str(tmpdir.join('a.yml'))))
+    assert subst.select_engine(StringIO(''), StringIO(), chain, None, False) is subst.replace_windowed
+    chain = subst._RuleChain(rules.for_path(str(tmpdir.join('a.py'))))
+    assert subst.select_engine(StringIO(''), StringIO(), chain, None, False) is subst.replace_global
+
+
+@pytest.mark.parametrize('linear', ['-l', '--engine=linear'])
+def test_main_linear(rules, tmpdir, linear):
+    with io.open('file.py', 'w', encoding='utf-8') as fh:
+        fh.write('import foo\nfoo foo\nfoo\n')
+    with io.open('file.yml', 'w', encoding='utf-8') as fh:
+        fh.write('foo foo\nfoo\n')
+    assert subst.main(['--rules', 'rules.txt', linear, '-b', 'file.py', 'file.yml']) == 0
+    with io.open('file.py', encoding='utf-8') as fh:
+        assert fh.read() == 'import bar\nbaz foo\nfoo\n'
+    with io.open('file.yml', encoding='utf-8') as fh:
+        assert fh.read() == 'FOO FOO\nFOO\n'
+
+
+@pytest.mark.parametrize('content', [
+    's/a/b/\n',
+    '[*.py]\ns/a/b/q\n',
+    '[*.py]\ns/(/b/\n',
+])
+def test_invalid_rules(tmpdir, content):
+    path = str(tmpdir.join('rules.txt'))
+    with io.open(path, 'w', encoding='utf-8') as fh:
+        fh.write(content)
+    with pytest.raises(subst.ParserException):
+        subst._parse_args__rules(path, subst.parse_args(['-s', 's/a/b/', 'file']))
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import re
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import pytest
+from .test_manager import *
+import subst
+
+
+@pytest.mark.parametrize('pattern, expected', [
+    (r'foo', 'foo'),
+    (r'foo\.bar', 'foo.bar'),
+    (r'zażółć', 'zażółć'),
+    (r'a\nb', 'a\nb'),
+    (r'(?i)foo', None),
+    (r'fo+', None),
+    (r'f.o', None),
+    (r'(foo)', None),
+])
+def test_pattern_literal(pattern, expected):
+    assert subst._pattern_literal(re.compile(pattern)) == expected
+
+
+@pytest.mark.parametrize('pattern, expected', [
+    (r'foo', True),
+    (r'fo+|ba[rz]', True),
+    (r'^(a)\1$', True),
+    (r'(?i)foo', False),
+    (r'f.o', False),
+    (r'f\wo', False),
+    (r'f[^x]o', False),
+    (r'\bfoo', False),
+    (r'zażółć', False),
+])
+def test_pattern_bytes(pattern, expected):
+    result = subst._pattern_bytes(re.compile(pattern))
+
+    assert (result is not None) is expected
+    if expected:
+        assert result.pattern == pattern.encode('ascii')
+
+
+@pytest.mark.parametrize('pattern, replace, linear, expected', [
+    (r'foo', 'bar', False, subst.replace_literal),
+    (r'foo', 'bar', True, subst.replace_literal),
+    (r'foo', r'\g<0>', False, subst.replace_windowed),
+    (r'foo', lambda m: 'bar', True, subst.replace_linear),
+    (r'a\nb', 'bar', False, subst.replace_literal),
+    (r'a\nb', 'bar', True, subst.replace_linear),
+    (r'f\w+', 'bar', False, subst.replace_windowed),
+    (r'f\s+', 'bar', False, subst.replace_global),
+    (r'f\s+', 'bar', True, subst.replace_linear),
+])
+def test_select_engine(pattern, replace, linear, expected):
+    engine = subst.select_engine(StringIO('data'), StringIO(), re.compile(pattern), replace, linear)
+
+    assert engine is expected
+
+
+@pytest.mark.parametrize('pattern, replace, count, expected', [
+    (r'foo', 'X', 0, 'X bar X\nX'),
+    (r'foo', 'X', 2, 'X bar X\nfoo'),
+    (r'o\nf', '-', 0, 'foo bar fo-oo'),
+])
+def test_replace_literal(pattern, replace, count, expected):
+    dst = StringIO()
+
+    cnt = subst.replace_literal(StringIO('foo bar foo\nfoo'), dst, re.compile(pattern), replace, count)
+
+    assert dst.getvalue() == expected
+    assert cnt == len(re.findall(pattern, 'foo bar foo\nfoo')[:count or None])
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+from .test_manager import *
+import subst
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, 'send_fds'), reason='requires Python 3.9+')
+
+
+def _start_server(socket_path):
+    env = dict(os.environ)
+    env.pop(subst.SERVER_ENV_VARIABLE, None)
+    return subprocess.Popen([sys.executable, subst.__file__, '--serve', socket_path], env=env)
+
+
+def _wait_for_server(socket_path):
+    # socket file is created before server listens on it
+    for _ in range(500):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+            return
+        except (IOError, OSError):
+            time.sleep(0.01)
+        finally:
+            sock.close()
+
+
+@pytest.fixture
+def server(tmpdir):
+    socket_path = str(tmpdir.join('subst.sock'))
+    proc = _start_server(socket_path)
+    try:
+        _wait_for_server(socket_path)
+        yield socket_path
+    finally:
+        proc.send_signal(signal.SIGINT)
+        proc.wait()
+
+
+def test_forward(server, tmpdir):
+    path = str(tmpdir.join('file.txt'))
+    with open(path, 'wb') as fh:
+        fh.write(b'foo\n')
+
+    assert subst._main__forward(server, ['-b', '-s', 's/foo/bar/', path]) == 0
+    with open(path, 'rb') as fh:
+        assert fh.read() == b'bar\n'
+
+    assert subst._main__forward(server, ['-b', '-s', 's/foo/bar/', path]) == 1
+    assert subst._main__forward(server, ['--no-such-option']) == 2
+
+
+def test_forward_relative_path(server, tmpdir):
+    with open(str(tmpdir.join('file.txt')), 'wb') as fh:
+        fh.write(b'foo\n')
+
+    cwd = os.getcwd()
+    os.chdir(str(tmpdir))
+    try:
+        assert subst._main__forward(server, ['-b', '-s', 's/foo/bar/', 'file.txt']) == 0
+    finally:
+        os.chdir(cwd)
+
+    with open(str(tmpdir.join('file.txt')), 'rb') as fh:
+        assert fh.read() == b'bar\n'
+
+
+def test_idle_client_doesnt_block_others(server, tmpdir):
+    path = str(tmpdir.join('file.txt'))
+    with open(path, 'wb') as fh:
+        fh.write(b'foo\n')
+
+    idle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        idle.connect(server)
+        assert subst._main__forward(server, ['-b', '-s', 's/foo/bar/', path]) == 0
+    finally:
+        idle.close()
+
+
+def test_serve_keeps_other_files(tmpdir):
+    path = str(tmpdir.join('keep.txt'))
+    with open(path, 'wb') as fh:
+        fh.write(b'foo\n')
+
+    proc = _start_server(path)
+    assert proc.wait() == 1
+    with open(path, 'rb') as fh:
+        assert fh.read() == b'foo\n'
+
+
+def test_forward_without_server(tmpdir):
+    assert subst._main__forward(str(tmpdir.join('missing.sock')), ['-s', 's/a/b/', 'x']) is None
+
+
+if __name__ == '__main__':
+    pytest.main()
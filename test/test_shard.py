@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import io
+import json
+
+import pytest
+from .test_manager import *
+import subst
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('0/1', (0, 1)),
+    ('2/4', (2, 4)),
+    (' 1 / 3 ', (1, 3)),
+])
+def test_parse_shard(value, expected):
+    assert subst._parse_args__shard(value) == expected
+
+
+@pytest.mark.parametrize('value', ['1/1', '-1/2', '1', 'a/b', '0/0'])
+def test_parse_shard_invalid(value):
+    with pytest.raises(subst.argparse.ArgumentTypeError):
+        subst._parse_args__shard(value)
+
+
+def test_shard_by_hash():
+    paths = ['dir/file%d.txt' % i for i in range(100)]
+    shards = [subst._Shard(index, 4) for index in range(4)]
+
+    for path in paths:
+        assert sum(shard.selects(path) for shard in shards) == 1
+        assert shards[0].selects(path) == shards[0].selects('./dir/../' + path)
+    assert all(any(shard.selects(path) for path in paths) for shard in shards)
+
+
+def test_shard_by_size():
+    sizes = {'a': 10, 'b': 6, 'c': 5, 'd': 4, 'e': 3, 'f': 1}
+    shards = [subst._Shard(index, 2, sizes) for index in range(2)]
+
+    totals = [sum(sizes[path] for path in shard.listed()) for shard in shards]
+    assert sorted(totals) == [14, 15]
+    for path in sizes:
+        assert sum(shard.selects(path) for shard in shards) == 1
+
+
+def test_merge_summaries(tmpdir, capsys):
+    paths = []
+    for index in range(2):
+        path = str(tmpdir.join('summary%d.json' % index))
+        with io.open(path, 'w', encoding='utf-8') as fh:
+            fh.write(json.dumps({'shard': [index, 3], 'files': 2, 'changed_files': 1, 'replacements': 5,
+                                 'seconds': index + 1}))
+        paths.append(path)
+
+    assert subst.main(['--merge-summaries'] + paths) == 1
+
+    merged = json.loads(capsys.readouterr().out)
+    assert merged['files'] == 4
+    assert merged['replacements'] == 10
+    assert merged['seconds'] == 2
+    assert merged['shards'] == [0, 1]
+    assert merged['missing_shards'] == [2]
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import os
+import re
+
+import pytest
+from .test_manager import *
+import subst
+
+
+class Cfg(object):
+    linear = False
+    regions = None
+    rules = None
+
+    def __init__(self, pattern):
+        self.pattern = re.compile(pattern)
+
+
+@pytest.mark.parametrize('pattern, data, encoding, expected', [
+    ('foo', b'bar\n' * 1000, 'utf-8', True),
+    ('foo', b'bar foo\n', 'utf-8', False),
+    ('foo', b'', 'utf-8', True),
+    ('^$', b'', 'utf-8', False),
+    ('b.r', b'bar\n', 'utf-8', False),
+    (r'\w+', b'bar\n', 'utf-8', False),
+    ('foo', b'bar\n', 'utf-16', False),
+])
+def test_match_free(tmpdir, pattern, data, encoding, expected):
+    path = str(tmpdir.join('file.txt'))
+    with open(path, 'wb') as fh:
+        fh.write(data)
+
+    entry = subst.FileEntry(path)
+    assert subst._process_file__match_free(entry, Cfg(pattern), encoding) is expected
+
+
+def test_copy_range_pipe(tmpdir):
+    path = str(tmpdir.join('file.txt'))
+    data = b'0123456789' * 1000
+    with open(path, 'wb') as fh:
+        fh.write(data)
+
+    read_fd, write_fd = os.pipe()
+    try:
+        with open(path, 'rb') as fh:
+            copied = subst._copy_range(fh.fileno(), write_fd, 5, 100)
+        os.close(write_fd)
+        write_fd = None
+        result = os.read(read_fd, 1000)
+    finally:
+        os.close(read_fd)
+        if write_fd is not None:
+            os.close(write_fd)
+
+    if copied:
+        assert result == data[5:105]
+    else:
+        assert result == b''
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import os
+import re
+
+import pytest
+from .test_manager import *
+import subst
+
+
+@pytest.mark.parametrize('pattern, expected', [
+    (r'hello', {b'hel', b'ell', b'llo'}),
+    (r'(?i)HeLLo', {b'hel', b'ell', b'llo'}),
+    (r'foo\d+bar', {b'foo', b'bar'}),
+    (r'(abcd)?xyz', {b'xyz'}),
+    (r'(?:abc)+', {b'abc'}),
+    (r'abc|xyz', set()),
+    (r'a.c', set()),
+    (r'(?i)desk', set()),
+    (r'zażółć', set()),
+])
+def test_pattern_trigrams(pattern, expected):
+    assert subst._pattern_trigrams(re.compile(pattern)) == expected
+
+
+def _write(path, data):
+    with open(path, 'wb') as fh:
+        fh.write(data)
+
+
+def test_index_candidates(tmpdir):
+    root = str(tmpdir.mkdir('tree'))
+    _write(os.path.join(root, 'a.txt'), b'Hello world\n')
+    _write(os.path.join(root, 'b.txt'), b'nothing here\n')
+    _write(os.path.join(root, 'c.txt'), b'\xff\xfeh\x00e\x00l\x00l\x00o\x00')
+    path = str(tmpdir.join('index.db'))
+
+    index = subst._TrigramIndex(path)
+    try:
+        assert index.update(root) == (3, 0)
+        assert index.update(root) == (0, 0)
+
+        trigrams = subst._pattern_trigrams(re.compile('(?i)hello'))
+        names = sorted(os.path.basename(entry.path) for entry in index.candidates(None, trigrams))
+        assert names == ['a.txt', 'c.txt']
+
+        # changed and unknown files are always candidates
+        _write(os.path.join(root, 'b.txt'), b'something else\n')
+        _write(os.path.join(root, 'd.txt'), b'nothing\n')
+        entries = [subst.FileEntry(os.path.join(root, name)) for name in ('a.txt', 'b.txt', 'd.txt')]
+        names = [os.path.basename(entry.path) for entry in index.candidates(entries, trigrams)]
+        assert names == ['a.txt', 'b.txt', 'd.txt']
+        names = sorted(os.path.basename(entry.path) for entry in index.candidates(None, trigrams))
+        assert names == ['a.txt', 'b.txt', 'c.txt']
+        assert index.candidates([], trigrams) == []
+
+        os.unlink(os.path.join(root, 'a.txt'))
+        assert index.update(root) == (2, 1)
+        assert index.candidates(None, trigrams)[0].path.endswith('c.txt')
+    finally:
+        index.close()
+
+
+def test_main_index(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    _write('a.txt', b'xxx\n')
+    _write('b.txt', b'foo\n')
+    assert subst.main(['--build-index', '.', '--index', 'index.db']) == 0
+
+    # wildcard matching nothing doesn't select all indexed files
+    assert subst.main(['-b', '-W', '--index', 'index.db', '-s', 's/foo/bar/', 'nomatch*']) == 1
+    with open('b.txt', 'rb') as fh:
+        assert fh.read() == b'foo\n'
+
+    # file changed since indexing is checked
+    _write('a.txt', b'foo\n')
+    assert subst.main(['-b', '--index', 'index.db', '-s', 's/foo/bar/']) == 0
+    for name in ('a.txt', 'b.txt'):
+        with open(name, 'rb') as fh:
+            assert fh.read() == b'bar\n'
+
+
+if __name__ == '__main__':
+    pytest.main()
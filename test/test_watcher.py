@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import os
+import sys
+
+import pytest
+from .test_manager import *
+import subst
+
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is available only on Linux')
+
+
+def _write(path, data='foo\n'):
+    with open(path, 'w') as fh:
+        fh.write(data)
+
+
+def test_watch_recursive(tmpdir):
+    root = str(tmpdir)
+    watcher = subst._Watcher([root], debounce=0.01)
+    try:
+        batches = watcher.batches()
+
+        _write(os.path.join(root, 'a.txt'))
+        _write(os.path.join(root, 'a.txt'))
+        assert next(batches) == [os.path.join(root, 'a.txt')]
+
+        os.mkdir(os.path.join(root, 'sub'))
+        _write(os.path.join(root, 'sub', 'b.txt'))
+        _write(os.path.join(root, 'sub', 'c.txt'))
+        assert sorted(next(batches)) == [os.path.join(root, 'sub', 'b.txt'), os.path.join(root, 'sub', 'c.txt')]
+
+        _write(os.path.join(root, '.gen'))
+        os.rename(os.path.join(root, '.gen'), os.path.join(root, 'd.txt'))
+        assert next(batches) == [os.path.join(root, '.gen'), os.path.join(root, 'd.txt')]
+    finally:
+        watcher.close()
+
+
+def test_watch_single_file(tmpdir):
+    path = str(tmpdir.join('a.txt'))
+    _write(path)
+    watcher = subst._Watcher([path], debounce=0.01)
+    try:
+        batches = watcher.batches()
+        _write(str(tmpdir.join('other.txt')))
+        _write(path)
+        assert next(batches) == [path]
+    finally:
+        watcher.close()
+
+
+def test_main_watch_refreshes_backup(tmpdir, monkeypatch):
+    path = str(tmpdir.join('a.txt'))
+    other = str(tmpdir.join('b.txt'))
+    _write(path)
+    _write(other)
+    _write(other + '.bak', 'old\n')
+
+    class Watcher(object):
+        def __init__(self, paths):
+            pass
+
+        def batches(self):
+            yield [path, other]
+            _write(path, 'foo 2\n')
+            yield [path]
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(subst, '_Watcher', Watcher)
+    assert subst.main(['--watch', '-s', 's/foo/bar/', str(tmpdir)]) == 0
+    with open(path) as fh:
+        assert fh.read() == 'bar 2\n'
+    with open(path + '.bak') as fh:
+        assert fh.read() == 'foo 2\n'
+    with open(other + '.bak') as fh:
+        assert fh.read() == 'old\n'
+
+
+if __name__ == '__main__':
+    pytest.main()